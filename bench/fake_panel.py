@@ -0,0 +1,29 @@
+"""模拟面板向机器人推送事件，用于测试面板事件接收服务
+
+用法（在项目根目录执行）：
+    python -m bench.fake_panel user@example.com
+    python -m bench.fake_panel --event user_banned --token <PANEL_EVENTS_TOKEN> a@example.com b@example.com
+"""
+import sys
+import argparse
+import httpx
+
+EVENT_TYPES = ('plan_changed', 'order_paid', 'user_banned')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='模拟面板推送事件')
+    parser.add_argument('emails', nargs='+', help='发生变化的用户邮箱')
+    parser.add_argument('--event', choices=EVENT_TYPES, default='plan_changed')
+    parser.add_argument('--url', default='http://127.0.0.1:9109/panel/events', help='事件接收地址')
+    parser.add_argument('--token', default='', help='PANEL_EVENTS_TOKEN')
+    args = parser.parse_args()
+
+    events = [{'event': args.event, 'email': email} for email in args.emails]
+    response = httpx.post(args.url, json=events, headers={'X-Panel-Token': args.token})
+    print(response.status_code, response.text)
+    sys.exit(0 if response.status_code == 202 else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""性能基准测试
+
+在进程内启动模拟的V2Board和Emby服务，生成指定数量的绑定用户，然后测量：
+- 各命令处理函数的吞吐量（命令/秒）
+- update_all_emby_permissions（启动时的Emby对账和权限下发）的耗时
+- check_and_clean_invalid_emby_accounts（订阅检查任务）的耗时
+
+结果与基线文件比较，任一指标退化超过容差时以非0状态退出；
+基线文件中没有对应用户数的结果时同样以非0状态退出，避免未比较就被当作通过。
+
+用法（在项目根目录执行）：
+    python -m bench.run_bench --users 1000
+    python -m bench.run_bench --users 10000 --latency 0.005
+    python -m bench.run_bench --users 1000 --update-baseline
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from bench.stub_servers import StubServer, FakeV2Board, FakeEmby  # noqa: E402
+
+DEFAULT_BASELINE = ROOT_DIR / 'bench' / 'baseline.json'
+# 参与吞吐量测试的命令处理函数
+HANDLERS = ('start', 'info', 'subscribe', 'emby_info')
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+    def mention_html(self) -> str:
+        return f'<a href="tg://user?id={self.id}">{self.id}</a>'
+
+
+class FakeMessage:
+    text = ''
+
+    async def reply_text(self, *args, **kwargs):
+        pass
+
+    async def reply_html(self, *args, **kwargs):
+        pass
+
+    async def delete(self):
+        pass
+
+
+class FakeUpdate:
+    """只包含处理函数用到的字段的Update替身"""
+
+    def __init__(self, user_id: int):
+        self.effective_user = FakeUser(user_id)
+        self.message = FakeMessage()
+
+
+def generate_users(store, fake_v2board: FakeV2Board, fake_emby: FakeEmby, count: int,
+                   drift_ratio: float):
+    """生成 count 个已绑定Emby账号的用户，drift_ratio 比例的Emby账号权限与期望不一致"""
+    from emby_api import DEFAULT_USER_POLICY, DESIRED_POLICY_HASH
+    from user_store import USER_COLUMNS, data_to_row
+
+    drifted_policy = dict(DEFAULT_USER_POLICY, SimultaneousStreamLimit=1)
+    rows = []
+    for telegram_id in range(1, count + 1):
+        email = f"user{telegram_id}@bench.local"
+        emby_user_id = f"emby{telegram_id}"
+        drifted = random.random() < drift_ratio
+        fake_v2board.emails.append(email)
+        fake_emby.add_user(emby_user_id, email, drifted_policy if drifted else None)
+        rows.append(data_to_row(telegram_id, {
+            'email': email,
+            'password': 'password',
+            'auth_data': f"token:{email}",
+            'emby': {
+                'user_id': emby_user_id,
+                'username': email,
+                'password': 'password',
+                'policy_hash': DESIRED_POLICY_HASH
+            }
+        }))
+    with store.conn:
+        store.conn.executemany(
+            f"INSERT OR REPLACE INTO users ({', '.join(USER_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(USER_COLUMNS))})", rows)
+
+
+async def reset_caches(main):
+    """清空会话、V2Board缓存和保存的登录态验证时间，使每一项测试都从冷缓存开始"""
+    import v2board_api
+    # 先写入上一项测试积压的修改，再清除其中记录的验证时间
+    await main.write_behind.flush()
+    with main.store.conn:
+        main.store.conn.execute("UPDATE users SET auth_validated_at = NULL")
+    main.user_data = type(main.user_data)(main.user_data.ttl, main.user_data.maxsize)
+    v2board_api.user_info_cache.clear()
+    v2board_api.subscribe_cache.clear()
+
+
+async def bench_handler(handler, user_count: int, commands: int, concurrency: int) -> float:
+    """并发调用处理函数 commands 次，返回命令/秒"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(user_id: int):
+        async with semaphore:
+            await handler(FakeUpdate(user_id), None)
+
+    user_ids = [random.randint(1, user_count) for _ in range(commands)]
+    start_time = time.perf_counter()
+    await asyncio.gather(*(call(user_id) for user_id in user_ids))
+    return commands / (time.perf_counter() - start_time)
+
+
+async def run(args) -> dict:
+    fake_v2board = FakeV2Board(denied_ratio=args.denied_ratio)
+    fake_emby = FakeEmby()
+    v2board_server = StubServer(fake_v2board, args.latency, args.error_rate)
+    emby_server = StubServer(fake_emby, args.latency, args.error_rate)
+    await v2board_server.start()
+    await emby_server.start()
+
+    workdir = tempfile.mkdtemp(prefix='bot-bench-')
+    os.chdir(workdir)
+    os.environ.update({
+        'V2BOARD_URL': f"{v2board_server.url}/api/v1",
+        'EMBY_URL': emby_server.url,
+        'EMBY_API_KEY': 'bench',
+        'ALLOWED_PLAN_IDS': str(fake_v2board.allowed_plan_id),
+        'USER_DB_PATH': os.path.join(workdir, 'users.db'),
+        'METRICS_PORT': '0'
+    })
+    if args.admin_mode:
+        os.environ.update({
+            'V2BOARD_ADMIN_PATH': fake_v2board.admin_path,
+            'V2BOARD_ADMIN_TOKEN': fake_v2board.admin_token
+        })
+
+    # 环境变量就绪后再导入机器人模块
+    import main
+    import scheduler
+    from v2board_api import close_async_client
+    from emby_api import close_async_client as close_emby_client
+    logging.getLogger().setLevel(logging.WARNING)
+
+    started = time.perf_counter()
+    generate_users(main.store, fake_v2board, fake_emby, args.users, args.drift_ratio)
+    print(f"生成 {args.users} 个用户，耗时 {time.perf_counter() - started:.2f}s，工作目录 {workdir}")
+
+    results = {'handlers': {}}
+    for name in HANDLERS:
+        await reset_caches(main)
+        results['handlers'][name] = round(await bench_handler(
+            getattr(main, name), args.users, args.commands, args.concurrency), 1)
+        print(f"  {name:<12} {results['handlers'][name]:>10.1f} 命令/秒")
+
+    await reset_caches(main)
+    started = time.perf_counter()
+    await main.update_all_emby_permissions()
+    results['permissions_seconds'] = round(time.perf_counter() - started, 3)
+    print(f"  update_all_emby_permissions          {results['permissions_seconds']:.2f}s")
+
+    await reset_caches(main)
+    started = time.perf_counter()
+    await scheduler.check_and_clean_invalid_emby_accounts()
+    results['sweep_seconds'] = round(time.perf_counter() - started, 3)
+    print(f"  check_and_clean_invalid_emby_accounts {results['sweep_seconds']:.2f}s")
+
+    print(f"请求数: V2Board {v2board_server.requests}, Emby {emby_server.requests}")
+    await close_async_client()
+    await close_emby_client()
+    await v2board_server.stop()
+    await emby_server.stop()
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """与基线比较，返回退化的指标说明"""
+    regressions = []
+    for name, value in results['handlers'].items():
+        expected = baseline.get('handlers', {}).get(name)
+        if expected and value < expected * (1 - tolerance):
+            regressions.append(f"{name}: {value:.1f} 命令/秒，基线 {expected:.1f}")
+    for key in ('permissions_seconds', 'sweep_seconds'):
+        expected = baseline.get(key)
+        if expected and results[key] > expected * (1 + tolerance):
+            regressions.append(f"{key}: {results[key]:.2f}s，基线 {expected:.2f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='v2board-emby-bot 性能基准测试')
+    parser.add_argument('--users', type=int, default=1000, help='生成的用户数，如 1000/10000/100000')
+    parser.add_argument('--latency', type=float, default=0.002, help='模拟服务每个请求的延迟（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='模拟服务随机返回500的比例')
+    parser.add_argument('--denied-ratio', type=float, default=0.05, help='订阅不满足要求的用户比例')
+    parser.add_argument('--drift-ratio', type=float, default=0.1, help='Emby权限与期望不一致的用户比例')
+    parser.add_argument('--commands', type=int, default=2000, help='每个处理函数调用的次数')
+    parser.add_argument('--concurrency', type=int, default=100, help='同时处理的命令数')
+    parser.add_argument('--baseline', type=Path, default=DEFAULT_BASELINE, help='基线文件')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='允许的退化比例')
+    parser.add_argument('--update-baseline', action='store_true', help='用本次结果更新基线')
+    parser.add_argument('--admin-mode', action='store_true', help='订阅检查使用管理员用户列表')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    baseline_path = args.baseline.resolve()
+    results = asyncio.run(run(args))
+
+    baselines = json.loads(baseline_path.read_text(encoding='utf-8')) if baseline_path.exists() else {}
+    key = str(args.users)
+    if args.update_baseline:
+        baselines[key] = results
+        baseline_path.write_text(
+            json.dumps(baselines, ensure_ascii=False, indent=2) + '\n', encoding='utf-8')
+        print(f"已更新基线 {baseline_path} [{key}]")
+        return
+
+    if key not in baselines:
+        print(f"基线文件中没有 {key} 个用户的结果，使用 --update-baseline 生成")
+        sys.exit(2)
+    regressions = compare(results, baselines[key], args.tolerance)
+    if regressions:
+        print("性能退化：")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+    print("未发现性能退化")
+
+
+if __name__ == '__main__':
+    main()
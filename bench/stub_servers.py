@@ -0,0 +1,207 @@
+import json
+import uuid
+import zlib
+import random
+import asyncio
+from urllib.parse import urlsplit, parse_qs
+
+from emby_api import DEFAULT_USER_POLICY
+
+REASONS = {200: 'OK', 204: 'No Content', 400: 'Bad Request', 403: 'Forbidden',
+           404: 'Not Found', 500: 'Internal Server Error'}
+
+
+class StubServer:
+    """进程内的最小HTTP/1.1服务（支持keep-alive），用于模拟V2Board和Emby
+
+    Args:
+        handler: handler(method, path, query, headers, body) -> (status, payload)
+        latency: 每个请求的固定延迟（秒）
+        error_rate: 随机返回500的比例
+    """
+
+    def __init__(self, handler, latency: float = 0.0, error_rate: float = 0.0):
+        self.handler = handler
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.server = None
+        self.port = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                self.requests += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if self.error_rate and random.random() < self.error_rate:
+                    status, payload = 500, {'message': 'stub error'}
+                else:
+                    url = urlsplit(target)
+                    query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                    status, payload = self.handler(method, url.path, query, headers, body)
+
+                data = b'' if payload is None else json.dumps(payload).encode('utf-8')
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode('latin-1') + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+class FakeV2Board:
+    """模拟V2Board用户接口：/passport/auth/login、/user/info、/user/getSubscribe，
+    以及管理后台的 /<admin_path>/user/fetch
+
+    auth_data 为 "token:<email>"，管理员为 admin_token，plan_id 由邮箱决定，
+    denied_ratio 比例的用户订阅不满足要求。
+    """
+
+    def __init__(self, allowed_plan_id: int = 1, denied_plan_id: int = 99, denied_ratio: float = 0.0,
+                 admin_path: str = 'admin', admin_token: str = 'admin-token'):
+        self.allowed_plan_id = allowed_plan_id
+        self.denied_plan_id = denied_plan_id
+        self.denied_ratio = denied_ratio
+        self.admin_path = admin_path
+        self.admin_token = admin_token
+        # 管理后台用户列表中的邮箱
+        self.emails = []
+        # 单独指定的用户字段（模拟面板上的套餐变更、封禁、到期），邮箱 -> {"plan_id", "banned", "expired_at"}
+        self.overrides = {}
+
+    def plan_id(self, email: str) -> int:
+        if 'plan_id' in self.overrides.get(email, {}):
+            return self.overrides[email]['plan_id']
+        if self.denied_ratio and (zlib.crc32(email.encode('utf-8')) % 1000) / 1000 < self.denied_ratio:
+            return self.denied_plan_id
+        return self.allowed_plan_id
+
+    def banned(self, email: str) -> bool:
+        return bool(self.overrides.get(email, {}).get('banned'))
+
+    def expired_at(self, email: str) -> int | None:
+        return self.overrides.get(email, {}).get('expired_at')
+
+    def __call__(self, method, path, query, headers, body):
+        if path.endswith('/passport/auth/login') and method == 'POST':
+            data = json.loads(body or b'{}')
+            return 200, {'data': {'auth_data': f"token:{data.get('email')}"}}
+
+        auth = headers.get('authorization', '')
+        if path.endswith(f"/{self.admin_path}/user/fetch"):
+            if auth != self.admin_token:
+                return 403, {'message': '鉴权失败'}
+            current = int(query.get('current', 1))
+            page_size = int(query.get('pageSize', 10))
+            emails = self.emails[(current - 1) * page_size:current * page_size]
+            return 200, {'data': [{'email': email, 'plan_id': self.plan_id(email), 'expired_at': self.expired_at(email),
+                                   'banned': self.banned(email)} for email in emails],
+                         'total': len(self.emails)}
+        if not auth.startswith('token:'):
+            return 403, {'message': '未登录或登陆已过期'}
+        email = auth[len('token:'):]
+        if path.endswith('/user/info'):
+            return 200, {'data': {
+                'email': email,
+                'plan_id': self.plan_id(email),
+                'banned': self.banned(email),
+                'balance': 0,
+                'transfer_enable': 100 * 1024 ** 3,
+                'expired_at': self.expired_at(email)
+            }}
+        if path.endswith('/user/getSubscribe'):
+            return 200, {'data': {
+                'subscribe_url': f"https://example.com/s/{email}",
+                'u': 0,
+                'd': 0,
+                'transfer_enable': 100 * 1024 ** 3
+            }}
+        return 404, {'message': 'not found'}
+
+
+class FakeEmby:
+    """模拟Emby用户接口：/emby/Users/New、/emby/Users/Query、/emby/Users/{id}[/Password|/Policy|/Configuration]"""
+
+    def __init__(self):
+        # emby_user_id -> 用户
+        self.users = {}
+
+    def add_user(self, user_id: str, name: str, policy: dict | None = None):
+        self.users[user_id] = {'Id': user_id, 'Name': name,
+                               'Policy': dict(policy or DEFAULT_USER_POLICY), 'Configuration': {}}
+
+    def __call__(self, method, path, query, headers, body):
+        parts = path.strip('/').split('/')
+        if parts[:2] != ['emby', 'Users']:
+            return 404, None
+        parts = parts[2:]
+        if parts == ['New'] and method == 'POST':
+            user_id = uuid.uuid4().hex
+            data = json.loads(body)
+            template = self.users.get(data.get('CopyFromUserId'))
+            self.add_user(user_id, data['Name'], template and template['Policy'])
+            if template:
+                self.users[user_id]['Configuration'] = dict(template['Configuration'])
+            return 200, {'Id': user_id}
+        if parts == ['Query'] and method == 'GET':
+            start_index = int(query.get('StartIndex', 0))
+            limit = int(query.get('Limit', 100))
+            items = list(self.users.values())
+            return 200, {'Items': items[start_index:start_index + limit],
+                         'TotalRecordCount': len(items)}
+        if not parts or parts[0] not in self.users:
+            if len(parts) == 2 and parts[1] == 'Policy':
+                return 500, {'message': 'Object reference not set to an instance of an object.'}
+            return 404, None
+        user = self.users[parts[0]]
+        if len(parts) == 1 and method == 'DELETE':
+            del self.users[parts[0]]
+            return 204, None
+        if len(parts) == 1 and method == 'GET':
+            return 200, user
+        if len(parts) == 1 and method == 'POST':
+            # 与Emby一致：按完整的UserDto更新用户，缺少字段的请求被拒绝
+            data = json.loads(body)
+            if not {'Id', 'Name', 'Policy', 'Configuration'} <= data.keys():
+                return 400, None
+            user['Name'] = data['Name']
+            user['Configuration'] = data['Configuration']
+            return 204, None
+        if parts[1:] == ['Password'] and method == 'POST':
+            return 204, None
+        if parts[1:] == ['Policy'] and method == 'POST':
+            user['Policy'] = json.loads(body)
+            return 204, None
+        if parts[1:] == ['Configuration'] and method == 'POST':
+            user['Configuration'] = json.loads(body)
+            return 204, None
+        return 404, None
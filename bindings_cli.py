@@ -0,0 +1,191 @@
+"""用户绑定数据的批量导出/导入
+
+导出时用游标逐行读取数据库，导入时逐行读取文件、按批写入，内存占用与用户数无关。
+每批在一个事务中写入，并在同一事务中记录导入进度；导入中断后用相同的命令重新执行，
+会从最后一个成功提交的批次之后继续。
+
+用法（在项目根目录执行，建议先停止机器人）：
+    python bindings_cli.py export bindings.jsonl
+    python bindings_cli.py export bindings.csv
+    python bindings_cli.py export - > bindings.jsonl
+    python bindings_cli.py import bindings.jsonl --batch-size 1000
+    python bindings_cli.py import bindings.csv --restart
+"""
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+from pathlib import Path
+from user_store import UserStore, USER_DB_PATH, USER_COLUMNS, BACKGROUND_BUSY_TIMEOUT
+
+# 导入时每个事务写入的行数
+DEFAULT_BATCH_SIZE = 1000
+# 输出进度的最小间隔（秒）
+REPORT_INTERVAL = 2.0
+
+
+def detect_format(path: str, fmt: str | None) -> str:
+    """未指定格式时按扩展名判断，.csv 为 csv，其余为 jsonl"""
+    if fmt:
+        return fmt
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+def normalize_row(record: dict) -> tuple:
+    """将导入文件中的一条记录转换为 USER_COLUMNS 顺序的数据库行，CSV中的空字符串视为空值"""
+    values = {column: (None if record.get(column) == '' else record.get(column)) for column in USER_COLUMNS}
+    if values['telegram_id'] is None:
+        raise ValueError("缺少 telegram_id")
+    values['telegram_id'] = int(values['telegram_id'])
+    if values['auth_validated_at'] is not None:
+        values['auth_validated_at'] = float(values['auth_validated_at'])
+    return tuple(values[column] for column in USER_COLUMNS)
+
+
+class Progress:
+    """按固定间隔向标准错误输出处理进度和吞吐量"""
+
+    def __init__(self, action: str):
+        self.action = action
+        self.count = 0
+        self.start_time = time.monotonic()
+        self.reported_at = self.start_time
+
+    def advance(self, count: int = 1):
+        self.count += count
+        now = time.monotonic()
+        if now - self.reported_at >= REPORT_INTERVAL:
+            self.reported_at = now
+            self.report()
+
+    def report(self, final: bool = False):
+        elapsed = time.monotonic() - self.start_time
+        rate = self.count / elapsed if elapsed > 0 else 0
+        prefix = "完成，" if final else ""
+        print(f"{prefix}已{self.action} {self.count} 条，耗时 {elapsed:.1f}s，{rate:.0f} 条/秒", file=sys.stderr)
+
+
+def export_bindings(store: UserStore, path: str, fmt: str) -> int:
+    """将所有用户数据逐行写入文件（path 为 - 时写入标准输出），返回导出的行数"""
+    progress = Progress('导出')
+    out = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='')
+    try:
+        if fmt == 'csv':
+            writer = csv.DictWriter(out, fieldnames=USER_COLUMNS)
+            writer.writeheader()
+            for row in store.iter_user_rows():
+                writer.writerow(row)
+                progress.advance()
+        else:
+            for row in store.iter_user_rows():
+                out.write(json.dumps(row, ensure_ascii=False) + '\n')
+                progress.advance()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    progress.report(final=True)
+    return progress.count
+
+
+def iter_records(f, fmt: str):
+    """逐条读取导入文件，返回 (行号, 记录)，JSON解析失败的行记录为None"""
+    if fmt == 'csv':
+        for line_no, record in enumerate(csv.DictReader(f), start=2):
+            yield line_no, record
+        return
+    for line_no, line in enumerate(f, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except ValueError:
+            yield line_no, None
+
+
+def import_bindings(store: UserStore, path: str, fmt: str, batch_size: int = DEFAULT_BATCH_SIZE,
+                    restart: bool = False) -> dict:
+    """分批导入用户数据（插入或覆盖），返回 {"imported", "skipped", "errors"}
+
+    已提交的记录数与文件大小一起记录在 meta 中，文件未变化时重新执行会跳过已提交的记录。
+    因为写入是插入或覆盖，即使重复导入同一批记录也不会产生重复数据。
+    """
+    progress_key = f"bindings_import:{Path(path).resolve()}"
+    file_size = os.path.getsize(path)
+    committed = 0
+    saved = store.get_meta(progress_key)
+    if saved and not restart:
+        saved = json.loads(saved)
+        if saved['size'] == file_size:
+            committed = saved['records']
+            print(f"从上次中断处继续，跳过已导入的 {committed} 条记录", file=sys.stderr)
+        else:
+            print("文件已变化，从头开始导入", file=sys.stderr)
+
+    stats = {'imported': 0, 'skipped': committed, 'errors': 0}
+    progress = Progress('导入')
+    batch = []
+    # 已读取的记录数（包括无法解析的行），与 committed 比较以跳过已提交的记录
+    records = 0
+
+    def flush():
+        store.save_user_rows(batch, {progress_key: json.dumps({'records': records, 'size': file_size})})
+        stats['imported'] += len(batch)
+        progress.advance(len(batch))
+        batch.clear()
+
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for line_no, record in iter_records(f, fmt):
+            records += 1
+            if records <= committed:
+                continue
+            try:
+                if not isinstance(record, dict):
+                    raise ValueError("无法解析")
+                batch.append(normalize_row(record))
+            except (TypeError, ValueError) as e:
+                stats['errors'] += 1
+                print(f"第 {line_no} 行无效，已跳过: {str(e)}", file=sys.stderr)
+                continue
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+
+    store.delete_meta(progress_key)
+    progress.report(final=True)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="用户绑定数据的批量导出/导入")
+    parser.add_argument('--db', default=str(USER_DB_PATH), help="数据库路径，默认为 USER_DB_PATH")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help="导出所有用户数据")
+    export_parser.add_argument('path', help="输出文件，- 表示标准输出")
+    export_parser.add_argument('--format', choices=('jsonl', 'csv'), help="默认按扩展名判断")
+
+    import_parser = subparsers.add_parser('import', help="导入用户数据（插入或覆盖）")
+    import_parser.add_argument('path', help="导入文件")
+    import_parser.add_argument('--format', choices=('jsonl', 'csv'), help="默认按扩展名判断")
+    import_parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help="每个事务写入的行数")
+    import_parser.add_argument('--restart', action='store_true', help="忽略上次中断的进度，从头导入")
+
+    args = parser.parse_args()
+    store = UserStore(Path(args.db), busy_timeout=BACKGROUND_BUSY_TIMEOUT)
+    try:
+        fmt = detect_format(args.path, args.format)
+        if args.command == 'export':
+            export_bindings(store, args.path, fmt)
+        else:
+            stats = import_bindings(store, args.path, fmt, args.batch_size, args.restart)
+            print(f"已导入 {stats['imported']} 条，跳过已导入 {stats['skipped']} 条，无效 {stats['errors']} 条，"
+                  f"数据库共 {store.count()} 个用户", file=sys.stderr)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import time
+import asyncio
+from collections import OrderedDict
+from deadline import run_within_deadline
+
+
+class LoadCancelled(Exception):
+    """合并等待的加载被取消（发起加载的调用者超时或被取消）"""
+
+    def __init__(self):
+        super().__init__("加载被取消")
+
+
+class AsyncTTLCache:
+    """带TTL过期和LRU淘汰的异步缓存
+
+    相同key的并发加载会合并为一次上游调用（single-flight），其余调用者等待同一个结果，
+    等待时同样受当前处理时限约束。只有非None的结果会被缓存。
+    """
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # key -> (过期时间, 值)，按最近使用顺序排列
+        self._data = OrderedDict()
+        # key -> 正在进行的加载
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """获取未过期的缓存值，不存在时返回None"""
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """删除指定key的缓存"""
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    async def get_or_load(self, key, loader):
+        """命中缓存直接返回，否则调用 loader() 加载；同一key同时只会有一个加载在进行"""
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await run_within_deadline(self._wait(future))
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+        except BaseException as e:
+            # 取消只针对发起加载的调用者，其他等待者收到普通异常
+            future.set_exception(LoadCancelled() if isinstance(e, asyncio.CancelledError) else e)
+            # 标记异常已被读取，避免没有等待者时产生警告
+            future.exception()
+            raise
+        else:
+            if value is not None:
+                self.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    @staticmethod
+    async def _wait(future):
+        """等待正在进行的加载，超时或被取消时不影响加载本身"""
+        return await asyncio.shield(future)
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced
+        }
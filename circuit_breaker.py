@@ -0,0 +1,240 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import httpx
+from dotenv import load_dotenv
+from metrics import CIRCUIT_OPEN, UPSTREAM_RETRIES
+from deadline import remaining, run_within_deadline
+
+logger = logging.getLogger(__name__)
+
+# 加载环境变量
+load_dotenv()
+
+# 连续失败多少次后熔断
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+# 熔断后多少秒放行一个探测请求
+CIRCUIT_RECOVERY_TIMEOUT = float(os.getenv('CIRCUIT_RECOVERY_TIMEOUT', '30'))
+# 单个请求最多尝试的次数（包含第一次）
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '3'))
+# 重试退避的基础延迟和最大延迟（秒），实际延迟为 [0, min(最大延迟, 基础延迟*2^n)] 内的随机值
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '5'))
+# 重试预算：每个请求积累的重试额度，以及与请求量无关的每秒保底重试数
+RETRY_BUDGET_RATIO = float(os.getenv('RETRY_BUDGET_RATIO', '0.2'))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv('RETRY_BUDGET_MIN_PER_SECOND', '1'))
+
+# 视为上游故障、可以重试的状态码
+RETRY_STATUS = {502, 503, 504}
+# 请求尚未发出的连接错误，非幂等请求也可以安全重试
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class CircuitOpenError(Exception):
+    """上游处于熔断状态，请求被直接拒绝"""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name} 已熔断，{retry_in:.0f} 秒后重试")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """单个上游的熔断器
+
+    closed: 正常放行，连续失败达到阈值后进入 open
+    open: 直接拒绝所有请求，recovery_timeout 秒后进入 half_open
+    half_open: 只放行一个探测请求，成功则恢复 closed，失败则重新 open
+    """
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 recovery_timeout: float = CIRCUIT_RECOVERY_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        # 探测请求的开始时间，探测请求被取消时超过 recovery_timeout 后允许新的探测
+        self._probe_started = None
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def is_open(self) -> bool:
+        """上游是否不可用：熔断后尚未到探测时间，或探测请求正在进行
+
+        熔断超过 recovery_timeout 后返回False，后台任务可以直接发送请求作为探测，
+        不必等待用户命令触发探测才能恢复。
+        """
+        if self.state == 'closed':
+            return False
+        if self.state == 'open':
+            return self.retry_in() > 0
+        return self.probing
+
+    @property
+    def probing(self) -> bool:
+        """是否有探测请求正在进行"""
+        return (self.state == 'half_open' and self._probe_started is not None
+                and time.monotonic() - self._probe_started < self.recovery_timeout)
+
+    def retry_in(self) -> float:
+        """距离允许下一次探测的秒数"""
+        if self.state != 'open':
+            return 0.0
+        return max(0.0, self.opened_at + self.recovery_timeout - time.monotonic())
+
+    def allow_request(self) -> bool:
+        now = time.monotonic()
+        if self.state == 'closed':
+            return True
+        if self.state == 'open':
+            if now - self.opened_at < self.recovery_timeout:
+                self.rejected += 1
+                return False
+            self.state = 'half_open'
+            self._probe_started = None
+        if self._probe_started is not None and now - self._probe_started < self.recovery_timeout:
+            self.rejected += 1
+            return False
+        self._probe_started = now
+        return True
+
+    def record_success(self):
+        if self.state != 'closed':
+            logger.info(f"{self.name} 已恢复，关闭熔断")
+        self.state = 'closed'
+        self.failures = 0
+        self._probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+            if self.state == 'closed':
+                self.trips += 1
+                logger.warning(
+                    f"{self.name} 连续失败 {self.failures} 次，熔断 {self.recovery_timeout:.0f} 秒")
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self._probe_started = None
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'retry_in': round(self.retry_in(), 1),
+            'rejected': self.rejected,
+            'trips': self.trips
+        }
+
+
+class RetryBudget:
+    """进程内所有上游共享的重试预算
+
+    每个请求积累 ratio 个重试额度，另外每秒补充 min_per_second 个，额度上限为 capacity。
+    上游大面积故障时重试量被限制在正常请求量的一定比例内，不会成倍放大请求。
+    """
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO,
+                 min_per_second: float = RETRY_BUDGET_MIN_PER_SECOND, capacity: float = 100):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.exhausted = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.min_per_second)
+        self.updated_at = now
+
+    def record_request(self):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def try_acquire(self) -> bool:
+        """取出一个重试额度，预算耗尽时返回False"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.exhausted += 1
+        return False
+
+
+# 各上游的熔断器和共享的重试预算
+_breakers = {}
+retry_budget = RetryBudget()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """获取指定上游（v2board / emby）的熔断器"""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = _breakers[name] = CircuitBreaker(name)
+        CIRCUIT_OPEN.labels(name).set_function(lambda: float(breaker.state != 'closed'))
+    return breaker
+
+
+def breaker_stats() -> dict:
+    return {name: breaker.stats() for name, breaker in _breakers.items()}
+
+
+def backoff_delay(attempt: int) -> float:
+    """第 attempt 次重试前的等待时间（指数退避 + 完全随机抖动）"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+def is_gateway_error(response: httpx.Response) -> bool:
+    """默认的上游故障判断：502/503/504"""
+    return response.status_code in RETRY_STATUS
+
+
+async def call_with_retry(name: str, send, idempotent: bool = True,
+                          is_failure=is_gateway_error) -> httpx.Response:
+    """经过熔断器和重试预算发送请求
+
+    网络错误和 is_failure 判断为故障的响应（默认为 502/503/504）计为上游失败，按指数退避重试；
+    非幂等请求只在请求尚未发出的连接错误时重试。熔断时直接抛出 CircuitOpenError，不等待网络超时。
+    每次尝试和重试等待都不会超过当前的处理时限（见 deadline.py），超时抛出 DeadlineExceeded。
+
+    Args:
+        name: 上游名称
+        send: 无参数的协程函数，每次调用发送一次请求
+        idempotent: 请求是否可以安全地重复发送
+        is_failure: 判断响应是否为上游故障的函数
+    """
+    breaker = get_breaker(name)
+    retry_budget.record_request()
+    attempt = 1
+    while True:
+        if not breaker.allow_request():
+            raise CircuitOpenError(name, breaker.retry_in())
+        error = None
+        try:
+            response = await run_within_deadline(send())
+        except httpx.TransportError as e:
+            breaker.record_failure()
+            error = e
+            retryable = idempotent or isinstance(e, CONNECT_ERRORS)
+        else:
+            if not is_failure(response):
+                breaker.record_success()
+                return response
+            breaker.record_failure()
+            retryable = idempotent
+
+        delay = backoff_delay(attempt)
+        left = remaining()
+        if (not retryable or attempt >= RETRY_MAX_ATTEMPTS or (left is not None and left <= delay)
+                or not retry_budget.try_acquire()):
+            if error is not None:
+                raise error
+            return response
+        UPSTREAM_RETRIES.labels(name).inc()
+        await asyncio.sleep(delay)
+        attempt += 1
@@ -0,0 +1,98 @@
+import os
+import time
+import asyncio
+import functools
+import contextvars
+from contextlib import contextmanager
+import httpx
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+# 每个Telegram命令的总处理时限（秒），其中所有上游请求共享这一时限
+COMMAND_DEADLINE = float(os.getenv('COMMAND_DEADLINE', '15'))
+
+# 当前任务的截止时间（time.monotonic()），None 表示不限时
+_deadline: contextvars.ContextVar = contextvars.ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """当前命令或任务的处理时限已用完"""
+
+    def __init__(self):
+        super().__init__("处理超时")
+
+
+@contextmanager
+def deadline(seconds: float | None):
+    """在 with 块内设置处理时限，嵌套时取更早的截止时间"""
+    if seconds is None:
+        yield
+        return
+    new_deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(new_deadline if current is None else min(current, new_deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> float | None:
+    """距离截止时间的剩余秒数，不限时时返回None"""
+    current = _deadline.get()
+    if current is None:
+        return None
+    return current - time.monotonic()
+
+
+def parse_endpoint_timeouts(value: str | None) -> dict:
+    """解析 "路径=秒数,路径=秒数" 格式的接口读取超时配置"""
+    timeouts = {}
+    for item in (value or '').split(','):
+        if '=' not in item:
+            continue
+        path, seconds = item.split('=', 1)
+        timeouts[path.strip()] = float(seconds)
+    return timeouts
+
+
+def request_timeout(connect: float, read: float) -> httpx.Timeout:
+    """按剩余时限收紧的单次请求超时，时限已用完时抛出 DeadlineExceeded"""
+    left = remaining()
+    if left is not None:
+        if left <= 0:
+            raise DeadlineExceeded()
+        connect = min(connect, left)
+        read = min(read, left)
+    return httpx.Timeout(read, connect=connect)
+
+
+async def run_within_deadline(coro):
+    """等待协程完成，但不超过当前截止时间"""
+    left = remaining()
+    if left is None:
+        return await coro
+    if left <= 0:
+        coro.close()
+        raise DeadlineExceeded()
+    try:
+        return await asyncio.wait_for(coro, left)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded() from None
+
+
+def command_deadline(func):
+    """为命令处理函数设置 COMMAND_DEADLINE 时限，超时时回复用户而不是一直等待上游"""
+
+    @functools.wraps(func)
+    async def wrapper(update, context, *args, **kwargs):
+        try:
+            with deadline(COMMAND_DEADLINE):
+                return await func(update, context, *args, **kwargs)
+        except DeadlineExceeded:
+            if update.message:
+                await update.message.reply_text("服务器响应超时，请稍后重试")
+
+    return wrapper
@@ -1,20 +1,117 @@
 import os
+import time
+import json
+import hashlib
 import random
 import string
-from venv import logger
+import logging
+import httpx
 import requests
 import re
 from dotenv import load_dotenv
+from metrics import observe_upstream
+from circuit_breaker import call_with_retry
+from deadline import parse_endpoint_timeouts, request_timeout
+from settings import Settings, get_settings
+from cache import AsyncTTLCache
 
+logger = logging.getLogger(__name__)
 
-class EmbyAPI:
-    def __init__(self):
-        # 加载.env文件
-        load_dotenv()
+# 共享的异步HTTP客户端（连接池），整个进程复用
+_async_client: httpx.AsyncClient | None = None
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """获取共享的异步HTTP客户端，首次调用时按 EMBY_POOL_SIZE 创建连接池"""
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=EMBY_POOL_SIZE,
+                max_keepalive_connections=EMBY_POOL_SIZE
+            ),
+            timeout=httpx.Timeout(EMBY_READ_TIMEOUT, connect=EMBY_CONNECT_TIMEOUT)
+        )
+    return _async_client
+
+
+async def close_async_client():
+    """关闭共享的异步HTTP客户端"""
+    global _async_client
+    if _async_client is not None and not _async_client.is_closed:
+        await _async_client.aclose()
+    _async_client = None
+
+
+load_dotenv()
+# 连接池大小（最大并发连接数）
+EMBY_POOL_SIZE = int(os.getenv('EMBY_POOL_SIZE', '20'))
+# 请求超时（秒）：连接超时、读取超时，以及按接口（路径模板）单独配置的读取超时
+EMBY_CONNECT_TIMEOUT = float(os.getenv('EMBY_CONNECT_TIMEOUT', '3'))
+EMBY_READ_TIMEOUT = float(os.getenv('EMBY_READ_TIMEOUT', '10'))
+EMBY_ENDPOINT_TIMEOUTS = parse_endpoint_timeouts(
+    os.getenv('EMBY_ENDPOINT_TIMEOUTS', '/Users/Query=30'))
+# 模板用户的权限和配置在内存中缓存的时间（秒）
+EMBY_TEMPLATE_CACHE_TTL = float(os.getenv('EMBY_TEMPLATE_CACHE_TTL', '300'))
+
+# 从模板用户创建账号时复制的内容
+TEMPLATE_COPY_OPTIONS = ["UserPolicy", "UserConfiguration"]
+# 模板用户ID -> 模板用户信息（包含 Policy 和 Configuration）
+template_cache = AsyncTTLCache(EMBY_TEMPLATE_CACHE_TTL, 100)
+
+# Emby用户的默认权限
+DEFAULT_USER_POLICY = {
+    "IsAdministrator": False,                   # 是否为管理员
+    "IsHidden": True,                           # 用户是否隐藏
+    "IsHiddenRemotely": True,                   # 是否在远程访问时隐藏
+    "IsHiddenFromUnusedDevices": True,          # 是否在未使用的设备上隐藏
+    "IsDisabled": False,                        # 用户是否被禁用
+    "AllowTagOrRating": False,                  # 是否允许标记或评级
+    "IsTagBlockingModeInclusive": False,        # 是否以标签阻止模式进行阻止
+    "EnableUserPreferenceAccess": True,         # 是否允许用户访问首选项
+    "EnableRemoteControlOfOtherUsers": False,   # 是否允许远程控制其他用户
+    "EnableSharedDeviceControl": True,          # 是否允许共享设备的控制
+    "EnableRemoteAccess": True,                 # 是否允许远程访问
+    "EnableLiveTvManagement": False,            # 是否允许管理 Live TV
+    "EnableLiveTvAccess": False,                # 是否允许访问 Live TV
+    "EnableMediaPlayback": True,                # 是否允许媒体播放
+    "EnableAudioPlaybackTranscoding": False,    # 表示是否允许音频转码
+    "EnableVideoPlaybackTranscoding": False,    # 表示是否允许视频转码
+    "EnablePlaybackRemuxing": False,            # 是否允许媒体复用
+    "EnableContentDeletion": False,             # 是否允许删除内容
+    "EnableContentDownloading": False,          # 是否允许下载内容
+    "EnableSubtitleDownloading": False,         # 是否允许下载字幕
+    "EnableSubtitleManagement": False,          # 是否允许管理字幕
+    "EnableSyncTranscoding": False,             # 是否允许同步转码
+    "EnableMediaConversion": False,             # 是否允许媒体转换
+    "EnablePublicSharing": False,               # 是否允许公开共享
+    "EnableAllDevices": True,                   # 是否允许访问所有设备
+    "EnableAllChannels": True,                  # 是否允许访问所有频道
+    "EnableAllFolders": True,                   # 是否允许访问所有文件夹
+    "DisablePremiumFeatures": False,            # 是否禁用高级功能
+    "AllowCameraUpload": False,                 # 是否允许相机上传
+    "SimultaneousStreamLimit": 2                # 同时流式传输的限制
+}
 
+
+def policy_hash(policy: dict, keys=None) -> str:
+    """计算权限的规范化哈希，只包含 keys（默认为 DEFAULT_USER_POLICY 的字段）"""
+    keys = sorted(keys if keys is not None else DEFAULT_USER_POLICY)
+    canonical = json.dumps({key: policy.get(key) for key in keys},
+                           sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+# 期望权限的哈希
+DESIRED_POLICY_HASH = policy_hash(DEFAULT_USER_POLICY)
+
+
+class EmbyAPI:
+    def __init__(self, settings: Settings | None = None):
         # 获取配置
-        self.base_url = os.getenv('EMBY_URL').rstrip('/')
-        self.api_key = os.getenv('EMBY_API_KEY')
+        settings = settings or get_settings()
+        self.base_url = settings.emby_url
+        self.api_key = settings.emby_api_key
 
         # 设置请求头
         self.headers = {
@@ -27,6 +124,9 @@ class EmbyAPI:
             'api_key': self.api_key
         }
 
+        # 请求超时（连接超时, 读取超时）
+        self.timeout = (EMBY_CONNECT_TIMEOUT, EMBY_READ_TIMEOUT)
+
     def generate_random_username(self, length=None):
         """生成5-8位随机用户名"""
         if length is None:
@@ -73,7 +173,8 @@ class EmbyAPI:
                 create_url,
                 headers=self.headers,
                 params=self.params,
-                json=create_data
+                json=create_data,
+                timeout=self.timeout
             )
 
             if response.status_code == 200:
@@ -89,7 +190,7 @@ class EmbyAPI:
                     "ResetPassword": False
                 }
                 requests.post(pwd_url, headers=self.headers,
-                              params=self.params, json=pwd_data)
+                              params=self.params, json=pwd_data, timeout=self.timeout)
                 
                 # 设置用户权限
                 self.set_user_policy(user_id)
@@ -113,40 +214,9 @@ class EmbyAPI:
     def set_user_policy(self, user_id: str) -> dict:
         """设置用户权限"""
         policy_url = f"{self.base_url}/emby/Users/{user_id}/Policy"
-        policy_data = {
-            "IsAdministrator": False,                   # 是否为管理员
-            "IsHidden": True,                           # 用户是否隐藏
-            "IsHiddenRemotely": True,                   # 是否在远程访问时隐藏
-            "IsHiddenFromUnusedDevices": True,          # 是否在未使用的设备上隐藏
-            "IsDisabled": False,                        # 用户是否被禁用
-            "AllowTagOrRating": False,                  # 是否允许标记或评级
-            "IsTagBlockingModeInclusive": False,        # 是否以标签阻止模式进行阻止
-            "EnableUserPreferenceAccess": True,         # 是否允许用户访问首选项
-            "EnableRemoteControlOfOtherUsers": False,   # 是否允许远程控制其他用户
-            "EnableSharedDeviceControl": True,          # 是否允许共享设备的控制
-            "EnableRemoteAccess": True,                 # 是否允许远程访问
-            "EnableLiveTvManagement": False,            # 是否允许管理 Live TV
-            "EnableLiveTvAccess": False,                # 是否允许访问 Live TV
-            "EnableMediaPlayback": True,                # 是否允许媒体播放
-            "EnableAudioPlaybackTranscoding": False,    # 表示是否允许音频转码
-            "EnableVideoPlaybackTranscoding": False,    # 表示是否允许视频转码
-            "EnablePlaybackRemuxing": False,            # 是否允许媒体复用
-            "EnableContentDeletion": False,             # 是否允许删除内容
-            "EnableContentDownloading": False,          # 是否允许下载内容
-            "EnableSubtitleDownloading": False,         # 是否允许下载字幕
-            "EnableSubtitleManagement": False,          # 是否允许管理字幕
-            "EnableSyncTranscoding": False,             # 是否允许同步转码
-            "EnableMediaConversion": False,             # 是否允许媒体转换
-            "EnablePublicSharing": False,               # 是否允许公开共享
-            "EnableAllDevices": True,                   # 是否允许访问所有设备
-            "EnableAllChannels": True,                  # 是否允许访问所有频道
-            "EnableAllFolders": True,                   # 是否允许访问所有文件夹
-            "DisablePremiumFeatures": False,            # 是否禁用高级功能
-            "AllowCameraUpload": False,                 # 是否允许相机上传
-            "IsTagBlockingModeInclusive": False,        # 是否以标签阻止模式进行阻止
-            "SimultaneousStreamLimit": 2                # 同时流式传输的限制
-        }
-        response = requests.post(policy_url, headers=self.headers, params=self.params, json=policy_data)
+        policy_data = dict(DEFAULT_USER_POLICY)
+        response = requests.post(policy_url, headers=self.headers, params=self.params, json=policy_data,
+                                 timeout=self.timeout)
         if response.status_code == 204:
             return {
                 "success": True
@@ -177,7 +247,250 @@ class EmbyAPI:
         try:
             url = f"{self.base_url}/emby/Users/{user_id}"
             response = requests.delete(
-                url, params=self.params, headers=self.headers)
+                url, params=self.params, headers=self.headers, timeout=self.timeout)
+            if response.status_code == 204:
+                logger.info(f"成功删除Emby用户: {user_id}")
+                return {
+                    "success": True
+                }
+            elif response.status_code == 404:
+                logger.info(f"用户不存在或已删除: {user_id}")
+                return {
+                    "success": True
+                }
+            else:
+                error_msg = f"删除用户失败，状态码: {response.status_code}"
+                if response.text:
+                    error_msg += f"，错误信息: {response.text}"
+                logger.error(error_msg)
+                return {
+                    "success": False,
+                    "error": error_msg
+                }
+        except Exception as e:
+            error_msg = f"删除用户时发生错误: {str(e)}"
+            logger.error(error_msg)
+            return {
+                "success": False,
+                "error": error_msg
+            }
+
+
+class AsyncEmbyAPI(EmbyAPI):
+    """EmbyAPI 的异步版本，所有实例共享同一个长连接池
+
+    创建用户时的 创建 -> 设置密码 -> 设置权限 三个请求依次复用连接池中的热连接，
+    不再为每个请求重新建立TCP/TLS连接。
+    """
+
+    async def _request(self, method: str, path: str, endpoint: str | None = None,
+                       params: dict | None = None, idempotent: bool = True,
+                       **kwargs) -> httpx.Response:
+        """通过共享连接池请求Emby接口，经过熔断器和重试，并记录每次尝试的耗时指标
+
+        Args:
+            path: /emby 之后的请求路径
+            endpoint: 指标中使用的路径模板（不含用户ID），默认为 path
+            idempotent: 请求能否安全重发，为False时只在连接失败时重试
+        """
+        async def send():
+            start_time = time.perf_counter()
+            status = 'error'
+            try:
+                response = await get_async_client().request(
+                    method, f"{self.base_url}/emby{path}", headers=self.headers,
+                    params=params or self.params,
+                    timeout=request_timeout(
+                        EMBY_CONNECT_TIMEOUT,
+                        EMBY_ENDPOINT_TIMEOUTS.get(endpoint or path, EMBY_READ_TIMEOUT)),
+                    **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                observe_upstream('emby', endpoint or path, status, time.perf_counter() - start_time)
+
+        return await call_with_retry('emby', send, idempotent)
+
+    async def create_user(self, username: str, password=None, disabled: bool = False,
+                          template_id: str | None = None):
+        """创建Emby用户
+
+        Args:
+            disabled: 是否创建为禁用状态（用于预创建账号池）
+            template_id: 模板用户ID，指定时创建请求直接复制模板的权限和配置，不再单独设置权限；
+                同时指定 disabled 时在复制的模板权限上只修改 IsDisabled
+        """
+        if password is None:
+            password = self.generate_random_password()
+
+        # 创建用户
+        create_data = { "Name": username, "HasPassword": True }
+        if template_id:
+            create_data.update(CopyFromUserId=template_id, UserCopyOptions=TEMPLATE_COPY_OPTIONS)
+
+        try:
+            # 重复创建会产生同名账号，只在连接失败时重试
+            response = await self._request('POST', "/Users/New", idempotent=False, json=create_data)
+
+            if response.status_code == 200:
+                # 从响应中提取用户ID
+                user_id = response.json()['Id']
+
+                # 设置用户密码
+                pwd_data = {
+                    "Id": user_id,
+                    "CurrentPw": "",
+                    "NewPw": password,
+                    "ResetPassword": False
+                }
+                await self._request('POST', f"/Users/{user_id}/Password",
+                                    "/Users/{id}/Password", json=pwd_data)
+
+                # 设置用户权限，从模板创建时权限已在Emby后台管理，不记录权限哈希
+                if not template_id:
+                    policy_result = await self.set_user_policy(user_id, disabled)
+                    policy_hash = DESIRED_POLICY_HASH if policy_result["success"] else None
+                else:
+                    policy_hash = None
+                    if disabled:
+                        # 不能用默认权限覆盖复制的模板权限，在模板权限上只修改 IsDisabled
+                        template = await self.get_template(template_id)
+                        if template and template.get('Policy'):
+                            policy_result = await self.set_user_policy(user_id, True, template['Policy'])
+                        else:
+                            policy_result = {"success": False, "error": f"模板用户 {template_id} 不存在"}
+                        if not policy_result["success"]:
+                            # 账号可能未被禁用，删除后返回失败
+                            await self.delete_user(user_id)
+                            return {
+                                "success": False,
+                                "error": f"禁用从模板创建的用户失败: {policy_result['error']}"
+                            }
+                return {
+                    "success": True,
+                    "user_id": user_id,
+                    "username": username,
+                    "password": password,
+                    "policy_hash": policy_hash
+                }
+            else:
+                return {
+                    "success": False,
+                    "error": f"创建用户失败: {response.status_code}"
+                }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": f"创建用户时发生错误: {str(e)}"
+            }
+
+    async def set_user_policy(self, user_id: str, disabled: bool = False, policy: dict | None = None) -> dict:
+        """设置用户权限（默认为 DEFAULT_USER_POLICY），disabled 为True时同时禁用该用户"""
+        policy_data = dict(policy or DEFAULT_USER_POLICY)
+        if disabled:
+            policy_data['IsDisabled'] = True
+        response = await self._request('POST', f"/Users/{user_id}/Policy",
+                                       "/Users/{id}/Policy", json=policy_data)
+        if response.status_code == 204:
+            return {
+                "success": True
+            }
+        elif response.status_code == 500 and "Object reference not set to an instance of an object." in response.text:
+            logger.info(f"用户不存在或已删除: {user_id}")
+            return {
+                "success": False,
+                "error": "用户不存在或已删除"
+            }
+        else:
+            return {
+                "success": False,
+                "error": f"设置用户权限失败: {response.status_code}"
+            }
+
+    async def set_user_configuration(self, user_id: str, configuration: dict) -> dict:
+        """设置用户配置（语言、播放、字幕等偏好）"""
+        response = await self._request('POST', f"/Users/{user_id}/Configuration",
+                                       "/Users/{id}/Configuration", json=configuration)
+        if response.status_code in (200, 204):
+            return {
+                "success": True
+            }
+        return {
+            "success": False,
+            "error": f"设置用户配置失败: {response.status_code}"
+        }
+
+    async def get_user(self, user_id: str) -> dict | None:
+        """获取用户信息（包含 Policy 和 Configuration），用户不存在时返回None"""
+        response = await self._request('GET', f"/Users/{user_id}", "/Users/{id}")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    async def get_template(self, template_id: str) -> dict | None:
+        """获取模板用户信息，结果缓存 EMBY_TEMPLATE_CACHE_TTL 秒"""
+        return await template_cache.get_or_load(template_id, lambda: self.get_user(template_id))
+
+    async def rename_user(self, user_id: str, username: str) -> dict:
+        """修改用户名
+
+        Emby按提交的完整 UserDto 更新用户（包括 Configuration），只提交部分字段会失败或重置其他设置，
+        因此先读取用户信息，只修改 Name 后整体提交。
+        """
+        user = await self.get_user(user_id)
+        if user is None:
+            return {
+                "success": False,
+                "error": "修改用户名失败: 用户不存在"
+            }
+        user["Name"] = username
+        response = await self._request('POST', f"/Users/{user_id}", "/Users/{id}", json=user)
+        if response.status_code in (200, 204):
+            return {
+                "success": True
+            }
+        return {
+            "success": False,
+            "error": f"修改用户名失败: {response.status_code}"
+        }
+
+    async def list_users(self, start_index: int = 0, limit: int = 500) -> dict:
+        """分页获取Emby用户列表（包含每个用户的Policy）
+
+        Returns:
+            dict: Emby返回的 {"Items": [...], "TotalRecordCount": N}
+        """
+        params = dict(self.params, StartIndex=start_index, Limit=limit)
+        response = await self._request('GET', "/Users/Query", params=params)
+        response.raise_for_status()
+        return response.json()
+
+    async def iter_users(self, page_size: int = 500):
+        """逐页遍历所有Emby用户"""
+        start_index = 0
+        while True:
+            page = await self.list_users(start_index, page_size)
+            items = page.get('Items', [])
+            for user in items:
+                yield user
+            start_index += len(items)
+            if not items or start_index >= page.get('TotalRecordCount', 0):
+                return
+
+    async def delete_user(self, user_id: str) -> dict:
+        """删除指定的Emby用户
+
+        Args:
+            user_id: 要删除的用户ID
+
+        Returns:
+            dict: 包含操作结果的字典
+                success: 是否成功
+                error: 如果失败，错误信息
+        """
+        try:
+            response = await self._request('DELETE', f"/Users/{user_id}", "/Users/{id}")
             if response.status_code == 204:
                 logger.info(f"成功删除Emby用户: {user_id}")
                 return {
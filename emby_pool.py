@@ -0,0 +1,232 @@
+import os
+import time
+import asyncio
+import logging
+import contextvars
+from dotenv import load_dotenv
+from emby_api import AsyncEmbyAPI, DESIRED_POLICY_HASH
+from user_store import UserStore, get_user_store
+from circuit_breaker import get_breaker
+from metrics import EMBY_POOL_CLAIMS, EMBY_POOL_AVAILABLE
+
+logger = logging.getLogger(__name__)
+
+# 加载环境变量
+load_dotenv()
+
+# 预创建账号池的目标大小，为0时不启用
+EMBY_WARM_POOL_SIZE = int(os.getenv('EMBY_WARM_POOL_SIZE', '0'))
+# 补充账号池的间隔（秒）和同时创建的账号数
+EMBY_WARM_POOL_REFILL_INTERVAL = float(os.getenv('EMBY_WARM_POOL_REFILL_INTERVAL', '60'))
+EMBY_WARM_POOL_REFILL_CONCURRENCY = int(os.getenv('EMBY_WARM_POOL_REFILL_CONCURRENCY', '2'))
+# 预创建账号的用户名前缀（用户名不含 @，不会被对账当作孤儿账号）
+EMBY_WARM_POOL_PREFIX = os.getenv('EMBY_WARM_POOL_PREFIX', 'pool-')
+# 领取后超过此时间（秒）仍未完成的账号视为中途失败，由补充任务回收
+EMBY_WARM_POOL_CLAIM_TIMEOUT = float(os.getenv('EMBY_WARM_POOL_CLAIM_TIMEOUT', '300'))
+
+
+class EmbyWarmPool:
+    """预创建的Emby账号池
+
+    后台任务预先创建禁用状态、已设置密码和权限的账号。/create_emby 时领取一个，
+    只需改名后启用，不再依次等待 创建 -> 设置密码 -> 设置权限 三个请求。
+    账号池为空或领取失败时由调用方退回直接创建。
+
+    领取状态记录在数据库中：账号启用并保存绑定后调用 complete 删除记录；进程在中途崩溃时，
+    补充任务发现超时未完成的领取记录，已绑定的直接删除记录，未绑定的从Emby删除账号。
+    """
+
+    def __init__(self, store: UserStore | None = None, target_size: int = EMBY_WARM_POOL_SIZE,
+                 concurrency: int = EMBY_WARM_POOL_REFILL_CONCURRENCY,
+                 prefix: str = EMBY_WARM_POOL_PREFIX, claim_timeout: float = EMBY_WARM_POOL_CLAIM_TIMEOUT):
+        self.store = store or get_user_store()
+        self.target_size = target_size
+        self.concurrency = concurrency
+        self.prefix = prefix
+        self.claim_timeout = claim_timeout
+        self._refill_lock = asyncio.Lock()
+        self._refill_task = None
+        # 本进程中正在启用的账号，回收时跳过
+        self._activating = set()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        EMBY_POOL_AVAILABLE.set_function(lambda: self.store.count_pooled_emby_users()['available'])
+
+    @property
+    def enabled(self) -> bool:
+        return self.target_size > 0
+
+    async def claim(self, telegram_id: int, username: str, emby: AsyncEmbyAPI | None = None,
+                    template_id: str = '') -> dict | None:
+        """领取一个预创建账号并改名、启用，返回与 AsyncEmbyAPI.create_user 相同结构的结果
+
+        改名会提交完整的用户信息（包含配置），因此先改名，完成后再并发写入权限和配置。
+        指定 template_id 时启用的同时写入模板用户的权限和配置（模板信息有缓存，不额外增加往返）。
+        账号池为空或启用失败时返回None，调用方应改为直接创建账号。
+        保存绑定后需调用 complete(result['user_id'])。
+        """
+        if not self.enabled:
+            return None
+        emby = emby or AsyncEmbyAPI()
+        template = None
+        if template_id:
+            try:
+                template = await emby.get_template(template_id)
+            except Exception as e:
+                logger.error(f"获取Emby模板用户 {template_id} 失败: {str(e)}")
+            if template is None:
+                return None
+
+        row = self.store.claim_pooled_emby_user(telegram_id, time.time())
+        self.request_refill()
+        if row is None:
+            self.misses += 1
+            EMBY_POOL_CLAIMS.labels('miss').inc()
+            return None
+
+        emby_user_id = row['emby_user_id']
+
+        def activation_updates() -> list:
+            if template is None:
+                return [emby.set_user_policy(emby_user_id)]
+            return [
+                emby.set_user_policy(emby_user_id, policy=dict(template.get('Policy') or {}, IsDisabled=False)),
+                emby.set_user_configuration(emby_user_id, template.get('Configuration') or {})
+            ]
+
+        def collect_errors(results: list) -> list:
+            return [str(result) if isinstance(result, BaseException) else result['error']
+                    for result in results if isinstance(result, BaseException) or not result['success']]
+
+        # 命令超时被取消时账号可能已部分启用，领取记录保留，由补充任务超时后回收
+        self._activating.add(emby_user_id)
+        try:
+            errors = collect_errors(await asyncio.gather(
+                emby.rename_user(emby_user_id, username), return_exceptions=True))
+            if not errors:
+                errors = collect_errors(await asyncio.gather(*activation_updates(), return_exceptions=True))
+        finally:
+            self._activating.discard(emby_user_id)
+        if errors:
+            self.failures += 1
+            EMBY_POOL_CLAIMS.labels('failed').inc()
+            logger.error(f"启用预创建账号 {emby_user_id} 失败: {'; '.join(errors)}")
+            await self.discard(emby_user_id, emby)
+            return None
+
+        self.hits += 1
+        EMBY_POOL_CLAIMS.labels('hit').inc()
+        return {
+            "success": True,
+            "user_id": emby_user_id,
+            "username": username,
+            "password": row['password'],
+            "policy_hash": DESIRED_POLICY_HASH if template is None else None,
+            "pooled": True
+        }
+
+    def complete(self, emby_user_id: str):
+        """绑定已保存，删除领取记录"""
+        self.store.remove_pooled_emby_user(emby_user_id)
+
+    async def discard(self, emby_user_id: str, emby: AsyncEmbyAPI | None = None):
+        """从Emby删除账号并删除记录，删除失败时保留记录等待下次回收"""
+        result = await (emby or AsyncEmbyAPI()).delete_user(emby_user_id)
+        if result["success"]:
+            self.store.remove_pooled_emby_user(emby_user_id)
+
+    async def recover_stale_claims(self, emby: AsyncEmbyAPI | None = None) -> int:
+        """回收超时未完成的领取记录，返回回收的数量"""
+        emby = emby or AsyncEmbyAPI()
+        stale = self.store.iter_stale_pool_claims(time.time() - self.claim_timeout)
+        for row in stale:
+            emby_user_id = row['emby_user_id']
+            if emby_user_id in self._activating:
+                continue
+            if self.store.find_telegram_id_by_emby_user_id(emby_user_id) is not None:
+                self.store.remove_pooled_emby_user(emby_user_id)
+            else:
+                logger.info(f"回收未完成领取的预创建账号 {emby_user_id}(tg:{row['claimed_by']})")
+                await self.discard(emby_user_id, emby)
+        return len(stale)
+
+    async def refill(self) -> int:
+        """回收未完成的领取并将账号池补充到目标大小，返回新创建的账号数
+
+        Emby熔断时跳过，已有补充在进行时直接返回。
+        """
+        if not self.enabled or self._refill_lock.locked() or get_breaker('emby').is_open:
+            return 0
+        async with self._refill_lock:
+            emby = AsyncEmbyAPI()
+            await self.recover_stale_claims(emby)
+            missing = self.target_size - self.store.count_pooled_emby_users()['available']
+            if missing <= 0:
+                return 0
+
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def provision() -> bool:
+                async with semaphore:
+                    if get_breaker('emby').is_open:
+                        return False
+                    username = f"{self.prefix}{emby.generate_random_username(12)}"
+                    result = await emby.create_user(username, disabled=True)
+                    if not result["success"]:
+                        logger.error(f"预创建Emby账号失败: {result['error']}")
+                        return False
+                    if result["policy_hash"] is None:
+                        # 权限未设置成功，账号可能未被禁用，不放入池中
+                        await emby.delete_user(result["user_id"])
+                        return False
+                    self.store.add_pooled_emby_user(
+                        result["user_id"], username, result["password"], time.time())
+                    return True
+
+            created = sum(await asyncio.gather(*(provision() for _ in range(missing))))
+            logger.info(f"预创建Emby账号池补充 {created}/{missing} 个，当前可用 "
+                        f"{self.store.count_pooled_emby_users()['available']}/{self.target_size}")
+            return created
+
+    def request_refill(self):
+        """在后台补充账号池（不等待完成）"""
+        if self._refill_task is None or self._refill_task.done():
+            # 使用新的上下文，不继承当前命令的处理时限
+            self._refill_task = asyncio.create_task(
+                self.refill_logged(), context=contextvars.Context())
+
+    async def refill_logged(self):
+        """补充账号池，出错时只记录日志"""
+        try:
+            await self.refill()
+        except Exception as e:
+            logger.error(f"补充预创建Emby账号池时出错: {str(e)}")
+
+    def stats(self) -> dict:
+        counts = self.store.count_pooled_emby_users()
+        return {
+            'target': self.target_size,
+            'available': counts['available'],
+            'claimed': counts['claimed'],
+            'hits': self.hits,
+            'misses': self.misses,
+            'failures': self.failures
+        }
+
+
+# 进程内共享的账号池
+_pool: EmbyWarmPool | None = None
+
+
+def get_emby_pool() -> EmbyWarmPool:
+    """获取共享的预创建账号池"""
+    global _pool
+    if _pool is None:
+        _pool = EmbyWarmPool()
+    return _pool
+
+
+async def refill_emby_pool(context):
+    """定时任务：补充预创建账号池"""
+    await get_emby_pool().refill_logged()
@@ -1,14 +1,30 @@
 import os
-import json
+import re
 import time
+
+# 进程启动时间，用于统计启动耗时
+PROCESS_START_TIME = time.monotonic()
+
 import logging
 from pathlib import Path
+from urllib.parse import urlparse
 from dotenv import load_dotenv
 from datetime import datetime
 from telegram import Update 
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
-from v2board_api import V2BoardAPI
-from emby_api import EmbyAPI
+from v2board_api import AsyncV2BoardAPI, close_async_client, is_subscription_expired
+from emby_api import EmbyAPI, AsyncEmbyAPI, close_async_client as close_emby_client
+from reconcile import reconcile_emby_users, rollout_policy, rollout_status, check_emby_templates, format_drifted
+from user_store import get_user_store
+from session_cache import SessionCache
+from notifier import get_notification_queue
+from panel_events import get_panel_event_receiver, PANEL_EVENTS_PORT
+from write_behind import get_write_behind
+from emby_pool import get_emby_pool, refill_emby_pool, EMBY_WARM_POOL_SIZE, EMBY_WARM_POOL_REFILL_INTERVAL
+from metrics import observe_handler, start_metrics_server, SESSION_CACHE_SIZE
+from circuit_breaker import breaker_stats
+from deadline import command_deadline, remaining, DeadlineExceeded
+from settings import get_settings, reload_settings
 from logging.handlers import TimedRotatingFileHandler
 
 # 配置日志
@@ -34,124 +50,96 @@ logging.getLogger("httpx").propagate = False
 
 # 加载环境变量
 load_dotenv()
-TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+TOKEN = get_settings().telegram_bot_token
+# 接收更新的方式：polling 长轮询；webhook 由Telegram推送到内置HTTP服务
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Webhook配置：对外访问地址（必须为HTTPS）、本地监听地址和端口、路径、校验密钥（必填）、Telegram同时推送的最大连接数
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN') or None
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+# 只接收处理函数实际处理的更新类型（私聊中的命令和文本消息）
+ALLOWED_UPDATES = [Update.MESSAGE]
+
+
+def webhook_config_errors() -> list:
+    """检查webhook模式的配置，返回错误说明
+
+    内置HTTP服务直接接收推送，没有校验密钥时任何能访问端口的人都可以伪造更新；Telegram只向HTTPS地址推送。
+    """
+    errors = []
+    if not WEBHOOK_SECRET_TOKEN:
+        errors.append("未设置 WEBHOOK_SECRET_TOKEN")
+    elif not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', WEBHOOK_SECRET_TOKEN):
+        errors.append("WEBHOOK_SECRET_TOKEN 只能包含字母、数字、_ 和 -，长度不超过256")
+    url = urlparse(WEBHOOK_URL)
+    if url.scheme != 'https' or not url.netloc:
+        errors.append(f"WEBHOOK_URL 必须是 https 地址，当前为 {WEBHOOK_URL!r}")
+    return errors
+
 
 # 定义会话状态
 TYPING_EMAIL = 0
 TYPING_PASSWORD = 1
 
-# 创建用户数据目录，如果目录不存在，则创建
+# 创建用户数据目录（存放用户数据库及旧版json数据），如果目录不存在，则创建
 USER_DATA_DIR = Path("user_data")
 if not USER_DATA_DIR.exists():
     USER_DATA_DIR.mkdir(exist_ok=True)
 
-# 用户会话数据（内存中的临时存储）
-user_data = {}
-# 用户数据最后访问时间
-user_last_access = {}
 # 数据过期时间（秒）
 DATA_EXPIRE_TIME = 300  # 5分钟不活动就清除数据
+# 内存中最多保留的会话数，超出时淘汰最久未访问的会话
+MAX_SESSIONS = int(os.getenv('MAX_SESSIONS', '10000'))
+# 用户会话数据（内存中的临时存储，按最近访问顺序过期）
+user_data = SessionCache(DATA_EXPIRE_TIME, MAX_SESSIONS)
+SESSION_CACHE_SIZE.set_function(lambda: len(user_data))
+# 认证数据确认有效后，在此时间（秒）内不再重复验证
+AUTH_VALIDATE_TTL = int(os.getenv('AUTH_VALIDATE_TTL', '60'))
 
-# 邮箱到用户ID的映射缓存
-email_user_map = {}
-EMAIL_MAP_FILE = Path("email_map.json")
-
-
-def load_email_map():
-    """加载邮箱映射数据"""
-    global email_user_map
-    try:
-        if EMAIL_MAP_FILE.exists():
-            with open(EMAIL_MAP_FILE, 'r', encoding='utf-8') as f:
-                email_user_map = json.load(f)
-        else:
-            # 如果映射文件不存在，则重建索引
-            rebuild_email_map()
-    except Exception as e:
-        logger.error(f"加载邮箱映射数据出错: {str(e)}")
-        email_user_map = {}
-
-
-def save_email_map():
-    """保存邮箱映射数据"""
-    try:
-        with open(EMAIL_MAP_FILE, 'w', encoding='utf-8') as f:
-            json.dump(email_user_map, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"保存邮箱映射数据出错: {str(e)}")
-
-
-def rebuild_email_map():
-    """重建邮箱映射索引"""
-    global email_user_map
-    email_user_map = {}
-    for file_path in USER_DATA_DIR.glob("*.json"):
-        try:
-            user_id = int(file_path.stem)
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                if data.get('email'):
-                    email_user_map[data['email']] = user_id
-        except Exception as e:
-            logger.error(f"重建邮箱索引时出错: {str(e)}")
-    save_email_map()
+# 用户绑定数据存储，命令处理函数中的读写经过合并写入层，不等待磁盘写入
+store = get_user_store()
+write_behind = get_write_behind()
 
 
 def check_email_usage(email: str, current_user_id: int) -> bool:
-    """检查邮箱是否被其他Telegram账号使用（优化版）"""
-    # 确保映射已加载
-    if not email_user_map:
-        load_email_map()
-
-    # 检查邮箱是否已被使用
-    if email in email_user_map:
-        existing_user_id = email_user_map[email]
-        if existing_user_id != current_user_id:
-            logger.warning(f"邮箱 {email}(tg:{existing_user_id}) 已被其他用户使用")
-            return False
+    """检查邮箱是否被其他Telegram账号使用"""
+    existing_user_id = write_behind.find_telegram_id_by_email(email)
+    if existing_user_id is not None and existing_user_id != current_user_id:
+        logger.warning(f"邮箱 {email}(tg:{existing_user_id}) 已被其他用户使用")
+        return False
     return True
 
 
-def check_and_clean_old_binding(email: str, current_user_id: int) -> bool:
+async def check_and_clean_old_binding(email: str, current_user_id: int) -> bool:
     """检查邮箱绑定并清理旧的绑定"""
     try:
-        # 确保映射已加载
-        if not email_user_map:
-            load_email_map()
-
         # 检查邮箱是否已被其他用户绑定
-        if email in email_user_map:
-            old_user_id = email_user_map[email]
-            if old_user_id != current_user_id:
-                logger.info(
-                    f"邮箱 {email}(tg:{old_user_id}) 正在被新用户(tg:{current_user_id})绑定，清理旧用户数据")
-
-                # 删除旧用户的Emby账号
-                if old_user_id in user_data and user_data[old_user_id].get('emby'):
-                    try:
-                        emby = EmbyAPI()
-                        emby_user_id = user_data[old_user_id]['emby']['user_id']
-                        emby.delete_user(emby_user_id)
-                        logger.info(f"已删除用户 {email}(tg:{old_user_id}) 的Emby账号")
-                    except Exception as e:
-                        logger.error(
-                            f"删除用户 {email}(tg:{old_user_id}) 的Emby账号时出错: {str(e)}")
-
-                # 清理旧用户的数据
-                if old_user_id in user_data:
-                    del user_data[old_user_id]
-                if old_user_id in user_last_access:
-                    del user_last_access[old_user_id]
-
-                # 删除旧用户的数据文件
-                old_file_path = USER_DATA_DIR / f"{old_user_id}.json"
-                if old_file_path.exists():
-                    old_file_path.unlink()
-                    logger.info(f"已删除用户 {email}(tg:{old_user_id}) 的数据文件")
-
-                # 从邮箱映射中删除旧绑定
-                del email_user_map[email]
-                save_email_map()
+        old_user_id = write_behind.find_telegram_id_by_email(email)
+        if old_user_id is not None and old_user_id != current_user_id:
+            logger.info(
+                f"邮箱 {email}(tg:{old_user_id}) 正在被新用户(tg:{current_user_id})绑定，清理旧用户数据")
+
+            # 删除旧用户的Emby账号
+            old_data = user_data.get(old_user_id) or write_behind.get(old_user_id) or {}
+            if old_data.get('emby'):
+                try:
+                    emby = AsyncEmbyAPI()
+                    emby_user_id = old_data['emby']['user_id']
+                    await emby.delete_user(emby_user_id)
+                    logger.info(f"已删除用户 {email}(tg:{old_user_id}) 的Emby账号")
+                except Exception as e:
+                    logger.error(
+                        f"删除用户 {email}(tg:{old_user_id}) 的Emby账号时出错: {str(e)}")
+
+            # 清理旧用户的数据
+            user_data.pop(old_user_id)
+
+            # 删除旧用户的绑定记录
+            write_behind.delete(old_user_id)
+            logger.info(f"已删除用户 {email}(tg:{old_user_id}) 的绑定数据")
 
         return True
     except Exception as e:
@@ -159,105 +147,92 @@ def check_and_clean_old_binding(email: str, current_user_id: int) -> bool:
         return False
 
 
-# 在保存用户数据时更新邮箱映射
-def save_user_data(user_id: int, data: dict):
-    """保存用户数据到json文件（更新版）"""
-    file_path = USER_DATA_DIR / f"{user_id}.json"
+def save_user_data(user_id: int, data: dict, on_flushed=None):
+    """保存用户数据到数据库（由合并写入层在后台写入），on_flushed 在写入数据库后调用"""
     # 只保存需要持久化的数据
     save_data = {
         'email': data.get('email'),
         'password': data.get('password'),
-        'auth_data': data.get('api').auth_data if data.get('api') else None,
+        'auth_data': data.get('api').auth_data if data.get('api') else data.get('auth_data'),
+        'auth_validated_at': data.get('api').auth_validated_at if data.get('api') else data.get('auth_validated_at'),
         'emby': data.get('emby', {})
     }
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(save_data, f, ensure_ascii=False, indent=2)
-
-    # 更新邮箱映射
-    if save_data.get('email'):
-        email_user_map[save_data['email']] = user_id
-        save_email_map()
+    write_behind.save(user_id, save_data, on_flushed)
 
 
 async def clean_expired_data(context: ContextTypes.DEFAULT_TYPE | None = None) -> None:
     """清理过期的用户数据"""
-    current_time = time.time()
-    expired_users = [
-        user_id for user_id, last_access in user_last_access.items()
-        if current_time - last_access > DATA_EXPIRE_TIME
-    ]
-    for user_id in expired_users:
-        if user_id in user_data:
-            email = user_data[user_id].get('email', 'unknown')
-            del user_data[user_id]
-            del user_last_access[user_id]
-            logger.info(f"已清理用户 {email}(tg:{user_id}) 的过期数据")
-        elif user_id in user_last_access:
-            del user_last_access[user_id]
-            logger.info(f"已清理用户 (tg:{user_id}) 的过期访问记录")
-
-
-def load_user_data(user_id: int) -> dict:
-    """从json文件加载用户数据"""
-    file_path = USER_DATA_DIR / f"{user_id}.json"
-    if file_path.exists():
+    for user_id, data in user_data.expire():
+        email = data.get('email', 'unknown')
+        logger.info(f"已清理用户 {email}(tg:{user_id}) 的过期数据")
+    # 定时任务调用时输出会话缓存统计
+    if context is not None:
+        logger.info(f"会话缓存统计: {user_data.stats()}")
+
+
+async def load_user_data(user_id: int) -> dict:
+    """从数据库加载用户数据"""
+    data = write_behind.get(user_id)
+    if data:
+        email = data.get('email') or 'unknown'
+        user_identifier = f"{email}(tg:{user_id})"
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                result = {}
-                email = data.get('email', 'unknown')
-                user_identifier = f"{email}(tg:{user_id})"
-
-                # 检查是否有必要的登录信息
-                if data.get('email') and data.get('password'):
-                    api = V2BoardAPI()
-                    api.email = data['email']
-                    api.password = data['password']
-
-                    # 如果有auth_data，先尝试使用它
-                    if data.get('auth_data'):
-                        api.auth_data = data['auth_data']
-                        api.headers['Authorization'] = data['auth_data']
-
-                        # 验证auth_data是否有效
-                        user_info = api.get_user_info()
-                        if user_info and 'data' in user_info:
-                            logger.info(f"用户 {user_identifier} 的认证数据有效")
-                            result = {
-                                'email': data['email'],
-                                'password': data['password'],
-                                'api': api,
-                                'emby': data.get('emby', {})
-                            }
-                            return result
-                        else:
-                            logger.warning(
-                                f"用户 {user_identifier} 的认证已过期，尝试重新登录")
-
-                    # 如果auth_data无效或不存在，尝试重新登录
-                    if api.login():
-                        logger.info(f"用户 {user_identifier} 自动重新登录成功")
-                        # 更新存储的认证数据
-                        data['auth_data'] = api.auth_data
-                        with open(file_path, 'w', encoding='utf-8') as f:
-                            json.dump(data, f, ensure_ascii=False, indent=2)
-
-                        result = {
+            # 检查是否有必要的登录信息
+            if data.get('email') and data.get('password'):
+                api = AsyncV2BoardAPI()
+                api.email = data['email']
+                api.password = data['password']
+
+                # 如果有auth_data，先尝试使用它
+                if data.get('auth_data'):
+                    api.auth_data = data['auth_data']
+                    api.headers['Authorization'] = data['auth_data']
+                    api.auth_validated_at = data.get('auth_validated_at')
+
+                    # 最近确认过有效的auth_data直接使用，否则重新验证
+                    # 验证时获取到的用户信息会保存在api上，供随后的处理函数复用
+                    auth_valid = api.is_auth_fresh(AUTH_VALIDATE_TTL)
+                    if not auth_valid:
+                        user_info = await api.get_user_info()
+                        auth_valid = bool(user_info and 'data' in user_info)
+                        if auth_valid:
+                            data['auth_validated_at'] = api.auth_validated_at
+                            write_behind.save(user_id, data)
+                    if auth_valid:
+                        logger.info(f"用户 {user_identifier} 的认证数据有效")
+                        return {
                             'email': data['email'],
                             'password': data['password'],
                             'api': api,
                             'emby': data.get('emby', {})
                         }
-                        return result
                     else:
-                        logger.warning(f"用户 {user_identifier} 重新登录失败")
-
-                # 如果无法登录，返回不带API的数据
-                return {
-                    'email': data.get('email'),
-                    'password': data.get('password'),
-                    'emby': data.get('emby', {})
-                }
+                        logger.warning(
+                            f"用户 {user_identifier} 的认证已过期，尝试重新登录")
+
+                # 如果auth_data无效或不存在，尝试重新登录
+                if await api.login():
+                    logger.info(f"用户 {user_identifier} 自动重新登录成功")
+                    # 更新存储的认证数据
+                    data['auth_data'] = api.auth_data
+                    data['auth_validated_at'] = api.auth_validated_at
+                    write_behind.save(user_id, data)
+
+                    return {
+                        'email': data['email'],
+                        'password': data['password'],
+                        'api': api,
+                        'emby': data.get('emby', {})
+                    }
+                else:
+                    logger.warning(f"用户 {user_identifier} 重新登录失败")
+
+            # 如果无法登录，返回不带API的数据
+            return {
+                'email': data.get('email'),
+                'password': data.get('password'),
+                'emby': data.get('emby', {})
+            }
 
         except Exception as e:
             logger.error(f"加载用户 {user_identifier} 数据时出错: {str(e)}")
@@ -271,16 +246,21 @@ async def load_user_session(update: Update) -> bool:
     # 清理过期数据
     await clean_expired_data()
 
-    # 如果数据不在内存中，从文件加载
-    if user_id not in user_data:
-        user_data[user_id] = load_user_data(user_id)
-
-    # 更新最后访问时间
-    user_last_access[user_id] = time.time()
+    # 如果数据不在内存中，从数据库加载；命中时同时更新最后访问时间
+    session = user_data.lookup(user_id)
+    if session is None:
+        session = await load_user_data(user_id)
+        left = remaining()
+        if left is not None and left <= 0:
+            # 处理时限已用完，加载结果不可靠（可能只是面板超时），不缓存
+            raise DeadlineExceeded()
+        user_data[user_id] = session
 
-    return bool(user_data[user_id].get('api'))
+    return bool(session.get('api'))
 
 
+@observe_handler
+@command_deadline
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理 /start 命令"""
     user = update.effective_user
@@ -298,6 +278,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_html(welcome_message)
 
 
+@observe_handler
+@command_deadline
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理 /help 命令"""
     help_text = """
@@ -314,6 +296,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(help_text)
 
 
+@observe_handler
+@command_deadline
 async def login(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """开始登录流程"""
     user_id = update.effective_user.id
@@ -327,6 +311,8 @@ async def login(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return TYPING_EMAIL
 
 
+@observe_handler
+@command_deadline
 async def email_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理邮箱输入"""
     user_id = update.effective_user.id
@@ -341,12 +327,14 @@ async def email_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_data[user_id] = {}
     
     user_data[user_id]['email'] = email
-    user_last_access[user_id] = time.time()  # 更新访问时间
+    user_data.touch(user_id)  # 更新访问时间
 
     await update.message.reply_text("请输入您的密码：")
     return TYPING_PASSWORD
 
 
+@observe_handler
+@command_deadline
 async def password_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理密码输入并尝试登录"""
     user_id = update.effective_user.id
@@ -363,14 +351,14 @@ async def password_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.delete()
 
     # 创建API实例并尝试登录
-    api = V2BoardAPI()
+    api = AsyncV2BoardAPI()
     api.email = email
     api.password = password
 
     try:
-        if api.login():
+        if await api.login():
             # 清理该邮箱的旧绑定
-            if not check_and_clean_old_binding(email, user_id):
+            if not await check_and_clean_old_binding(email, user_id):
                 await update.message.reply_text("处理账号绑定时出错，请重试")
                 return ConversationHandler.END
 
@@ -381,6 +369,8 @@ async def password_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # 保存用户数据
             save_user_data(user_id, user_data[user_id])
             await update.message.reply_text("登录成功！现在您可以使用其他命令了。")
+        elif api.upstream_failed():
+            await update.message.reply_text("登录失败：面板暂时不可用，请稍后重试")
         else:
             await update.message.reply_text("登录失败：账号或密码错误")
     except Exception as e:
@@ -390,6 +380,8 @@ async def password_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+@observe_handler
+@command_deadline
 async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """获取用户信息"""
     if not await load_user_session(update):
@@ -398,7 +390,7 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         api = user_data[update.effective_user.id]['api']
-        info = api.get_user_info()
+        info = await api.get_user_info_cached(AUTH_VALIDATE_TTL)
         if info.get('expired_at') is None:
             expiration_text = "永久有效"
         else:
@@ -422,6 +414,8 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("获取信息失败：网络错误")
 
 
+@observe_handler
+@command_deadline
 async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """获取订阅信息"""
     if not await load_user_session(update):
@@ -430,7 +424,7 @@ async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         api = user_data[update.effective_user.id]['api']
-        sub_info = api.get_subscribe_info()
+        sub_info = await api.get_subscribe_info()
         if sub_info and 'data' in sub_info:
             sub_info = sub_info['data']
             message = f"""
@@ -449,6 +443,8 @@ async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("获取订阅信息失败：网络错误")
 
 
+@observe_handler
+@command_deadline
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """取消当前操作"""
     user_id = update.effective_user.id
@@ -466,6 +462,8 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+@observe_handler
+@command_deadline
 async def create_emby(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """创建Emby账号"""
     if not await load_user_session(update):
@@ -481,7 +479,7 @@ async def create_emby(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # 获取用户信息，检查订阅等级
         api = user_data[user_id]['api']
-        user_info = api.get_user_info()
+        user_info = await api.get_user_info_cached(AUTH_VALIDATE_TTL)
 
         if not user_info or 'data' not in user_info:
             await update.message.reply_text("获取用户信息失败，请重新登录")
@@ -489,8 +487,7 @@ async def create_emby(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         user_info = user_info['data']
         current_plan_id = user_info.get('plan_id')
-        allowed_plan_ids = [int(x.strip()) for x in os.getenv(
-            'ALLOWED_PLAN_IDS', '').split(',') if x.strip()]
+        allowed_plan_ids = get_settings().allowed_plan_ids
 
         # 检查是否有订阅
         if not current_plan_id:
@@ -502,15 +499,23 @@ async def create_emby(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"您当前的订阅套餐不满足创建Emby账号的要求")
             return
 
+        # 检查订阅是否已到期
+        if is_subscription_expired(user_info):
+            await update.message.reply_text("您的订阅已到期，无法创建Emby账号")
+            return
+
         # 检查邮箱是否被其他Telegram账号使用
         email = user_data[user_id]['email']
         if not check_email_usage(email, user_id):
             await update.message.reply_text("该邮箱已被其他Telegram账号使用，无法创建Emby账号")
             return
 
-        # 创建Emby账号
-        emby = EmbyAPI()
-        result = emby.create_user(email)
+        # 创建Emby账号：优先领取预创建账号，账号池为空时直接创建；配置了模板用户时复制模板的权限和配置
+        emby = AsyncEmbyAPI()
+        template_id = get_settings().emby_template_for(current_plan_id)
+        result = await get_emby_pool().claim(user_id, email, emby, template_id)
+        if result is None:
+            result = await emby.create_user(email, template_id=template_id)
         user = update.effective_user
 
         if result["success"]:
@@ -518,9 +523,13 @@ async def create_emby(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_data[user_id]['emby'] = {
                 'username': result['username'],
                 'password': result['password'],
-                'user_id': result['user_id']
+                'user_id': result['user_id'],
+                'policy_hash': result.get('policy_hash')
             }
-            save_user_data(user_id, user_data[user_id])
+            # 领取的预创建账号在绑定写入数据库后才删除领取记录，中途退出时由账号池回收
+            on_flushed = (lambda: get_emby_pool().complete(result['user_id'])) if result.get('pooled') else None
+            save_user_data(user_id, user_data[user_id], on_flushed)
+            emby_info = user_data[user_id]['emby']
 
             message = f"""
 <b>{user.mention_html()}, 欢迎使用 Halo Media Server</b>
@@ -533,7 +542,7 @@ async def create_emby(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 下面是您的 Emby 服务器信息：
 
-{os.getenv('EMBY_SERVER_URL_TEMPLATE')}
+{get_settings().emby_server_url_template}
 服务器端口: 443
 
 请妥善保管您的账号信息，忘记密码只能通过删除账号重新创建。
@@ -547,6 +556,8 @@ async def create_emby(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("创建Emby账号时发生错误")
 
 
+@observe_handler
+@command_deadline
 async def emby_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查看Emby账号信息"""
     if not await load_user_session(update):
@@ -572,7 +583,7 @@ async def emby_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 下面是您的 Emby 服务器信息：
 
-{os.getenv('EMBY_SERVER_URL_TEMPLATE')}
+{get_settings().emby_server_url_template}
 服务器端口: 443
 
 请妥善保管您的账号信息，忘记密码只能通过删除账号重新创建。
@@ -582,7 +593,7 @@ async def emby_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def update_emby_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """更新Emby密码"""
     user_id = update.effective_user.id
-    user_data = load_user_data(user_id)
+    user_data = await load_user_data(user_id)
     if 'api' not in user_data:
         await update.message.reply_text("请先登录")
         return
@@ -599,6 +610,8 @@ async def update_emby_password(update: Update, context: ContextTypes.DEFAULT_TYP
     await update.message.reply_text("密码更新成功")
 
 
+@observe_handler
+@command_deadline
 async def delete_emby(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """删除Emby账号"""
     if not await load_user_session(update):
@@ -612,9 +625,9 @@ async def delete_emby(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        emby = EmbyAPI()
+        emby = AsyncEmbyAPI()
         emby_user_id = user_data[user_id]['emby']['user_id']
-        result = emby.delete_user(emby_user_id)
+        result = await emby.delete_user(emby_user_id)
 
         if result["success"]:
             # 从用户数据中删除Emby账号信息
@@ -631,41 +644,109 @@ async def delete_emby(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("删除Emby账号时发生错误")
 
 
-def update_all_emby_permissions():
-    """更新所有Emby用户的权限"""
+# 启动后台Emby权限同步的状态
+emby_sync_status = {
+    'state': 'pending',
+    'started_at': None,
+    'finished_at': None,
+    'reconcile': None,
+    'error': None
+}
+
+
+async def update_all_emby_permissions(context: ContextTypes.DEFAULT_TYPE | None = None):
+    """对账所有Emby用户：清除已失效的绑定，只为权限不一致的账号重新设置权限"""
     logger.info("开始更新所有Emby用户权限...")
-    emby = EmbyAPI()
-    user_files = os.listdir('user_data')
-    updated_count = 0
-    error_count = 0
-
-    for file in user_files:
-        if file.endswith('.json'):
-            try:
-                with open(os.path.join('user_data', file), 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    if data.get('emby'):
-                        emby_user_id = data['emby']['user_id']
-                        result = emby.set_user_policy(emby_user_id)
-                        if result["success"]:
-                            updated_count += 1
-                            logger.info(
-                                f"成功更新用户权限: {data['emby']['username']}")
-                        elif result["success"] is False and result["error"] == "用户不存在或已删除":
-                            logger.info(
-                                f"用户不存在或已删除: {data['emby']['username']}")
-                            del data['emby']
-                            user_id = int(file.split('.')[0])  # 从文件名获取 user_id
-                            save_user_data(user_id, data)
-                        else:
-                            error_count += 1
-                            logger.error(
-                                f"更新用户权限失败: {data['emby']['username']} - {result['error']}")
-            except Exception as e:
-                error_count += 1
-                logger.error(f"处理用户数据时出错: {file} - {str(e)}")
-
-    logger.info(f"Emby权限更新完成。成功: {updated_count}, 失败: {error_count}")
+    emby_sync_status.update({
+        'state': 'running',
+        'started_at': time.time(),
+        'finished_at': None,
+        'reconcile': None,
+        'error': None
+    })
+    try:
+        settings = get_settings()
+        emby_sync_status['reconcile'] = await reconcile_emby_users(
+            write_behind, check_drift=not settings.emby_templates_configured)
+        if settings.emby_templates_configured:
+            # 权限由Emby后台的模板用户管理，不下发内置的默认权限
+            template_ids = [settings.emby_template_user_id, *settings.emby_plan_templates.values()]
+            problems = await check_emby_templates([x for x in template_ids if x])
+            if problems:
+                emby_sync_status['error'] = '；'.join(problems)
+            logger.info("已配置Emby模板用户，跳过默认权限下发")
+        else:
+            await rollout_policy(write_behind)
+        emby_sync_status['state'] = 'done'
+    except Exception as e:
+        emby_sync_status.update({'state': 'failed', 'error': str(e)})
+        logger.error(f"Emby权限更新失败: {str(e)}")
+    finally:
+        emby_sync_status['finished_at'] = time.time()
+        duration = emby_sync_status['finished_at'] - emby_sync_status['started_at']
+        logger.info(f"Emby权限更新结束，状态: {emby_sync_status['state']}，耗时 {duration:.2f}s")
+
+
+@observe_handler
+@command_deadline
+async def sync_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看后台Emby权限同步的进度（仅管理员）"""
+    if update.effective_user.id not in get_settings().admin_telegram_ids:
+        return
+
+    message = f"Emby权限同步状态：{emby_sync_status['state']}\n"
+    if emby_sync_status['started_at']:
+        end_time = emby_sync_status['finished_at'] or time.time()
+        message += f"已运行：{end_time - emby_sync_status['started_at']:.1f} 秒\n"
+    if emby_sync_status['reconcile']:
+        stats = emby_sync_status['reconcile']
+        message += (f"对账：Emby用户 {stats['emby_users']}，本地绑定 {stats['bindings']}，"
+                    f"已失效 {stats['missing']}，权限不一致 {format_drifted(stats['drifted'])}，孤儿账号 {stats['orphans']}\n")
+    message += (f"权限下发：{rollout_status['done'] + rollout_status['failed']}/{rollout_status['total']}，"
+                f"失败 {rollout_status['failed']}\n")
+    if emby_sync_status['error']:
+        message += f"错误：{emby_sync_status['error']}\n"
+    from scheduler import sweep_status
+    if sweep_status['started_at']:
+        state = "进行中" if sweep_status['running'] else "已完成"
+        if sweep_status['paused']:
+            state = "已暂停（上游熔断）"
+        elif sweep_status['budget_exhausted']:
+            state = "超过时限，下次从中断处继续"
+        message += (f"订阅检查（{sweep_status['label']}）：{state}，"
+                    f"{sweep_status['checked']}/{sweep_status['total']}\n")
+        if sweep_status['deletions_halted']:
+            message += (f"登录失败的用户比例异常（{sweep_status['login_failures']} 个），"
+                        f"已停止因登录失败删除Emby账号，请检查面板\n")
+    if PANEL_EVENTS_PORT:
+        message += f"面板事件待检查：{get_panel_event_receiver().stats()['pending']}\n"
+    if EMBY_WARM_POOL_SIZE:
+        stats = get_emby_pool().stats()
+        message += (f"预创建账号池：可用 {stats['available']}/{stats['target']}，"
+                    f"命中 {stats['hits']}，未命中 {stats['misses']}，失败 {stats['failures']}\n")
+    for name, stats in breaker_stats().items():
+        if stats['state'] != 'closed':
+            message += f"{name} 已熔断，{stats['retry_in']:.0f} 秒后探测恢复\n"
+    await update.message.reply_text(message)
+
+
+@observe_handler
+async def reload_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """重新读取 .env 中的业务配置（仅管理员）"""
+    if update.effective_user.id not in get_settings().admin_telegram_ids:
+        return
+
+    try:
+        settings = reload_settings()
+    except Exception as e:
+        logger.error(f"重新加载配置失败: {str(e)}")
+        await update.message.reply_text(f"重新加载配置失败，仍使用原配置: {str(e)}")
+        return
+    await update.message.reply_text(
+        f"配置已重新加载\n"
+        f"允许的订阅等级：{', '.join(str(x) for x in sorted(settings.allowed_plan_ids))}\n"
+        f"管理员模式：{'已启用' if settings.v2board_admin_configured else '未启用'}\n"
+        f"Emby模板用户：{'已配置' if settings.emby_templates_configured else '未配置'}")
 
 
 async def invalid_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -674,16 +755,41 @@ async def invalid_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+async def on_startup(application: Application):
+    """机器人启动时在后台更新所有Emby用户权限，不阻塞接收消息"""
+    get_notification_queue().start(application.bot)
+    if PANEL_EVENTS_PORT:
+        get_panel_event_receiver().start()
+    application.job_queue.run_once(
+        update_all_emby_permissions, when=0, name='update_all_emby_permissions')
+    logger.info(f"机器人初始化完成，启动耗时 {time.monotonic() - PROCESS_START_TIME:.2f}s")
+
+
+async def on_shutdown(application: Application):
+    """机器人停止时关闭共享的HTTP连接池"""
+    await get_notification_queue().stop()
+    await get_panel_event_receiver().stop()
+    await write_behind.stop()
+    await close_async_client()
+    await close_emby_client()
+
+
 if __name__ == '__main__':
     """启动机器人"""
-    # 加载邮箱映射数据
-    load_email_map()
+    if BOT_MODE == 'webhook':
+        errors = webhook_config_errors()
+        if errors:
+            logger.error(f"webhook模式配置错误，拒绝启动：{'；'.join(errors)}")
+            raise SystemExit(1)
 
-    # 创建应用
-    application = Application.builder().token(TOKEN).build()
+    # 首次启动时导入旧版json用户数据
+    store.import_user_data_dir_once(USER_DATA_DIR)
 
-    # 更新所有Emby用户权限
-    update_all_emby_permissions()
+    # 启动 /metrics 指标服务
+    start_metrics_server()
+
+    # 创建应用
+    application = Application.builder().token(TOKEN).post_init(on_startup).post_shutdown(on_shutdown).build()
 
     # 创建登录会话处理器
     login_handler = ConversationHandler(
@@ -708,6 +814,8 @@ if __name__ == '__main__':
         CommandHandler("create_emby", create_emby, filters.ChatType.PRIVATE),
         CommandHandler("emby_info", emby_info, filters.ChatType.PRIVATE),
         CommandHandler("delete_emby", delete_emby, filters.ChatType.PRIVATE),
+        CommandHandler("sync_status", sync_status, filters.ChatType.PRIVATE),
+        CommandHandler("reload_config", reload_config, filters.ChatType.PRIVATE),
     ]
 
     # 注册所有处理器
@@ -718,14 +826,38 @@ if __name__ == '__main__':
     application.job_queue.run_repeating(
         clean_expired_data, interval=600)  # 每10分钟清理过期数据
 
-    # 添加订阅等级检查任务，每小时检查一次
-    from scheduler import check_and_clean_invalid_emby_accounts
-    application.job_queue.run_repeating(
-        check_and_clean_invalid_emby_accounts,
-        interval=3600,  # 每小时检查一次
-        first=60  # 启动1分钟后开始第一次检查
-    )
+    # 补充预创建的Emby账号池
+    if EMBY_WARM_POOL_SIZE:
+        application.job_queue.run_repeating(
+            refill_emby_pool, interval=EMBY_WARM_POOL_REFILL_INTERVAL, first=5)
+
+    # 添加订阅等级检查任务：默认每个周期（一小时）检查全部用户，滚动模式下每个tick检查一个分片
+    from scheduler import (check_and_clean_invalid_emby_accounts, check_rolling_slice,
+                           SCHEDULER_MODE, SCHEDULER_PERIOD, SCHEDULER_TICK)
+    if SCHEDULER_MODE == 'rolling':
+        application.job_queue.run_repeating(
+            check_rolling_slice,
+            interval=SCHEDULER_TICK,
+            first=60  # 启动1分钟后开始第一次检查
+        )
+    else:
+        application.job_queue.run_repeating(
+            check_and_clean_invalid_emby_accounts,
+            interval=SCHEDULER_PERIOD,
+            first=60  # 启动1分钟后开始第一次检查
+        )
 
     # 启动机器人
-    logger.info("机器人启动中...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info(f"机器人启动中（{BOT_MODE}模式）...")
+    if BOT_MODE == 'webhook':
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
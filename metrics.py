@@ -0,0 +1,104 @@
+import os
+import time
+import functools
+import logging
+from dotenv import load_dotenv
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+logger = logging.getLogger(__name__)
+
+# 加载环境变量
+load_dotenv()
+
+# /metrics 监听地址和端口，端口为0时不启动
+METRICS_ADDR = os.getenv('METRICS_ADDR', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+HANDLER_LATENCY = Histogram(
+    'bot_handler_latency_seconds',
+    '命令处理函数耗时',
+    ['handler']
+)
+UPSTREAM_LATENCY = Histogram(
+    'bot_upstream_request_latency_seconds',
+    '请求V2Board/Emby接口的耗时',
+    ['upstream', 'endpoint', 'status']
+)
+SWEEP_DURATION = Histogram(
+    'bot_scheduler_sweep_duration_seconds',
+    '订阅检查任务每次运行的耗时',
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, float('inf'))
+)
+SWEEP_USERS = Counter(
+    'bot_scheduler_users_total',
+    '订阅检查任务处理的用户数，按结果分类',
+    ['result']
+)
+PANEL_EVENTS = Counter(
+    'bot_panel_events_total',
+    '收到的面板事件数，按事件类型和处理结果分类',
+    ['event', 'result']
+)
+EMBY_POOL_CLAIMS = Counter(
+    'bot_emby_pool_claims_total',
+    '创建Emby账号时从预创建账号池领取的次数，按结果分类（hit/miss/failed）',
+    ['result']
+)
+EMBY_POOL_AVAILABLE = Gauge(
+    'bot_emby_pool_available',
+    '预创建账号池中可领取的账号数'
+)
+UPSTREAM_RETRIES = Counter(
+    'bot_upstream_retries_total',
+    '上游请求的重试次数',
+    ['upstream']
+)
+CIRCUIT_OPEN = Gauge(
+    'bot_circuit_open',
+    '上游是否处于熔断状态（1为熔断）',
+    ['upstream']
+)
+WRITE_BEHIND_PENDING = Gauge(
+    'bot_write_behind_pending',
+    '等待写入数据库的用户数'
+)
+WRITE_BEHIND_COALESCED = Counter(
+    'bot_write_behind_coalesced_total',
+    '被同一用户之后的修改合并掉的写入次数'
+)
+WRITE_BEHIND_FLUSH_DURATION = Histogram(
+    'bot_write_behind_flush_seconds',
+    '每批写入数据库的耗时'
+)
+SESSION_CACHE_SIZE = Gauge(
+    'bot_session_cache_size',
+    '内存中的用户会话数'
+)
+
+
+def observe_handler(func):
+    """记录命令处理函数耗时的装饰器，标签为函数名"""
+    histogram = HANDLER_LATENCY.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start_time)
+
+    return wrapper
+
+
+def observe_upstream(upstream: str, endpoint: str, status, seconds: float):
+    """记录一次上游请求的耗时，status 为HTTP状态码或 'error'"""
+    UPSTREAM_LATENCY.labels(upstream, endpoint, str(status)).observe(seconds)
+
+
+def start_metrics_server():
+    """在后台线程中启动 /metrics HTTP服务"""
+    if not METRICS_PORT:
+        return
+    start_http_server(METRICS_PORT, addr=METRICS_ADDR)
+    logger.info(f"指标服务已启动: http://{METRICS_ADDR}:{METRICS_PORT}/metrics")
@@ -0,0 +1,213 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from dotenv import load_dotenv
+from telegram import Bot
+from telegram.error import RetryAfter, Forbidden, BadRequest
+from user_store import UserStore, get_user_store
+
+logger = logging.getLogger(__name__)
+
+# 加载环境变量
+load_dotenv()
+
+# 全局发送速率（条/秒），Telegram对机器人的全局限制约为30条/秒
+NOTIFY_RATE = float(os.getenv('NOTIFY_RATE', '25'))
+# 同一个聊天两条消息之间的最小间隔（秒）
+NOTIFY_PER_CHAT_INTERVAL = float(os.getenv('NOTIFY_PER_CHAT_INTERVAL', '1'))
+# 单条消息最多尝试发送的次数
+NOTIFY_MAX_ATTEMPTS = int(os.getenv('NOTIFY_MAX_ATTEMPTS', '5'))
+# 读写发件箱出错后，worker重试前的等待时间（秒）
+NOTIFY_ERROR_DELAY = 5.0
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """RetryAfter 中要求等待的秒数（兼容int和timedelta两种类型）"""
+    retry_after = error.retry_after
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class TokenBucket:
+    """令牌桶限速器"""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        # 在此时间之前不发放令牌（收到429时整体暂停）
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        """等待直到获得一个令牌"""
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class NotificationQueue:
+    """持久化的Telegram消息发送队列
+
+    消息先写入数据库发件箱，再由后台worker按全局令牌桶和单聊天间隔限速发送。
+    遇到429时按 retry_after 暂停并稍后重试，重启后会继续发送未完成的消息。
+    """
+
+    def __init__(self, store: UserStore | None = None, rate: float = NOTIFY_RATE,
+                 per_chat_interval: float = NOTIFY_PER_CHAT_INTERVAL,
+                 max_attempts: int = NOTIFY_MAX_ATTEMPTS):
+        self.store = store or get_user_store()
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        # chat_id -> 最近一次发送时间
+        self._last_sent = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.sent = 0
+        self.dropped = 0
+        self.retried = 0
+
+    def enqueue(self, chat_id: int, text: str):
+        """加入一条待发送消息，立即返回"""
+        self.store.enqueue_notification(chat_id, text, time.time())
+        self._wakeup.set()
+
+    def start(self, bot: Bot):
+        """启动后台发送worker"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run(bot))
+
+    async def stop(self):
+        """停止后台发送worker，未发送的消息保留在发件箱中"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self, bot: Bot):
+        pending = self.store.count_notifications()
+        if pending:
+            logger.info(f"发件箱中有 {pending} 条待发送消息")
+        while True:
+            try:
+                due = self.store.fetch_due_notifications(time.time())
+                if not due:
+                    await self._wait_for_next()
+                    continue
+                for notification in due:
+                    try:
+                        await self._deliver(bot, notification)
+                    except Exception as e:
+                        # 未预料的错误同样计为一次尝试，超过次数后丢弃，不让一条消息卡住整个队列
+                        logger.error(f"处理发往 tg:{notification['chat_id']} 的消息时出错: {str(e)}")
+                        self._retry_later(notification, notification['attempts'] + 1, e)
+            except Exception as e:
+                # 发件箱读写失败（如数据库被锁），稍后重试，worker不退出
+                logger.error(f"消息发送队列出错，{NOTIFY_ERROR_DELAY:.0f} 秒后重试: {str(e)}")
+                await asyncio.sleep(NOTIFY_ERROR_DELAY)
+
+    async def _wait_for_next(self):
+        """等待新消息入队或下一条被推迟的消息到期"""
+        self._wakeup.clear()
+        next_time = self.store.next_notification_time()
+        timeout = None if next_time is None else max(0.0, next_time - time.time())
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _deliver(self, bot: Bot, notification):
+        chat_id = notification['chat_id']
+        now = time.monotonic()
+        last_sent = self._last_sent.get(chat_id)
+        if last_sent is not None and now - last_sent < self.per_chat_interval:
+            # 同一聊天发送过快，推迟到间隔之后
+            delay = self.per_chat_interval - (now - last_sent)
+            self.store.reschedule_notification(
+                notification['id'], time.time() + delay, notification['attempts'])
+            return
+
+        await self.bucket.acquire()
+        attempts = notification['attempts'] + 1
+        try:
+            await bot.send_message(chat_id=chat_id, text=notification['text'])
+        except RetryAfter as e:
+            seconds = retry_after_seconds(e)
+            logger.warning(f"Telegram限流，暂停发送 {seconds:.0f} 秒")
+            self.bucket.pause(seconds)
+            self.retried += 1
+            self.store.reschedule_notification(
+                notification['id'], time.time() + seconds, notification['attempts'])
+            return
+        except (Forbidden, BadRequest) as e:
+            # 用户屏蔽了机器人或聊天不存在，重试没有意义
+            logger.warning(f"向 tg:{chat_id} 发送消息失败，已放弃: {str(e)}")
+            self.dropped += 1
+            self.store.delete_notification(notification['id'])
+            return
+        except Exception as e:
+            # 网络错误、群组迁移等其他错误，退避后重试
+            self._retry_later(notification, attempts, e)
+            return
+
+        self.sent += 1
+        self._last_sent[chat_id] = time.monotonic()
+        self.store.delete_notification(notification['id'])
+        if len(self._last_sent) > 10000:
+            self._prune_last_sent()
+
+    def _retry_later(self, notification, attempts: int, error: Exception):
+        """发送失败，未达到最多尝试次数时按指数退避推迟重试，否则放弃"""
+        if attempts >= self.max_attempts:
+            logger.error(f"向 tg:{notification['chat_id']} 发送消息失败 {attempts} 次，已放弃: {str(error)}")
+            self.dropped += 1
+            self.store.delete_notification(notification['id'])
+        else:
+            self.retried += 1
+            delay = min(300, 2 ** attempts) * random.uniform(0.5, 1.5)
+            self.store.reschedule_notification(notification['id'], time.time() + delay, attempts)
+
+    def _prune_last_sent(self):
+        deadline = time.monotonic() - self.per_chat_interval
+        self._last_sent = {
+            chat_id: sent_at for chat_id, sent_at in self._last_sent.items() if sent_at > deadline
+        }
+
+    def stats(self) -> dict:
+        return {
+            'pending': self.store.count_notifications(),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'retried': self.retried
+        }
+
+
+# 进程内共享的发送队列
+_queue: NotificationQueue | None = None
+
+
+def get_notification_queue() -> NotificationQueue:
+    """获取共享的消息发送队列"""
+    global _queue
+    if _queue is None:
+        _queue = NotificationQueue()
+    return _queue
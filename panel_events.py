@@ -0,0 +1,158 @@
+import os
+import hmac
+import json
+import asyncio
+import ipaddress
+import logging
+from dotenv import load_dotenv
+from tornado.web import Application, RequestHandler
+from tornado.httpserver import HTTPServer
+from write_behind import WriteBehindStore, get_write_behind
+from metrics import PANEL_EVENTS
+
+logger = logging.getLogger(__name__)
+
+# 加载环境变量
+load_dotenv()
+
+# 面板事件接收服务的监听地址和端口，端口为0时不启动
+PANEL_EVENTS_ADDR = os.getenv('PANEL_EVENTS_ADDR', '127.0.0.1')
+PANEL_EVENTS_PORT = int(os.getenv('PANEL_EVENTS_PORT', '0'))
+# 接收事件的路径
+PANEL_EVENTS_PATH = os.getenv('PANEL_EVENTS_PATH', '/panel/events')
+# 校验密钥，面板需在 X-Panel-Token 请求头中携带；监听地址不是本机回环地址时必须设置，只监听回环地址时可为空（不校验）
+PANEL_EVENTS_TOKEN = os.getenv('PANEL_EVENTS_TOKEN', '')
+# 同时进行的定向检查数
+PANEL_EVENTS_CONCURRENCY = int(os.getenv('PANEL_EVENTS_CONCURRENCY', '5'))
+
+# 支持的事件类型：套餐变更、订单支付完成、用户被封禁
+EVENT_TYPES = {'plan_changed', 'order_paid', 'user_banned'}
+
+
+def is_loopback(address: str) -> bool:
+    """监听地址是否只能从本机访问（空地址表示监听所有网卡）"""
+    if address == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return False
+
+
+class PanelEventHandler(RequestHandler):
+    """接收面板推送的事件
+
+    请求体为单个事件或事件数组，每个事件形如 {"event": "plan_changed", "email": "user@example.com"}。
+    """
+
+    def initialize(self, receiver: 'PanelEventReceiver'):
+        self.receiver = receiver
+
+    def post(self):
+        token = self.request.headers.get('X-Panel-Token', '')
+        if self.receiver.token and not hmac.compare_digest(token, self.receiver.token):
+            self.set_status(401)
+            self.write({'error': 'invalid token'})
+            return
+
+        try:
+            payload = json.loads(self.request.body or b'null')
+        except ValueError:
+            payload = None
+        events = payload if isinstance(payload, list) else [payload]
+        if not events or not all(
+                isinstance(event, dict) and event.get('event') in EVENT_TYPES
+                and isinstance(event.get('email'), str) and event['email'] for event in events):
+            self.set_status(400)
+            self.write({'error': 'invalid event', 'events': sorted(EVENT_TYPES)})
+            return
+
+        queued = sum(self.receiver.submit(event['event'], event['email']) for event in events)
+        self.set_status(202)
+        self.write({'received': len(events), 'queued': queued})
+
+
+class PanelEventReceiver:
+    """面板事件接收服务
+
+    收到事件后通过邮箱索引找到绑定的Telegram用户，加入定向检查队列，由后台worker立即检查该用户。
+    同一用户在队列中只保留一次检查。队列只在内存中，重启时丢失的事件由定时的全量检查兜底。
+    """
+
+    def __init__(self, store: WriteBehindStore | None = None, address: str = PANEL_EVENTS_ADDR,
+                 port: int = PANEL_EVENTS_PORT, path: str = PANEL_EVENTS_PATH,
+                 token: str = PANEL_EVENTS_TOKEN, concurrency: int = PANEL_EVENTS_CONCURRENCY):
+        self.store = store or get_write_behind()
+        self.address = address
+        self.port = port
+        self.path = path
+        self.token = token
+        self.concurrency = concurrency
+        self.queue = asyncio.Queue()
+        # 已在队列中等待检查的Telegram ID
+        self._pending = set()
+        self._server = None
+        self._workers = []
+
+    def submit(self, event: str, email: str) -> bool:
+        """将事件对应的用户加入检查队列，找不到绑定用户时返回False（邮箱不区分大小写）"""
+        telegram_id = self.store.find_telegram_id_by_email(email.strip().lower())
+        if telegram_id is None:
+            PANEL_EVENTS.labels(event, 'unknown').inc()
+            return False
+        if telegram_id in self._pending:
+            PANEL_EVENTS.labels(event, 'coalesced').inc()
+            return True
+        self._pending.add(telegram_id)
+        self.queue.put_nowait((telegram_id, event))
+        PANEL_EVENTS.labels(event, 'queued').inc()
+        return True
+
+    def start(self):
+        """启动HTTP服务和检查worker，监听非回环地址却未设置校验密钥时拒绝启动"""
+        if self._server is not None:
+            return
+        if not self.token and not is_loopback(self.address):
+            logger.error(f"面板事件接收服务监听在 {self.address or '所有网卡'}，未设置 PANEL_EVENTS_TOKEN，拒绝启动")
+            return
+        app = Application([(self.path, PanelEventHandler, {'receiver': self})])
+        self._server = HTTPServer(app, xheaders=True)
+        self._server.listen(self.port, self.address)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        logger.info(f"面板事件接收服务已启动: http://{self.address}:{self.port}{self.path}")
+
+    async def stop(self):
+        """停止HTTP服务和检查worker"""
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _worker(self):
+        # 延迟导入：scheduler 导入时会配置日志
+        from scheduler import recheck_user
+        while True:
+            telegram_id, event = await self.queue.get()
+            self._pending.discard(telegram_id)
+            try:
+                await recheck_user(telegram_id, f"面板事件 {event} ")
+            except Exception as e:
+                logger.error(f"处理面板事件 {event}(tg:{telegram_id}) 时出错: {str(e)}")
+
+    def stats(self) -> dict:
+        return {'pending': self.queue.qsize()}
+
+
+# 进程内共享的事件接收服务
+_receiver: PanelEventReceiver | None = None
+
+
+def get_panel_event_receiver() -> PanelEventReceiver:
+    """获取共享的面板事件接收服务"""
+    global _receiver
+    if _receiver is None:
+        _receiver = PanelEventReceiver()
+    return _receiver
@@ -0,0 +1,225 @@
+import os
+import time
+import asyncio
+import logging
+from dotenv import load_dotenv
+from emby_api import AsyncEmbyAPI, DESIRED_POLICY_HASH, policy_hash
+from write_behind import WriteBehindStore, get_write_behind
+from circuit_breaker import get_breaker
+
+logger = logging.getLogger(__name__)
+
+# 加载环境变量
+load_dotenv()
+
+# 拉取Emby用户列表时的分页大小
+EMBY_RECONCILE_PAGE_SIZE = int(os.getenv('EMBY_RECONCILE_PAGE_SIZE', '500'))
+# 是否删除Emby中没有本地绑定的孤儿账号（默认只记录日志）
+EMBY_DELETE_ORPHANS = os.getenv('EMBY_DELETE_ORPHANS', 'false').lower() == 'true'
+# 权限下发时每批处理的账号数（批内并发）
+EMBY_ROLLOUT_BATCH_SIZE = int(os.getenv('EMBY_ROLLOUT_BATCH_SIZE', '20'))
+
+# 最近一次权限下发的进度
+rollout_status = {
+    'running': False,
+    'total': 0,
+    'done': 0,
+    'failed': 0,
+    'started_at': None,
+    'finished_at': None
+}
+
+
+def is_orphan_candidate(user: dict) -> bool:
+    """是否可能是机器人创建但失去绑定的账号
+
+    机器人以用户邮箱作为Emby用户名，管理员账号和不像邮箱的用户名一律不动。
+    """
+    policy = user.get('Policy') or {}
+    return not policy.get('IsAdministrator') and '@' in (user.get('Name') or '')
+
+
+def format_drifted(drifted: int | None) -> str:
+    """权限不一致的账号数，未统计时说明原因"""
+    return '不统计（使用模板用户）' if drifted is None else str(drifted)
+
+
+async def reconcile_emby_users(store: WriteBehindStore | None = None,
+                               emby: AsyncEmbyAPI | None = None,
+                               delete_orphans: bool = EMBY_DELETE_ORPHANS,
+                               check_drift: bool = True) -> dict:
+    """将本地绑定与Emby用户列表对账，只处理存在差异的账号
+
+    - 本地有绑定但Emby中已不存在的账号：单独确认后清除本地绑定
+    - 记录的权限哈希与Emby上的实际权限不一致：更新记录的哈希，由 rollout_policy 下发
+    - check_drift 为True时统计权限与 DEFAULT_USER_POLICY 不一致的账号；使用模板用户时权限本就各不相同，
+      不统计（drifted 为None）
+    - Emby中存在但没有本地绑定的账号：记录日志，开启 EMBY_DELETE_ORPHANS 时删除
+
+    读取绑定前先写入尚未写入的修改，修改通过合并写入层保存。
+
+    Returns:
+        dict: 各类差异的统计
+    """
+    store = store or get_write_behind()
+    emby = emby or AsyncEmbyAPI()
+    start_time = time.monotonic()
+    stats = {
+        'emby_users': 0,
+        'bindings': 0,
+        'missing': 0,
+        'drifted': 0 if check_drift else None,
+        'orphans': 0,
+        'deleted_orphans': 0,
+        'errors': 0
+    }
+
+    # 拉取前记录已有的绑定，拉取期间新创建的账号可能不在已拉取的页中，不能据此清除其绑定
+    await store.flush()
+    listed_bindings = {user_id: data['emby']['user_id'] for user_id, data in store.store.iter_emby_bindings()}
+
+    # 一次性分页拉取所有Emby用户，拉取失败时不做任何修改
+    live_users = {}
+    async for user in emby.iter_users(EMBY_RECONCILE_PAGE_SIZE):
+        live_users[user['Id']] = user
+    stats['emby_users'] = len(live_users)
+
+    await store.flush()
+    bound_ids = set()
+    for user_id, data in list(store.store.iter_emby_bindings()):
+        stats['bindings'] += 1
+        emby_user_id = data['emby']['user_id']
+        bound_ids.add(emby_user_id)
+        user_identifier = f"{data.get('email')}(tg:{user_id})"
+        live_user = live_users.get(emby_user_id)
+        try:
+            if live_user is None:
+                if listed_bindings.get(user_id) != emby_user_id:
+                    # 绑定在拉取期间创建或更换，留到下次对账
+                    continue
+                if await emby.get_user(emby_user_id) is not None:
+                    continue
+                stats['missing'] += 1
+                logger.info(f"用户 {user_identifier} 的Emby账号不存在或已删除，清除绑定")
+                clear_emby_binding(store, user_id, emby_user_id)
+            else:
+                live_hash = policy_hash(live_user.get('Policy') or {})
+                if check_drift and live_hash != DESIRED_POLICY_HASH:
+                    stats['drifted'] += 1
+                if live_hash != data['emby'].get('policy_hash'):
+                    store.set_policy_hash(user_id, emby_user_id, live_hash)
+        except Exception as e:
+            stats['errors'] += 1
+            logger.error(f"对账用户 {user_identifier} 时出错: {str(e)}")
+
+    for emby_user_id, user in live_users.items():
+        if emby_user_id in bound_ids or not is_orphan_candidate(user):
+            continue
+        stats['orphans'] += 1
+        if not delete_orphans:
+            logger.warning(f"发现没有绑定的Emby账号: {user.get('Name')}({emby_user_id})")
+            continue
+        result = await emby.delete_user(emby_user_id)
+        if result["success"]:
+            stats['deleted_orphans'] += 1
+        else:
+            stats['errors'] += 1
+
+    logger.info(
+        f"Emby对账完成，耗时 {time.monotonic() - start_time:.2f}s。"
+        f"Emby用户: {stats['emby_users']}, 本地绑定: {stats['bindings']}, "
+        f"已失效: {stats['missing']}, 权限不一致: {format_drifted(stats['drifted'])}, "
+        f"孤儿账号: {stats['orphans']}(已删除 {stats['deleted_orphans']}), 失败: {stats['errors']}")
+    return stats
+
+
+def clear_emby_binding(store: WriteBehindStore, user_id: int, emby_user_id: str):
+    """清除用户的Emby绑定，用户已更换Emby账号时不修改"""
+    data = store.get(user_id)
+    if data is None or (data.get('emby') or {}).get('user_id') != emby_user_id:
+        return
+    data['emby'] = {}
+    store.save(user_id, data)
+
+
+async def check_emby_templates(template_ids, emby: AsyncEmbyAPI | None = None) -> list:
+    """检查配置的模板用户，返回问题列表
+
+    模板用户的权限会原样复制给新账号，因此模板不能是管理员，也不能被禁用。
+    """
+    emby = emby or AsyncEmbyAPI()
+    problems = []
+    for template_id in sorted(set(template_ids)):
+        template = await emby.get_template(template_id)
+        policy = (template or {}).get('Policy') or {}
+        if template is None:
+            problems.append(f"模板用户 {template_id} 不存在")
+        elif policy.get('IsAdministrator'):
+            problems.append(f"模板用户 {template.get('Name')}({template_id}) 是管理员")
+        elif policy.get('IsDisabled'):
+            problems.append(f"模板用户 {template.get('Name')}({template_id}) 已被禁用，复制出的账号也会被禁用")
+    for problem in problems:
+        logger.error(problem)
+    return problems
+
+
+async def rollout_policy(store: WriteBehindStore | None = None, emby: AsyncEmbyAPI | None = None,
+                         batch_size: int = EMBY_ROLLOUT_BATCH_SIZE) -> dict:
+    """向记录的权限哈希与期望不一致的账号下发期望权限
+
+    按Telegram ID顺序分批处理，每成功一个账号就记录新的哈希，
+    因此中断后再次运行只会处理剩余的账号。
+    """
+    store = store or get_write_behind()
+    emby = emby or AsyncEmbyAPI()
+    await store.flush()
+    rollout_status.update({
+        'running': True,
+        'total': store.store.count_policy_outdated(DESIRED_POLICY_HASH),
+        'done': 0,
+        'failed': 0,
+        'started_at': time.time(),
+        'finished_at': None
+    })
+    if rollout_status['total']:
+        logger.info(f"开始下发Emby权限，共 {rollout_status['total']} 个账号需要更新")
+
+    async def push(user_id: int, data: dict):
+        user_identifier = f"{data.get('email')}(tg:{user_id})"
+        try:
+            result = await emby.set_user_policy(data['emby']['user_id'])
+        except Exception as e:
+            result = {"success": False, "error": str(e)}
+        if result["success"]:
+            store.set_policy_hash(user_id, data['emby']['user_id'], DESIRED_POLICY_HASH)
+            rollout_status['done'] += 1
+        elif result["error"] == "用户不存在或已删除":
+            clear_emby_binding(store, user_id, data['emby']['user_id'])
+            rollout_status['done'] += 1
+        else:
+            rollout_status['failed'] += 1
+            logger.error(f"更新用户 {user_identifier} 的Emby权限失败: {result['error']}")
+
+    try:
+        after_id = 0
+        while True:
+            if get_breaker('emby').is_open:
+                # Emby熔断，停止下发，剩余账号在下次运行时继续
+                logger.warning("Emby已熔断，暂停权限下发")
+                break
+            batch = store.store.iter_policy_outdated(DESIRED_POLICY_HASH, after_id, batch_size)
+            if not batch:
+                break
+            await asyncio.gather(*(push(user_id, data) for user_id, data in batch))
+            after_id = batch[-1][0]
+            logger.info(
+                f"Emby权限下发进度: {rollout_status['done'] + rollout_status['failed']}"
+                f"/{rollout_status['total']}，失败 {rollout_status['failed']}")
+    finally:
+        rollout_status['running'] = False
+        rollout_status['finished_at'] = time.time()
+
+    if rollout_status['total']:
+        logger.info(
+            f"Emby权限下发完成。成功: {rollout_status['done']}, 失败: {rollout_status['failed']}")
+    return dict(rollout_status)
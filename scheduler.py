@@ -1,10 +1,17 @@
 import os
-import json
+import math
+import time
+import asyncio
 import logging
-from pathlib import Path
 from dotenv import load_dotenv
-from v2board_api import V2BoardAPI
-from emby_api import EmbyAPI
+from v2board_api import AsyncV2BoardAPI, AsyncV2BoardAdminAPI, user_info_cache, is_subscription_expired
+from emby_api import AsyncEmbyAPI
+from user_store import get_user_store
+from write_behind import get_write_behind
+from notifier import get_notification_queue
+from circuit_breaker import get_breaker, breaker_stats
+from settings import get_settings
+from metrics import SWEEP_DURATION, SWEEP_USERS
 from telegram.ext import ContextTypes
 
 # 配置日志
@@ -17,34 +24,191 @@ logger = logging.getLogger(__name__)
 # 加载环境变量
 load_dotenv()
 
-async def check_and_clean_invalid_emby_accounts(context: ContextTypes.DEFAULT_TYPE | None = None):
-    """检查所有用户的订阅等级并清理不符合要求的Emby账号"""
-    user_data_dir = Path("user_data")
-    allowed_plan_ids = [int(x.strip()) for x in os.getenv(
-        'ALLOWED_PLAN_IDS', '').split(',') if x.strip()]
-    emby = EmbyAPI()
-
-    # 遍历用户数据目录
-    for file_path in user_data_dir.glob("*.json"):
-        try:
-            # 读取用户数据
-            with open(file_path, 'r', encoding='utf-8') as f:
-                user_data = json.load(f)
-
-            user_id = file_path.stem
-            user_email = user_data.get('email', 'unknown')
-            user_identifier = f"{user_email}(tg:{user_id})"
-
-            # 如果用户没有Emby账号，跳过检查
-            if not user_data.get('emby'):
-                continue
-
-            # 如果没有登录信息，跳过检查
-            if not user_data.get('email') or not user_data.get('password'):
-                continue
+# 同时检查的用户数
+SCHEDULER_CONCURRENCY = int(os.getenv('SCHEDULER_CONCURRENCY', '20'))
+# 同时发往V2Board的请求数
+SCHEDULER_V2BOARD_CONCURRENCY = int(os.getenv('SCHEDULER_V2BOARD_CONCURRENCY', '10'))
+# 同时发往Emby的请求数
+SCHEDULER_EMBY_CONCURRENCY = int(os.getenv('SCHEDULER_EMBY_CONCURRENCY', '5'))
+# 检查模式：full 每个周期一次检查全部用户；rolling 每个tick检查一个分片，一个周期内覆盖全部用户
+SCHEDULER_MODE = os.getenv('SCHEDULER_MODE', 'full')
+# 完整检查一遍所有用户的周期（秒）
+SCHEDULER_PERIOD = int(os.getenv('SCHEDULER_PERIOD', '3600'))
+# 滚动模式下每次检查的间隔（秒）
+SCHEDULER_TICK = int(os.getenv('SCHEDULER_TICK', '60'))
+# 一次完整检查的总时限（秒），用完后记录进度并结束，下次从中断处继续，默认为检查周期的90%
+SCHEDULER_TIME_BUDGET = float(os.getenv('SCHEDULER_TIME_BUDGET', str(SCHEDULER_PERIOD * 0.9)))
+# 滚动模式下每个分片的检查时限（秒），为tick间隔的90%
+ROLLING_SLICE_BUDGET = SCHEDULER_TICK * 0.9
+# 管理员模式下用户列表的复用时间（秒），滚动模式的多个tick共用一次拉取的结果
+SCHEDULER_LISTING_TTL = float(os.getenv('SCHEDULER_LISTING_TTL', '300'))
+# 在此时间（秒）内检查过且结果正常的用户不再重复检查，0 表示不跳过
+SCHEDULER_FRESHNESS = float(os.getenv('SCHEDULER_FRESHNESS', '1800'))
+# 一次检查中因登录失败删除账号的保护：登录失败的用户超过 SCHEDULER_LOGIN_FAILURE_ALLOWANCE 个，
+# 且占已检查用户的比例超过 SCHEDULER_MAX_LOGIN_FAILURE_RATIO 时，视为面板异常，本次检查不再因登录失败删除账号
+SCHEDULER_LOGIN_FAILURE_ALLOWANCE = int(os.getenv('SCHEDULER_LOGIN_FAILURE_ALLOWANCE', '5'))
+SCHEDULER_MAX_LOGIN_FAILURE_RATIO = float(os.getenv('SCHEDULER_MAX_LOGIN_FAILURE_RATIO', '0.2'))
+# 检查过程中保存进度的间隔（秒）
+CHECKPOINT_INTERVAL = 5
+# 等待其他请求探测上游是否恢复时的轮询间隔（秒）
+PROBE_POLL_INTERVAL = 0.2
+
+# 当前/最近一次检查的进度
+sweep_status = {
+    'running': False,
+    'label': None,
+    'slice': None,
+    'slices': None,
+    'total': 0,
+    'checked': 0,
+    'paused': False,
+    'budget_exhausted': False,
+    'login_failures': 0,
+    'deletions_halted': False,
+    'resume_from': None,
+    'started_at': None,
+    'finished_at': None
+}
+
+
+class LoginFailureGuard:
+    """单次检查中登录失败的比例异常时，停止因登录失败删除账号
+
+    面板以无法识别的方式出错时（例如修改了提示语、返回异常数据），所有用户都会登录失败，
+    继续删除会清空全部Emby账号。被保护的用户结果为 paused，下次检查时重新判断。
+    """
+
+    def __init__(self, allowance: int = SCHEDULER_LOGIN_FAILURE_ALLOWANCE,
+                 max_ratio: float = SCHEDULER_MAX_LOGIN_FAILURE_RATIO):
+        self.allowance = allowance
+        self.max_ratio = max_ratio
+        self.checked = 0
+        self.failures = 0
+        self.halted = False
+
+    def record_checked(self):
+        """记录一个向面板查询的用户"""
+        self.checked += 1
+
+    def allow_deletion(self) -> bool:
+        """记录一次登录失败，返回是否允许删除该用户的Emby账号"""
+        self.failures += 1
+        if not self.halted and self.failures > self.allowance and self.failures > self.max_ratio * self.checked:
+            self.halted = True
+            logger.error(
+                f"本次检查已有 {self.failures}/{self.checked} 个用户登录失败，比例异常，"
+                f"可能是面板出错，停止因登录失败删除Emby账号")
+        return not self.halted
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    """按最近秩法计算百分位数，sorted_values 必须已排序"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+# 管理员模式下最近一次拉取的用户订阅信息，(拉取时间, 小写邮箱 -> 订阅信息)
+_plan_map_cache = (0.0, None)
+
+
+async def load_plan_map() -> dict | None:
+    """管理员模式下分页拉取面板用户列表，未配置或拉取失败时返回None（逐个用户登录检查）"""
+    global _plan_map_cache
+    settings = get_settings()
+    if not settings.v2board_admin_configured:
+        return None
+    fetched_at, plan_map = _plan_map_cache
+    if plan_map is not None and time.monotonic() - fetched_at < SCHEDULER_LISTING_TTL:
+        return plan_map
+    start_time = time.monotonic()
+    try:
+        plan_map = await AsyncV2BoardAdminAPI(settings).fetch_plan_map()
+    except Exception as e:
+        logger.error(f"拉取V2Board用户列表失败，改为逐个用户登录检查: {str(e)}")
+        return None
+    _plan_map_cache = (time.monotonic(), plan_map)
+    logger.info(f"已拉取V2Board用户列表，共 {len(plan_map)} 个用户，耗时 {time.monotonic() - start_time:.2f}s")
+    return plan_map
+
+
+def upstreams_available() -> bool:
+    """V2Board和Emby是否都没有熔断，熔断期间不做任何删除操作
 
+    熔断超过恢复时间后视为可用，检查任务发出的第一个请求即作为探测请求。
+    """
+    return not get_breaker('v2board').is_open and not get_breaker('emby').is_open
+
+
+def upstreams_probing() -> bool:
+    """是否有上游的探测请求正在进行"""
+    return get_breaker('v2board').probing or get_breaker('emby').probing
+
+
+def current_binding(user_id: int, user_data: dict) -> dict | None:
+    """重新读取用户数据（包括尚未写入的修改），邮箱和Emby账号与检查开始时一致时返回，否则返回None
+
+    检查过程中用户可能重新登录、创建或解绑Emby账号，删除和保存前需要确认绑定没有变化，
+    并且只修改最新数据中的Emby信息，不用检查开始时的快照覆盖其他字段。
+    """
+    current = get_write_behind().get(user_id)
+    if (current is None or current.get('email') != user_data.get('email')
+            or (current.get('emby') or {}).get('user_id') != user_data['emby']['user_id']):
+        return None
+    return current
+
+
+async def delete_emby_binding(user_id: int, user_data: dict, emby: AsyncEmbyAPI,
+                              emby_limit: asyncio.Semaphore) -> dict | None:
+    """删除用户的Emby账号并清除绑定，返回删除结果；绑定在检查期间已变化时不删除，返回None"""
+    if current_binding(user_id, user_data) is None:
+        return None
+    async with emby_limit:
+        result = await emby.delete_user(user_data['emby']['user_id'])
+    if result["success"]:
+        current = current_binding(user_id, user_data)
+        if current is not None:
+            current['emby'] = {}
+            get_write_behind().save(user_id, current)
+    return result
+
+
+async def check_user(user_id: int, user_data: dict, emby: AsyncEmbyAPI, allowed_plan_ids: frozenset,
+                     v2board_limit: asyncio.Semaphore, emby_limit: asyncio.Semaphore,
+                     plan_map: dict | None = None, guard: LoginFailureGuard | None = None):
+    """检查单个用户的订阅等级，不符合要求时删除其Emby账号
+
+    plan_map 为管理员模式拉取的用户列表，其中有该用户时直接使用，否则登录该用户查询。
+    使用 plan_map 时不会验证保存的账号密码，用户在面板修改密码后绑定仍然保留，直到重新 /login 或列表中找不到该用户。
+    guard 为本次检查共用的登录失败保护，登录失败比例异常时不再因登录失败删除账号。
+
+    Returns:
+        str: 检查结果，skipped / ok / deleted / failed / paused
+    """
+    user_identifier = f"unknown(tg:{user_id})"
+    try:
+        user_email = user_data.get('email', 'unknown')
+        user_identifier = f"{user_email}(tg:{user_id})"
+
+        # 如果用户没有Emby账号，跳过检查
+        if not user_data.get('emby'):
+            return 'skipped'
+
+        # 如果没有登录信息，跳过检查
+        if not user_data.get('email') or not user_data.get('password'):
+            return 'skipped'
+
+        if guard is not None:
+            guard.record_checked()
+
+        # 管理员模式下优先使用用户列表中的订阅信息
+        user_info = None
+        if plan_map is not None and user_data['email'].lower() in plan_map:
+            user_info = {'data': plan_map[user_data['email'].lower()]}
+        else:
             # 创建API实例并尝试登录
-            api = V2BoardAPI()
+            api = AsyncV2BoardAPI()
             api.email = user_data['email']
             api.password = user_data['password']
 
@@ -54,59 +218,270 @@ async def check_and_clean_invalid_emby_accounts(context: ContextTypes.DEFAULT_TY
                 api.headers['Authorization'] = user_data['auth_data']
 
             # 获取用户信息
-            user_info = api.get_user_info()
-
-            # 如果获取失败，尝试重新登录
-            if not user_info or 'data' not in user_info:
-                if not api.login():
-                    # 如果登录失败，删除用户的emby账号
-                    emby_user_id = user_data['emby']['user_id']
-                    result = emby.delete_user(emby_user_id)
-                    if result["success"]:
-                        user_data['emby'] = {}
-                        with open(file_path, 'w', encoding='utf-8') as f:
-                            json.dump(user_data, f,
-                                      ensure_ascii=False, indent=2)
-                    # 向用户发送消息
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text="登录失败，请使用 /login 命令重新登录"
-                    )
-                    logger.warning(
-                        f"用户 {user_identifier} 登录失败，已删除Emby账号并向用户发送消息")
-                    continue
-                user_info = api.get_user_info()
-
-            if user_info and 'data' in user_info:
-                current_plan_id = user_info['data'].get('plan_id')
-
-                # 如果没有订阅或订阅等级不在允许列表中
-                if not current_plan_id or current_plan_id not in allowed_plan_ids:
-                    logger.info(f"用户 {user_identifier} 的订阅等级不满足要求，删除Emby账号")
-
-                    # 删除Emby账号
-                    emby_user_id = user_data['emby']['user_id']
-                    result = emby.delete_user(emby_user_id)
-
-                    if result["success"]:
-                        # 从用户数据中删除Emby信息
-                        del user_data['emby']
-                        # 保存更新后的用户数据
-                        with open(file_path, 'w', encoding='utf-8') as f:
-                            json.dump(user_data, f,
-                                      ensure_ascii=False, indent=2)
-                        logger.info(f"已删除用户 {user_identifier} 的Emby账号")
-                    else:
-                        logger.error(
-                            f"删除用户 {user_identifier} 的Emby账号失败: {result.get('error')}")
-
-        except Exception as e:
-            logger.error(f"处理用户 {user_identifier} 时出错: {str(e)}")
-            continue
-
-    logger.info("完成订阅等级检查和Emby账号清理")
+            async with v2board_limit:
+                user_info = await api.get_user_info()
+            if not user_info and api.upstream_failed():
+                logger.warning(f"用户 {user_identifier} 的用户信息请求未得到面板正常响应，跳过本次检查")
+                return 'paused'
+
+        # 如果获取失败，尝试重新登录
+        if not user_info or 'data' not in user_info:
+            async with v2board_limit:
+                logged_in = await api.login()
+            if not logged_in and api.upstream_failed():
+                # 面板不可用时无法判断账号是否有效，不删除
+                logger.warning(f"用户 {user_identifier} 的登录请求未得到面板正常响应，跳过本次检查")
+                return 'paused'
+            if not logged_in and guard is not None and not guard.allow_deletion():
+                return 'paused'
+            if not logged_in:
+                # 如果登录失败，删除用户的emby账号
+                result = await delete_emby_binding(user_id, user_data, emby, emby_limit)
+                if result is None:
+                    logger.info(f"用户 {user_identifier} 的绑定在检查期间已变化，跳过")
+                    return 'skipped'
+                # 通过发送队列通知用户，不等待消息发出
+                get_notification_queue().enqueue(
+                    user_id, "登录失败，请使用 /login 命令重新登录")
+                logger.warning(
+                    f"用户 {user_identifier} 登录失败，已删除Emby账号并向用户发送消息")
+                return 'deleted' if result["success"] else 'failed'
+            async with v2board_limit:
+                user_info = await api.get_user_info()
+
+        if user_info and 'data' in user_info:
+            current_plan_id = user_info['data'].get('plan_id')
+            banned = user_info['data'].get('banned')
+            expired = is_subscription_expired(user_info['data'])
+
+            # 如果账号被封禁、订阅已到期、没有订阅或订阅等级不在允许列表中
+            if banned or expired or not current_plan_id or current_plan_id not in allowed_plan_ids:
+                reason = "账号已被封禁" if banned else "订阅已到期" if expired else "订阅等级不满足要求"
+                logger.info(f"用户 {user_identifier} 的{reason}，删除Emby账号")
+
+                # 删除Emby账号并清除绑定
+                result = await delete_emby_binding(user_id, user_data, emby, emby_limit)
+                if result is None:
+                    logger.info(f"用户 {user_identifier} 的绑定在检查期间已变化，跳过")
+                    return 'skipped'
+                if result["success"]:
+                    logger.info(f"已删除用户 {user_identifier} 的Emby账号")
+                    return 'deleted'
+                else:
+                    logger.error(
+                        f"删除用户 {user_identifier} 的Emby账号失败: {result.get('error')}")
+                    return 'failed'
+            return 'ok'
+        return 'failed'
+
+    except Exception as e:
+        logger.error(f"处理用户 {user_identifier} 时出错: {str(e)}")
+        return 'failed'
+
+
+async def run_sweep(bindings, label: str, time_budget: float | None = None,
+                    checkpoint_key: str | None = None):
+    """并发检查给定的用户，返回检查的用户数
+
+    用户通过固定数量的worker并发检查，发往V2Board和Emby的请求各自有并发上限。
+    每个用户的检查时间和结果记录在数据库中。超过 time_budget 秒或上游熔断时不再领取新用户，
+    第一个未检查的用户记录在 sweep_status['resume_from'] 中；指定 checkpoint_key 时，
+    检查过程中也定期将其保存到数据库，重启后可以从这里继续。
+    """
+    start_time = time.monotonic()
+    store = get_user_store()
+    settings = get_settings()
+    allowed_plan_ids = settings.allowed_plan_ids
+    emby = AsyncEmbyAPI(settings)
+    v2board_limit = asyncio.Semaphore(SCHEDULER_V2BOARD_CONCURRENCY)
+    emby_limit = asyncio.Semaphore(SCHEDULER_EMBY_CONCURRENCY)
+    plan_map = await load_plan_map()
+    guard = LoginFailureGuard()
+    latencies = []
+
+    items = list(bindings)
+    queue = asyncio.Queue()
+    for index, (user_id, user_data) in enumerate(items):
+        queue.put_nowait((index, user_id, user_data))
+    # 已检查完的位置，low_water 之前的用户全部检查完毕（worker并发完成的顺序不固定）
+    done = set()
+    low_water = 0
+    last_checkpoint = time.monotonic()
+
+    def save_checkpoint():
+        if checkpoint_key:
+            store.set_meta(checkpoint_key, str(items[low_water][0]) if low_water < len(items) else '')
+    sweep_status.update({
+        'running': True,
+        'label': label,
+        'total': queue.qsize(),
+        'checked': 0,
+        'paused': False,
+        'budget_exhausted': False,
+        'login_failures': 0,
+        'deletions_halted': False,
+        'resume_from': None,
+        'started_at': time.time(),
+        'finished_at': None
+    })
+
+    async def worker():
+        nonlocal low_water, last_checkpoint
+        while True:
+            while not upstreams_available():
+                if not upstreams_probing():
+                    # 上游熔断，停止领取新用户，剩余用户留到下次检查
+                    sweep_status['paused'] = True
+                    return
+                # 其他worker的请求正在探测上游是否恢复，等待探测结果
+                await asyncio.sleep(PROBE_POLL_INTERVAL)
+            if time_budget is not None and time.monotonic() - start_time > time_budget:
+                sweep_status['budget_exhausted'] = True
+                return
+            try:
+                index, user_id, user_data = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            user_start = time.monotonic()
+            result = await check_user(user_id, user_data, emby, allowed_plan_ids,
+                                      v2board_limit, emby_limit, plan_map, guard)
+            sweep_status['login_failures'] = guard.failures
+            sweep_status['deletions_halted'] = guard.halted
+            latencies.append(time.monotonic() - user_start)
+            get_write_behind().record_check(user_id, result, time.time())
+            done.add(index)
+            while low_water in done:
+                done.discard(low_water)
+                low_water += 1
+            if checkpoint_key and time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                save_checkpoint()
+                last_checkpoint = time.monotonic()
+            sweep_status['checked'] += 1
+            SWEEP_USERS.labels('checked').inc()
+            if result in ('deleted', 'failed', 'paused'):
+                SWEEP_USERS.labels(result).inc()
+
+    try:
+        workers = max(1, min(SCHEDULER_CONCURRENCY, queue.qsize()))
+        await asyncio.gather(*(worker() for _ in range(workers)))
+    finally:
+        sweep_status['running'] = False
+        sweep_status['finished_at'] = time.time()
+        if low_water < len(items):
+            sweep_status['resume_from'] = items[low_water][0]
+        save_checkpoint()
+        SWEEP_DURATION.observe(time.monotonic() - start_time)
+
+    unchecked = sweep_status['total'] - len(latencies)
+    if sweep_status['paused']:
+        logger.warning(
+            f"上游熔断，暂停{label}的订阅检查，剩余 {unchecked} 个用户未检查，"
+            f"熔断状态: {breaker_stats()}")
+    elif sweep_status['budget_exhausted']:
+        logger.warning(
+            f"{label}的订阅检查超过时限 {time_budget:.0f}s，剩余 {unchecked} 个用户未检查")
+    latencies.sort()
+    logger.info(
+        f"完成{label}的订阅等级检查和Emby账号清理，共 {len(latencies)} 个用户，"
+        f"耗时 {time.monotonic() - start_time:.2f}s，"
+        f"单用户耗时 p50={percentile(latencies, 50):.3f}s "
+        f"p90={percentile(latencies, 90):.3f}s p99={percentile(latencies, 99):.3f}s")
+    return len(latencies)
+
+
+async def check_and_clean_invalid_emby_accounts(context: ContextTypes.DEFAULT_TYPE | None = None):
+    """检查所有用户的订阅等级并清理不符合要求的Emby账号
+
+    上次检查因超时、熔断或重启中断时，从中断处继续，到末尾后再从头检查到中断处。
+    SCHEDULER_FRESHNESS 内检查过且结果正常的用户被跳过。
+    """
+    store = get_user_store()
+    start_id = int(store.get_meta('sweep_checkpoint') or 0)
+    if start_id:
+        logger.info(f"从上次中断的位置 tg:{start_id} 继续检查")
+    fresh_after = fresh_threshold()
+    if fresh_after is not None:
+        fresh = store.count_fresh_checks(fresh_after)
+        if fresh:
+            logger.info(f"跳过 {fresh} 个最近 {SCHEDULER_FRESHNESS:.0f}s 内检查过的用户")
+    # 只取出已绑定Emby账号的用户
+    await run_sweep(store.iter_emby_bindings(start_id, fresh_after), "全部用户",
+                    SCHEDULER_TIME_BUDGET, 'sweep_checkpoint')
+
+
+def fresh_threshold() -> float | None:
+    """在此时间戳之后检查过且结果正常的用户不需要再检查，未开启时返回None"""
+    if SCHEDULER_FRESHNESS <= 0:
+        return None
+    return time.time() - SCHEDULER_FRESHNESS
+
+
+# 定向检查（面板事件触发）共用的并发限制
+_recheck_v2board_limit = asyncio.Semaphore(SCHEDULER_V2BOARD_CONCURRENCY)
+_recheck_emby_limit = asyncio.Semaphore(SCHEDULER_EMBY_CONCURRENCY)
+
+
+async def recheck_user(telegram_id: int, reason: str = '') -> str:
+    """立即检查单个用户（面板通知订阅变化时调用），不使用缓存的用户信息
+
+    Returns:
+        str: 检查结果，同 check_user
+    """
+    store = get_write_behind()
+    user_data = store.get(telegram_id)
+    if not user_data or not user_data.get('emby'):
+        return 'skipped'
+    if user_data.get('auth_data'):
+        # 面板上的订阅刚发生变化，缓存中的用户信息已过时
+        user_info_cache.invalidate(user_data['auth_data'])
+    if not upstreams_available():
+        return 'paused'
+    settings = get_settings()
+    result = await check_user(telegram_id, user_data, AsyncEmbyAPI(settings), settings.allowed_plan_ids,
+                              _recheck_v2board_limit, _recheck_emby_limit)
+    store.record_check(telegram_id, result, time.time())
+    logger.info(f"{reason}触发检查用户 {user_data.get('email')}(tg:{telegram_id})，结果: {result}")
+    return result
+
+
+def current_slice(now: float | None = None) -> tuple:
+    """滚动模式下应检查的分片，返回 (分片序号, 分片总数)
+
+    一个周期被划分为 SCHEDULER_PERIOD / SCHEDULER_TICK 个分片。分片序号保存在数据库中，
+    每检查完一个分片加一，某次tick被跳过（上一个分片未结束）或重启时从未检查的分片继续，
+    不会漏掉分片；首次运行时按当前时间选择分片。
+    """
+    slices = max(1, math.ceil(SCHEDULER_PERIOD / SCHEDULER_TICK))
+    saved = get_user_store().get_meta('rolling_slice')
+    if saved:
+        return int(saved) % slices, slices
+    now = time.time() if now is None else now
+    return int(now // SCHEDULER_TICK) % slices, slices
+
+
+async def check_rolling_slice(context: ContextTypes.DEFAULT_TYPE | None = None):
+    """滚动模式：每次只检查一个分片的用户，一个周期内覆盖所有用户
+
+    每个分片最多检查 ROLLING_SLICE_BUDGET 秒，在下一个tick之前结束，避免下一次运行因
+    上一次未结束而被跳过；未检查完的用户在下一个周期再检查。
+    """
+    slice_index, slices = current_slice()
+    sweep_status.update({'slice': slice_index, 'slices': slices})
+    bindings = get_user_store().iter_emby_bindings_slice(slices, slice_index, fresh_threshold())
+    try:
+        await run_sweep(bindings, f"分片 {slice_index + 1}/{slices} ", ROLLING_SLICE_BUDGET)
+    finally:
+        get_user_store().set_meta('rolling_slice', str((slice_index + 1) % slices))
+
 
 if __name__ == "__main__":
     # 测试代码
-    import asyncio
-    asyncio.run(check_and_clean_invalid_emby_accounts())
+    from v2board_api import close_async_client
+    from emby_api import close_async_client as close_emby_client
+
+    async def _run():
+        await check_and_clean_invalid_emby_accounts()
+        await close_async_client()
+        await close_emby_client()
+
+    asyncio.run(_run())
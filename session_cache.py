@@ -0,0 +1,87 @@
+import time
+from collections import OrderedDict
+
+
+class SessionCache:
+    """用户会话缓存
+
+    会话按最近访问时间排列，最久未访问的在最前面：访问、过期清理、淘汰都是均摊O(1)，
+    不需要扫描全部会话。超过 maxsize 时淘汰最久未访问的会话。
+    """
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # user_id -> [最后访问时间, 会话数据]
+        self._sessions = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, user_id):
+        return user_id in self._sessions
+
+    def __getitem__(self, user_id):
+        return self._sessions[user_id][1]
+
+    def __setitem__(self, user_id, data):
+        self._sessions[user_id] = [time.monotonic(), data]
+        self._sessions.move_to_end(user_id)
+        while len(self._sessions) > self.maxsize:
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+
+    def __delitem__(self, user_id):
+        del self._sessions[user_id]
+
+    def get(self, user_id, default=None):
+        item = self._sessions.get(user_id)
+        return item[1] if item is not None else default
+
+    def pop(self, user_id, default=None):
+        item = self._sessions.pop(user_id, None)
+        return item[1] if item is not None else default
+
+    def lookup(self, user_id):
+        """获取会话并更新访问时间，不存在时返回None，同时统计命中率"""
+        item = self._sessions.get(user_id)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        item[0] = time.monotonic()
+        self._sessions.move_to_end(user_id)
+        return item[1]
+
+    def touch(self, user_id):
+        """更新会话的最后访问时间"""
+        item = self._sessions.get(user_id)
+        if item is not None:
+            item[0] = time.monotonic()
+            self._sessions.move_to_end(user_id)
+
+    def expire(self) -> list:
+        """移除所有过期会话，返回被移除的 (user_id, 会话数据)"""
+        deadline = time.monotonic() - self.ttl
+        expired = []
+        while self._sessions:
+            user_id, (last_access, data) = next(iter(self._sessions.items()))
+            if last_access > deadline:
+                break
+            self._sessions.popitem(last=False)
+            expired.append((user_id, data))
+        self.expired += len(expired)
+        return expired
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._sessions),
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evicted': self.evicted
+        }
@@ -0,0 +1,109 @@
+import os
+import logging
+from dataclasses import dataclass
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+
+def parse_id_set(value: str | None) -> frozenset:
+    """解析英文逗号分隔的整数ID列表"""
+    return frozenset(int(x.strip()) for x in (value or '').split(',') if x.strip())
+
+
+def parse_plan_templates(value: str | None) -> dict:
+    """解析 "订阅等级=Emby用户ID,订阅等级=Emby用户ID" 格式的模板用户配置"""
+    templates = {}
+    for item in (value or '').split(','):
+        if '=' not in item:
+            continue
+        plan_id, user_id = item.split('=', 1)
+        templates[int(plan_id.strip())] = user_id.strip()
+    return templates
+
+
+@dataclass(frozen=True)
+class Settings:
+    """机器人的业务配置，启动时从环境变量（.env）解析一次
+
+    API客户端通过构造参数接收配置，不再各自读取环境变量。
+    连接池大小、超时、缓存、并发度等调优参数仍是各模块导入时读取的常量，修改后需要重启。
+    """
+    telegram_bot_token: str | None
+    # 可以使用管理命令的Telegram ID
+    admin_telegram_ids: frozenset
+    v2board_url: str
+    # 允许创建Emby账号的订阅等级
+    allowed_plan_ids: frozenset
+    # 管理员模式：管理后台路径、管理员auth_data、管理员账号密码、用户列表分页大小
+    v2board_admin_path: str
+    v2board_admin_token: str
+    v2board_admin_email: str
+    v2board_admin_password: str
+    v2board_admin_page_size: int
+    emby_url: str
+    emby_api_key: str | None
+    # 发给用户的Emby服务器地址说明
+    emby_server_url_template: str
+    # 创建Emby账号时复制权限和配置的模板用户：默认模板、按订阅等级指定的模板
+    emby_template_user_id: str
+    emby_plan_templates: dict
+
+    @classmethod
+    def from_env(cls) -> 'Settings':
+        return cls(
+            telegram_bot_token=os.getenv('TELEGRAM_BOT_TOKEN'),
+            admin_telegram_ids=parse_id_set(os.getenv('ADMIN_TELEGRAM_IDS')),
+            v2board_url=(os.getenv('V2BOARD_URL') or '').rstrip('/'),
+            allowed_plan_ids=parse_id_set(os.getenv('ALLOWED_PLAN_IDS')),
+            v2board_admin_path=os.getenv('V2BOARD_ADMIN_PATH', '').strip('/'),
+            v2board_admin_token=os.getenv('V2BOARD_ADMIN_TOKEN', ''),
+            v2board_admin_email=os.getenv('V2BOARD_ADMIN_EMAIL', ''),
+            v2board_admin_password=os.getenv('V2BOARD_ADMIN_PASSWORD', ''),
+            v2board_admin_page_size=int(os.getenv('V2BOARD_ADMIN_PAGE_SIZE', '500')),
+            emby_url=(os.getenv('EMBY_URL') or '').rstrip('/'),
+            emby_api_key=os.getenv('EMBY_API_KEY'),
+            emby_server_url_template=os.getenv('EMBY_SERVER_URL_TEMPLATE', ''),
+            emby_template_user_id=os.getenv('EMBY_TEMPLATE_USER_ID', '').strip(),
+            emby_plan_templates=parse_plan_templates(os.getenv('EMBY_PLAN_TEMPLATES'))
+        )
+
+    @property
+    def v2board_admin_configured(self) -> bool:
+        """是否配置了V2Board管理员模式"""
+        return bool(self.v2board_admin_path and (
+            self.v2board_admin_token or (self.v2board_admin_email and self.v2board_admin_password)))
+
+    @property
+    def emby_templates_configured(self) -> bool:
+        """是否配置了Emby模板用户（权限在Emby后台通过模板用户管理）"""
+        return bool(self.emby_template_user_id or self.emby_plan_templates)
+
+    def emby_template_for(self, plan_id: int | None) -> str:
+        """订阅等级对应的模板用户ID，没有单独配置时使用默认模板，未配置模板时返回空字符串"""
+        return self.emby_plan_templates.get(plan_id, self.emby_template_user_id)
+
+
+# 进程内共享的配置
+_settings: Settings | None = None
+
+
+def get_settings() -> Settings:
+    """获取共享的配置，首次调用时从环境变量解析"""
+    global _settings
+    if _settings is None:
+        load_dotenv()
+        _settings = Settings.from_env()
+    return _settings
+
+
+def reload_settings() -> Settings:
+    """重新读取 .env 并替换共享的配置，解析失败时抛出异常并保留原配置
+
+    之后创建的API客户端和处理的命令使用新配置。
+    """
+    global _settings
+    load_dotenv(override=True)
+    _settings = Settings.from_env()
+    logger.info("配置已重新加载")
+    return _settings
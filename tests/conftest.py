@@ -0,0 +1,59 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# 项目模块位于仓库根目录
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import settings  # noqa: E402
+import notifier  # noqa: E402
+import user_store  # noqa: E402
+import write_behind  # noqa: E402
+import circuit_breaker  # noqa: E402
+import emby_api  # noqa: E402
+import v2board_api  # noqa: E402
+from bench.stub_servers import StubServer  # noqa: E402
+
+
+class Upstreams:
+    """测试用的模拟V2Board/Emby服务和独立的数据库，共享实例都指向它们"""
+
+    def __init__(self, store: user_store.UserStore, monkeypatch):
+        self.store = store
+        self.monkeypatch = monkeypatch
+        self.servers = []
+
+    async def start(self, v2board=None, emby=None, latency: float = 0.0):
+        """在当前事件循环中启动模拟服务（每个请求延迟 latency 秒），并让配置指向它们"""
+        for name, handler in (('V2BOARD_URL', v2board), ('EMBY_URL', emby)):
+            if handler is None:
+                continue
+            server = StubServer(handler, latency)
+            await server.start()
+            self.servers.append(server)
+            self.monkeypatch.setenv(name, server.url + ('/api/v1' if name == 'V2BOARD_URL' else ''))
+        self.monkeypatch.setattr(settings, '_settings', None)
+
+    async def stop(self):
+        """关闭共享的HTTP客户端（绑定在当前事件循环上）和模拟服务"""
+        await v2board_api.close_async_client()
+        await emby_api.close_async_client()
+        for server in self.servers:
+            await server.stop()
+
+
+@pytest.fixture
+def upstreams(tmp_path, monkeypatch):
+    store = user_store.UserStore(tmp_path / 'users.db')
+    monkeypatch.setenv('EMBY_API_KEY', 'test-key')
+    monkeypatch.setenv('ALLOWED_PLAN_IDS', '1')
+    monkeypatch.setattr(user_store, '_store', store)
+    monkeypatch.setattr(write_behind, '_write_behind', write_behind.WriteBehindStore(store, interval=0))
+    monkeypatch.setattr(notifier, '_queue', notifier.NotificationQueue(store))
+    monkeypatch.setattr(circuit_breaker, '_breakers', {})
+    monkeypatch.setattr(settings, '_settings', None)
+    v2board_api.user_info_cache.clear()
+    v2board_api.subscribe_cache.clear()
+    yield Upstreams(store, monkeypatch)
+    store.close()
@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+from bindings_cli import export_bindings, import_bindings
+from user_store import UserStore
+
+
+def binding(telegram_id: int) -> dict:
+    email = f"user{telegram_id}@example.com"
+    return {
+        'email': email,
+        'password': 'secret',
+        'auth_data': f"token:{email}",
+        'auth_validated_at': 1000.0 + telegram_id,
+        'emby': {'user_id': f"emby-{telegram_id}", 'username': email, 'password': 'p', 'policy_hash': None}
+    }
+
+
+@pytest.fixture
+def source(tmp_path):
+    store = UserStore(tmp_path / 'source.db')
+    for telegram_id in range(1, 8):
+        store.save(telegram_id, binding(telegram_id))
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def target(tmp_path):
+    store = UserStore(tmp_path / 'target.db')
+    yield store
+    store.close()
+
+
+@pytest.mark.parametrize('name', ['bindings.jsonl', 'bindings.csv'])
+def test_export_import_roundtrip(source, target, tmp_path, name):
+    path = str(tmp_path / name)
+    fmt = 'csv' if name.endswith('.csv') else 'jsonl'
+    assert export_bindings(source, path, fmt) == 7
+    assert import_bindings(target, path, fmt, batch_size=3) == {'imported': 7, 'skipped': 0, 'errors': 0}
+    assert all(target.get(telegram_id) == binding(telegram_id) for telegram_id in range(1, 8))
+
+
+def fail_on_batch(target: UserStore, monkeypatch, failing_batch: int):
+    """写入第 failing_batch 批时模拟磁盘错误（导入中断）"""
+    save_user_rows = target.save_user_rows
+    calls = []
+
+    def save(rows, meta):
+        calls.append(len(rows))
+        if len(calls) == failing_batch:
+            raise OSError("disk I/O error")
+        save_user_rows(rows, meta)
+
+    monkeypatch.setattr(target, 'save_user_rows', save)
+
+
+def test_interrupted_import_resumes_after_last_batch(source, target, tmp_path, monkeypatch):
+    path = str(tmp_path / 'bindings.jsonl')
+    export_bindings(source, path, 'jsonl')
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('not json\n')
+        f.write(json.dumps({'telegram_id': 8, 'email': 'user8@example.com'}) + '\n')
+
+    fail_on_batch(target, monkeypatch, 3)
+    with pytest.raises(OSError):
+        import_bindings(target, path, 'jsonl', batch_size=2)
+    assert [telegram_id for telegram_id, _ in target.iter_emby_bindings()] == [1, 2, 3, 4]
+
+    # 重新执行时跳过已提交的两批，从第5条继续
+    monkeypatch.undo()
+    stats = import_bindings(target, path, 'jsonl', batch_size=2)
+    assert stats == {'imported': 4, 'skipped': 4, 'errors': 1}
+    assert all(target.get(telegram_id) == binding(telegram_id) for telegram_id in range(1, 8))
+    assert target.get(8)['email'] == 'user8@example.com'
+    assert target.get_meta(f"bindings_import:{tmp_path / 'bindings.jsonl'}") is None
+
+
+def test_changed_file_is_imported_from_start(source, target, tmp_path, monkeypatch):
+    path = str(tmp_path / 'bindings.jsonl')
+    export_bindings(source, path, 'jsonl')
+
+    fail_on_batch(target, monkeypatch, 2)
+    with pytest.raises(OSError):
+        import_bindings(target, path, 'jsonl', batch_size=3)
+    monkeypatch.undo()
+
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'telegram_id': 8, 'email': 'user8@example.com'}) + '\n')
+    stats = import_bindings(target, path, 'jsonl', batch_size=3)
+    assert stats == {'imported': 8, 'skipped': 0, 'errors': 0}
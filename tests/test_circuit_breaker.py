@@ -0,0 +1,179 @@
+import asyncio
+import types
+
+import httpx
+import pytest
+
+import circuit_breaker
+import v2board_api
+from cache import LoadCancelled
+from circuit_breaker import CircuitBreaker, CircuitOpenError, call_with_retry, get_breaker
+from deadline import DeadlineExceeded
+from v2board_api import AsyncV2BoardAPI
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """替换熔断器模块使用的时钟，测试中手动推进时间"""
+    fake = types.SimpleNamespace(now=1000.0)
+    fake.monotonic = lambda: fake.now
+    monkeypatch.setattr(circuit_breaker, 'time', fake)
+    monkeypatch.setattr(circuit_breaker, '_breakers', {})
+    return fake
+
+
+def trip(breaker: CircuitBreaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker('test', failure_threshold=3, recovery_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.is_open
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.is_open
+    assert not breaker.allow_request()
+
+
+def test_recovers_open_half_open_closed(clock):
+    breaker = CircuitBreaker('test', failure_threshold=3, recovery_timeout=30)
+    trip(breaker)
+
+    clock.now += 29
+    assert breaker.is_open
+    assert not breaker.allow_request()
+
+    # 超过恢复时间后不再视为不可用，后台任务的下一个请求即为探测
+    clock.now += 2
+    assert not breaker.is_open
+    assert not breaker.probing
+
+    assert breaker.allow_request()
+    assert breaker.state == 'half_open'
+    assert breaker.probing
+    assert breaker.is_open
+    # 探测进行中时其他请求被拒绝
+    assert not breaker.allow_request()
+
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert not breaker.is_open
+    assert breaker.allow_request()
+
+
+def test_failed_probe_reopens(clock):
+    breaker = CircuitBreaker('test', failure_threshold=3, recovery_timeout=30)
+    trip(breaker)
+    clock.now += 31
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.is_open
+    assert breaker.retry_in() == 30
+
+
+def test_abandoned_probe_allows_new_probe(clock):
+    breaker = CircuitBreaker('test', failure_threshold=3, recovery_timeout=30)
+    trip(breaker)
+    clock.now += 31
+    assert breaker.allow_request()
+    # 探测请求被取消，没有记录结果
+    clock.now += 31
+    assert not breaker.probing
+    assert not breaker.is_open
+    assert breaker.allow_request()
+
+
+def test_background_call_probes_after_recovery_timeout(clock):
+    breaker = get_breaker('test-background')
+    trip(breaker)
+
+    async def send():
+        return httpx.Response(200)
+
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(call_with_retry('test-background', send))
+
+    clock.now += breaker.recovery_timeout + 1
+    assert not breaker.is_open
+    response = asyncio.run(call_with_retry('test-background', send))
+    assert response.status_code == 200
+    assert breaker.state == 'closed'
+
+
+@pytest.mark.parametrize('outcome, unavailable', [
+    (httpx.ConnectError('connection refused'), True),
+    (httpx.ReadTimeout('timed out'), True),
+    (CircuitOpenError('v2board', 30), True),
+    (DeadlineExceeded(), True),
+    (LoadCancelled(), True),
+    ((502, None), True),
+    ((503, None), True),
+    ((504, None), True),
+    # 面板对密码错误、账号被封禁返回500，只有带这些提示的500视为被拒绝
+    ((500, {'message': '邮箱或密码错误'}), False),
+    ((500, {'message': 'Incorrect email or password'}), False),
+    ((500, {'message': '该账户已被停止使用'}), False),
+    # 数据库不可用、PHP错误等其他500视为面板故障
+    ((500, {'message': 'SQLSTATE[HY000] [2002] Connection refused'}), True),
+    ((500, None), True),
+    ((404, None), True),
+    ((429, None), True),
+    ((400, {'message': '参数错误'}), False),
+    ((403, {'message': '未登录或登陆已过期'}), False),
+    # 成功状态码但没有 auth_data
+    ((200, {'message': 'ok'}), True),
+])
+def test_upstream_failed_classification(monkeypatch, outcome, unavailable):
+    async def fake_call_with_retry(name, send, idempotent=True, is_failure=None):
+        if isinstance(outcome, Exception):
+            raise outcome
+        status, payload = outcome
+        if payload is None:
+            return httpx.Response(status, text='<html>Server Error</html>')
+        return httpx.Response(status, json=payload)
+
+    monkeypatch.setattr(v2board_api, 'call_with_retry', fake_call_with_retry)
+    api = AsyncV2BoardAPI()
+    api.email = 'user@example.com'
+    api.password = 'secret'
+    assert not asyncio.run(api.login())
+    assert api.upstream_failed() is unavailable
+
+
+def test_unexpected_errors_are_not_swallowed(monkeypatch):
+    async def fake_call_with_retry(name, send, idempotent=True, is_failure=None):
+        raise KeyError('bug')
+
+    monkeypatch.setattr(v2board_api, 'call_with_retry', fake_call_with_retry)
+    api = AsyncV2BoardAPI()
+    api.email = 'user@example.com'
+    api.password = 'secret'
+    with pytest.raises(KeyError):
+        asyncio.run(api.login())
+
+
+@pytest.mark.parametrize('payload, failure', [
+    ({'message': 'SQLSTATE[HY000] [2002] Connection refused'}, True),
+    ({'message': '邮箱或密码错误'}, False),
+])
+def test_panel_500_counts_toward_breaker_unless_rejection(clock, payload, failure):
+    breaker = get_breaker('test-panel-500')
+
+    async def send():
+        return httpx.Response(500, json=payload)
+
+    response = asyncio.run(call_with_retry('test-panel-500', send, idempotent=False,
+                                           is_failure=v2board_api.is_panel_failure))
+    assert response.status_code == 500
+    assert breaker.failures == (1 if failure else 0)
+
+
+def test_login_without_credentials_is_not_upstream_failure():
+    api = AsyncV2BoardAPI()
+    api.last_error = httpx.ConnectError('stale')
+    assert not asyncio.run(api.login())
+    assert not api.upstream_failed()
@@ -0,0 +1,75 @@
+import asyncio
+import time
+import types
+
+import pytest
+
+import deadline as deadline_module
+from bench.stub_servers import FakeV2Board
+from circuit_breaker import get_breaker
+from deadline import DeadlineExceeded, command_deadline, deadline, remaining, request_timeout, run_within_deadline
+from v2board_api import AsyncV2BoardAPI
+
+
+def test_nested_deadline_keeps_earlier_limit():
+    assert remaining() is None
+    with deadline(10):
+        with deadline(60):
+            assert remaining() <= 10
+        with deadline(1):
+            assert remaining() <= 1
+        assert 1 < remaining() <= 10
+    assert remaining() is None
+
+
+def test_request_timeout_shrinks_to_remaining_time():
+    assert request_timeout(5, 10).read == 10
+    with deadline(2):
+        timeout = request_timeout(5, 10)
+        assert timeout.connect <= 2 and timeout.read <= 2
+    with deadline(-1):
+        with pytest.raises(DeadlineExceeded):
+            request_timeout(5, 10)
+
+
+def test_slow_panel_request_stops_at_deadline(upstreams):
+    async def scenario():
+        await upstreams.start(FakeV2Board(), latency=1.0)
+        try:
+            api = AsyncV2BoardAPI()
+            api.auth_data = 'token:user@example.com'
+            api.headers['Authorization'] = api.auth_data
+            start_time = time.monotonic()
+            with deadline(0.2):
+                result = await api.get_user_info()
+            return api, result, time.monotonic() - start_time
+        finally:
+            await upstreams.stop()
+
+    api, result, elapsed = asyncio.run(scenario())
+    assert result is None
+    assert isinstance(api.last_error, DeadlineExceeded)
+    assert api.upstream_failed()
+    assert elapsed < 0.8
+    # 命令超时不是上游故障，不计入熔断器
+    assert get_breaker('v2board').failures == 0
+
+
+def test_command_deadline_replies_on_timeout(monkeypatch):
+    monkeypatch.setattr(deadline_module, 'COMMAND_DEADLINE', 0.05)
+    replies = []
+
+    async def reply_text(text):
+        replies.append(text)
+
+    update = types.SimpleNamespace(message=types.SimpleNamespace(reply_text=reply_text))
+
+    @command_deadline
+    async def handler(update, context):
+        async def slow_upstream():
+            await asyncio.sleep(1)
+
+        await run_within_deadline(slow_upstream())
+
+    asyncio.run(handler(update, None))
+    assert replies == ["服务器响应超时，请稍后重试"]
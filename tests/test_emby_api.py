@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+import emby_api
+from bench.stub_servers import FakeEmby
+from emby_api import AsyncEmbyAPI, DEFAULT_USER_POLICY, DESIRED_POLICY_HASH
+
+TEMPLATE_POLICY = dict(DEFAULT_USER_POLICY, EnableLiveTvAccess=True, EnableContentDownloading=True)
+
+
+@pytest.fixture
+def emby(upstreams):
+    emby_api.template_cache.clear()
+    fake = FakeEmby()
+    fake.add_user('template', 'template', TEMPLATE_POLICY)
+    fake.users['template']['Configuration'] = {'SubtitleMode': 'Always'}
+    return fake
+
+
+def create(upstreams, emby: FakeEmby, **kwargs) -> dict:
+    async def scenario():
+        await upstreams.start(emby=emby)
+        try:
+            return await AsyncEmbyAPI().create_user('user@example.com', **kwargs)
+        finally:
+            await upstreams.stop()
+
+    return asyncio.run(scenario())
+
+
+def test_create_applies_default_policy(upstreams, emby):
+    result = create(upstreams, emby, disabled=True)
+    assert result['policy_hash'] == DESIRED_POLICY_HASH
+    assert emby.users[result['user_id']]['Policy'] == dict(DEFAULT_USER_POLICY, IsDisabled=True)
+
+
+def test_create_from_template_keeps_template_policy(upstreams, emby):
+    result = create(upstreams, emby, template_id='template')
+    assert result['success'] and result['policy_hash'] is None
+    user = emby.users[result['user_id']]
+    assert user['Policy'] == TEMPLATE_POLICY
+    assert user['Configuration'] == {'SubtitleMode': 'Always'}
+
+
+def test_disabled_create_from_template_only_disables(upstreams, emby):
+    result = create(upstreams, emby, template_id='template', disabled=True)
+    assert result['success'] and result['policy_hash'] is None
+    # 在模板权限上只修改 IsDisabled，不被默认权限覆盖
+    assert emby.users[result['user_id']]['Policy'] == dict(TEMPLATE_POLICY, IsDisabled=True)
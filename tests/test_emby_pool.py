@@ -0,0 +1,93 @@
+import asyncio
+import time
+
+from bench.stub_servers import FakeEmby
+from emby_api import DEFAULT_USER_POLICY
+from emby_pool import EmbyWarmPool
+
+
+def pooled_user(store, emby: FakeEmby, emby_user_id: str, created_at: float | None = None):
+    emby.add_user(emby_user_id, f"pool-{emby_user_id}", dict(DEFAULT_USER_POLICY, IsDisabled=True))
+    store.add_pooled_emby_user(emby_user_id, f"pool-{emby_user_id}", 'p',
+                               time.time() if created_at is None else created_at)
+
+
+def claim(upstreams, emby: FakeEmby, template_id: str = ''):
+    pool = EmbyWarmPool(store=upstreams.store, target_size=1)
+
+    async def scenario():
+        await upstreams.start(emby=emby)
+        try:
+            result = await pool.claim(1, 'user@example.com', template_id=template_id)
+            # 等待领取后触发的后台补充完成
+            await pool._refill_task
+            return result
+        finally:
+            await upstreams.stop()
+
+    return asyncio.run(scenario())
+
+
+def test_claim_renames_and_enables(upstreams):
+    emby = FakeEmby()
+    pooled_user(upstreams.store, emby, 'emby-1')
+    result = claim(upstreams, emby)
+
+    assert result['success'] and result['user_id'] == 'emby-1'
+    user = emby.users['emby-1']
+    assert user['Name'] == 'user@example.com'
+    assert user['Policy']['IsDisabled'] is False
+
+
+def test_claim_with_template_keeps_template_configuration(upstreams):
+    emby = FakeEmby()
+    emby.add_user('template', 'template', dict(DEFAULT_USER_POLICY, EnableLiveTvAccess=True))
+    emby.users['template']['Configuration'] = {'SubtitleMode': 'Always'}
+    pooled_user(upstreams.store, emby, 'emby-1')
+    result = claim(upstreams, emby, template_id='template')
+
+    assert result['success']
+    user = emby.users['emby-1']
+    assert user['Name'] == 'user@example.com'
+    # 改名提交的完整用户信息不能覆盖随后写入的模板配置
+    assert user['Configuration'] == {'SubtitleMode': 'Always'}
+    assert user['Policy']['EnableLiveTvAccess'] is True
+    assert user['Policy']['IsDisabled'] is False
+
+
+def test_recover_stale_claims(upstreams):
+    emby = FakeEmby()
+    store = upstreams.store
+    now = time.time()
+    for index, emby_user_id in enumerate(('bound', 'unbound', 'activating', 'recent')):
+        pooled_user(store, emby, emby_user_id, now - 3600 + index)
+    # 按创建顺序领取，前三个在10分钟前领取，最后一个刚刚领取
+    for telegram_id in (1, 2, 3):
+        store.claim_pooled_emby_user(telegram_id, now - 600)
+    store.claim_pooled_emby_user(4, now)
+    # 进程在保存绑定后、删除领取记录前崩溃
+    store.save(1, {'email': 'a@example.com', 'password': 'secret', 'auth_data': None,
+                   'emby': {'user_id': 'bound', 'username': 'a@example.com', 'password': 'p'}})
+    pool = EmbyWarmPool(store=store, target_size=1, claim_timeout=300)
+    pool._activating.add('activating')
+
+    async def scenario():
+        await upstreams.start(emby=emby)
+        try:
+            return await pool.recover_stale_claims()
+        finally:
+            await upstreams.stop()
+
+    assert asyncio.run(scenario()) == 3
+    # 已绑定的只删除记录，未绑定的从Emby删除，本进程中正在启用和未超时的不处理
+    assert sorted(emby.users) == ['activating', 'bound', 'recent']
+    assert store.count_pooled_emby_users() == {'available': 0, 'claimed': 2}
+
+
+def test_failed_claim_discards_account(upstreams):
+    emby = FakeEmby()
+    pooled_user(upstreams.store, emby, 'emby-1')
+    # 账号已在Emby后台被删除，改名失败
+    del emby.users['emby-1']
+    assert claim(upstreams, emby) is None
+    assert upstreams.store.count_pooled_emby_users()['claimed'] == 0
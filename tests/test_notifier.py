@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import Forbidden, NetworkError, RetryAfter
+
+from notifier import NotificationQueue
+from user_store import UserStore
+
+
+class FakeBot:
+    """按顺序抛出 errors 中的异常，之后发送成功"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((chat_id, text))
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = UserStore(tmp_path / 'users.db')
+    yield store
+    store.close()
+
+
+def deliver(queue: NotificationQueue, bot: FakeBot):
+    notification = queue.store.fetch_due_notifications(time.time() + 3600)[0]
+    asyncio.run(queue._deliver(bot, notification))
+    return queue.store.fetch_due_notifications(time.time() + 3600)
+
+
+def test_retry_after_pauses_and_requeues_without_counting_attempt(store):
+    queue = NotificationQueue(store, rate=100, per_chat_interval=0)
+    queue.enqueue(1, 'hello')
+    before = time.time()
+    remaining = deliver(queue, FakeBot(RetryAfter(30)))
+
+    assert len(remaining) == 1
+    assert remaining[0]['attempts'] == 0
+    assert remaining[0]['not_before'] >= before + 30
+    assert queue.bucket.paused_until > time.monotonic() + 29
+    assert queue.retried == 1
+
+
+def test_network_error_backs_off_until_max_attempts(store):
+    queue = NotificationQueue(store, rate=100, per_chat_interval=0, max_attempts=2)
+    queue.enqueue(1, 'hello')
+    remaining = deliver(queue, FakeBot(NetworkError('timed out')))
+    assert remaining[0]['attempts'] == 1
+    assert remaining[0]['not_before'] > time.time()
+
+    assert deliver(queue, FakeBot(NetworkError('timed out'))) == []
+    assert queue.dropped == 1
+
+
+def test_blocked_chat_is_dropped(store):
+    queue = NotificationQueue(store, rate=100, per_chat_interval=0)
+    queue.enqueue(1, 'hello')
+    assert deliver(queue, FakeBot(Forbidden('bot was blocked by the user'))) == []
+    assert queue.dropped == 1 and queue.retried == 0
+
+
+def test_worker_resends_after_retry_after(store):
+    bot = FakeBot(RetryAfter(0))
+
+    async def scenario():
+        queue = NotificationQueue(store, rate=100, per_chat_interval=0)
+        queue.start(bot)
+        queue.enqueue(1, 'hello')
+        for _ in range(100):
+            if bot.sent:
+                break
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert bot.sent == [(1, 'hello')]
+    assert queue.sent == 1 and queue.retried == 1
+    assert store.count_notifications() == 0
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from panel_events import PanelEventReceiver, is_loopback
+from user_store import UserStore
+from write_behind import WriteBehindStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = UserStore(tmp_path / 'users.db')
+    yield store
+    store.close()
+
+
+def test_email_lookup_ignores_case(store):
+    store.save(1, {'email': 'Alice@Example.com', 'password': 'secret', 'auth_data': None, 'emby': {}})
+
+    async def scenario():
+        write_behind = WriteBehindStore(store, interval=60)
+        write_behind.save(2, {'email': 'Bob@Example.com', 'password': 'secret', 'auth_data': None, 'emby': {}})
+        receiver = PanelEventReceiver(write_behind)
+        # 数据库中的和尚未写入的绑定都能按面板推送的小写邮箱找到
+        assert receiver.submit('plan_changed', 'alice@example.com')
+        assert receiver.submit('plan_changed', 'BOB@example.com')
+        assert not receiver.submit('plan_changed', 'carol@example.com')
+        assert [receiver.queue.get_nowait()[0] for _ in range(2)] == [1, 2]
+        await write_behind.stop()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize('address, loopback', [
+    ('127.0.0.1', True),
+    ('::1', True),
+    ('localhost', True),
+    ('0.0.0.0', False),
+    ('', False),
+    ('192.168.1.10', False),
+])
+def test_is_loopback(address, loopback):
+    assert is_loopback(address) is loopback
+
+
+def test_refuses_to_listen_publicly_without_token(store):
+    async def scenario():
+        receiver = PanelEventReceiver(WriteBehindStore(store, interval=60), address='0.0.0.0', port=0, token='')
+        receiver.start()
+        assert receiver._server is None
+        assert receiver._workers == []
+
+    asyncio.run(scenario())
@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+import write_behind
+from bench.stub_servers import FakeEmby
+from emby_api import DEFAULT_USER_POLICY
+from reconcile import reconcile_emby_users
+
+
+@pytest.mark.parametrize('check_drift, drifted', [(True, 1), (False, None)])
+def test_drift_is_not_counted_in_template_mode(upstreams, check_drift, drifted):
+    emby = FakeEmby()
+    emby.add_user('emby-1', 'a@example.com')
+    emby.add_user('emby-2', 'b@example.com', dict(DEFAULT_USER_POLICY, EnableLiveTvAccess=True))
+    for telegram_id, email in ((1, 'a@example.com'), (2, 'b@example.com')):
+        upstreams.store.save(telegram_id, {
+            'email': email,
+            'password': 'secret',
+            'auth_data': None,
+            'emby': {'user_id': f"emby-{telegram_id}", 'username': email, 'password': 'p'}
+        })
+
+    async def scenario():
+        await upstreams.start(emby=emby)
+        try:
+            return await reconcile_emby_users(write_behind.get_write_behind(), check_drift=check_drift)
+        finally:
+            await upstreams.stop()
+
+    stats = asyncio.run(scenario())
+    assert stats['bindings'] == 2 and stats['missing'] == 0
+    assert stats['drifted'] == drifted
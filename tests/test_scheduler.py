@@ -0,0 +1,194 @@
+import asyncio
+import json
+import types
+
+import pytest
+
+import scheduler
+from bench.stub_servers import FakeV2Board, FakeEmby
+from circuit_breaker import get_breaker
+from scheduler import LoginFailureGuard, run_sweep
+
+DB_ERROR = {'message': 'SQLSTATE[HY000] [2002] Connection refused'}
+BAD_PASSWORD = {'message': '邮箱或密码错误'}
+
+
+class PanelWithLoginErrors(FakeV2Board):
+    """auth_data 已失效、登录返回指定错误的面板，failing 为登录失败的邮箱，None 表示全部"""
+
+    def __init__(self, status: int, payload: dict, failing: set | None = None):
+        super().__init__()
+        self.status = status
+        self.payload = payload
+        self.failing = failing
+
+    def __call__(self, method, path, query, headers, body):
+        if path.endswith('/passport/auth/login'):
+            email = json.loads(body)['email']
+            if self.failing is None or email in self.failing:
+                return self.status, self.payload
+        elif path.endswith('/user/info') and headers.get('authorization', '').startswith('expired:'):
+            return 403, {'message': '未登录或登陆已过期'}
+        return super().__call__(method, path, query, headers, body)
+
+
+def bind_users(store, emby: FakeEmby, count: int):
+    for i in range(1, count + 1):
+        email = f"user{i}@example.com"
+        emby.add_user(f"emby-{i}", email)
+        store.save(i, {
+            'email': email,
+            'password': 'secret',
+            'auth_data': f"expired:{email}",
+            'emby': {'user_id': f"emby-{i}", 'username': email, 'password': 'p'}
+        })
+
+
+def sweep(upstreams, panel, emby: FakeEmby, count: int):
+    bind_users(upstreams.store, emby, count)
+
+    async def scenario():
+        await upstreams.start(panel, emby)
+        try:
+            return await run_sweep(upstreams.store.iter_emby_bindings(), 'test')
+        finally:
+            await upstreams.stop()
+
+    return asyncio.run(scenario())
+
+
+def test_panel_database_error_does_not_delete_accounts(upstreams):
+    emby = FakeEmby()
+    sweep(upstreams, PanelWithLoginErrors(500, DB_ERROR), emby, 10)
+
+    assert len(emby.users) == 10
+    assert all(data['emby'] for _, data in upstreams.store.iter_emby_bindings())
+    # 面板故障计入熔断器，检查暂停
+    assert get_breaker('v2board').state == 'open'
+    assert scheduler.sweep_status['paused']
+
+
+def test_html_error_page_is_panel_failure(upstreams):
+    emby = FakeEmby()
+    panel = PanelWithLoginErrors(500, None)
+    sweep(upstreams, panel, emby, 3)
+    assert len(emby.users) == 3
+
+
+def test_credential_error_deletes_only_that_account(upstreams):
+    emby = FakeEmby()
+    panel = PanelWithLoginErrors(500, BAD_PASSWORD, failing={'user3@example.com'})
+    sweep(upstreams, panel, emby, 10)
+
+    assert sorted(emby.users) == sorted(f"emby-{i}" for i in range(1, 11) if i != 3)
+    assert upstreams.store.get(3)['emby'] == {}
+    assert get_breaker('v2board').state == 'closed'
+    assert not scheduler.sweep_status['deletions_halted']
+
+
+def test_mass_login_failure_halts_deletions(upstreams, monkeypatch):
+    monkeypatch.setattr(scheduler, 'SCHEDULER_CONCURRENCY', 1)
+    emby = FakeEmby()
+    sweep(upstreams, PanelWithLoginErrors(500, BAD_PASSWORD), emby, 30)
+
+    guard = LoginFailureGuard()
+    assert len(emby.users) == 30 - guard.allowance
+    assert scheduler.sweep_status['deletions_halted']
+    assert scheduler.sweep_status['login_failures'] == 30
+
+
+@pytest.mark.parametrize('checked, failures, allowed', [
+    (100, 5, 5),
+    (100, 20, 20),
+    (100, 30, 20),
+    (10, 10, 5),
+])
+def test_login_failure_guard(checked, failures, allowed):
+    guard = LoginFailureGuard(allowance=5, max_ratio=0.2)
+    for _ in range(checked):
+        guard.record_checked()
+    assert sum(guard.allow_deletion() for _ in range(failures)) == allowed
+    assert guard.halted == (failures > allowed)
+
+
+def test_rolling_slices_continue_after_skipped_tick(upstreams, monkeypatch):
+    monkeypatch.setattr(scheduler, 'SCHEDULER_PERIOD', 180)
+    monkeypatch.setattr(scheduler, 'SCHEDULER_TICK', 60)
+    monkeypatch.setattr(scheduler, 'time', types.SimpleNamespace(time=lambda: 60.0 * 7))
+    runs = []
+
+    async def fake_run_sweep(bindings, label, time_budget=None, checkpoint_key=None):
+        runs.append((label, time_budget))
+
+    monkeypatch.setattr(scheduler, 'run_sweep', fake_run_sweep)
+    # 时间不变（相当于中间的tick被跳过），分片仍依次推进
+    for _ in range(4):
+        asyncio.run(scheduler.check_rolling_slice())
+
+    assert [label for label, _ in runs] == ['分片 2/3 ', '分片 3/3 ', '分片 1/3 ', '分片 2/3 ']
+    # 分片的检查时限小于tick间隔，不会导致下一次运行被跳过
+    assert all(budget < 60 for _, budget in runs)
+
+
+@pytest.mark.parametrize('expired_at, deleted', [
+    (None, False),
+    (4102444800, False),
+    (946684800, True),
+])
+def test_admin_mode_deletes_expired_subscription(upstreams, expired_at, deleted):
+    emby = FakeEmby()
+    bind_users(upstreams.store, emby, 1)
+    plan_map = {'user1@example.com': {'email': 'user1@example.com', 'plan_id': 1,
+                                      'expired_at': expired_at, 'banned': False}}
+
+    async def scenario():
+        await upstreams.start(emby=emby)
+        try:
+            user_id, user_data = next(upstreams.store.iter_emby_bindings())
+            return await scheduler.check_user(user_id, user_data, scheduler.AsyncEmbyAPI(), {1},
+                                              asyncio.Semaphore(1), asyncio.Semaphore(1), plan_map)
+        finally:
+            await upstreams.stop()
+
+    assert asyncio.run(scenario()) == ('deleted' if deleted else 'ok')
+    assert (emby.users == {}) is deleted
+
+
+def test_full_sweep_resumes_from_checkpoint(upstreams, monkeypatch):
+    for telegram_id in range(1, 7):
+        email = f"user{telegram_id}@example.com"
+        upstreams.store.save(telegram_id, {'email': email, 'password': 'secret', 'auth_data': None,
+                                           'emby': {'user_id': f"emby-{telegram_id}", 'username': email,
+                                                    'password': 'p'}})
+    # 每检查一个用户时钟前进1秒，时限2.5秒时检查3个用户后停止
+    clock = types.SimpleNamespace(now=0.0, time=scheduler.time.time)
+    clock.monotonic = lambda: clock.now
+    checked = []
+
+    async def fake_check_user(user_id, *args):
+        checked.append(user_id)
+        clock.now += 1
+        return 'ok'
+
+    monkeypatch.setattr(scheduler, 'time', clock)
+    monkeypatch.setattr(scheduler, 'check_user', fake_check_user)
+    monkeypatch.setattr(scheduler, 'SCHEDULER_CONCURRENCY', 1)
+    monkeypatch.setattr(scheduler, 'SCHEDULER_TIME_BUDGET', 2.5)
+
+    asyncio.run(scheduler.check_and_clean_invalid_emby_accounts())
+    assert checked == [1, 2, 3]
+    assert scheduler.sweep_status['budget_exhausted']
+    assert upstreams.store.get_meta('sweep_checkpoint') == '4'
+
+    # 下一次从中断处继续，刚检查过且结果正常的用户被跳过
+    checked.clear()
+    monkeypatch.setattr(scheduler, 'SCHEDULER_TIME_BUDGET', 100)
+    asyncio.run(scheduler.check_and_clean_invalid_emby_accounts())
+    assert checked == [4, 5, 6]
+    assert upstreams.store.get_meta('sweep_checkpoint') == ''
+
+    # 关闭跳过后从头检查全部用户
+    checked.clear()
+    monkeypatch.setattr(scheduler, 'SCHEDULER_FRESHNESS', 0)
+    asyncio.run(scheduler.check_and_clean_invalid_emby_accounts())
+    assert checked == [1, 2, 3, 4, 5, 6]
@@ -0,0 +1,55 @@
+import types
+
+import pytest
+
+import session_cache
+from session_cache import SessionCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """替换会话缓存使用的时钟，测试中手动推进时间"""
+    fake = types.SimpleNamespace(now=1000.0)
+    fake.monotonic = lambda: fake.now
+    monkeypatch.setattr(session_cache, 'time', fake)
+    return fake
+
+
+def test_evicts_least_recently_used(clock):
+    cache = SessionCache(ttl=300, maxsize=2)
+    cache[1] = 'a'
+    cache[2] = 'b'
+    # 访问后1成为最近使用的会话，超出容量时淘汰2
+    assert cache.lookup(1) == 'a'
+    cache[3] = 'c'
+    assert 2 not in cache
+    assert cache.get(1) == 'a' and cache.get(3) == 'c'
+    assert cache.stats()['evicted'] == 1
+
+
+def test_expires_only_idle_sessions(clock):
+    cache = SessionCache(ttl=300, maxsize=10)
+    cache[1] = 'a'
+    clock.now += 200
+    cache[2] = 'b'
+    clock.now += 50
+    cache.touch(1)
+
+    clock.now += 260
+    # 1在250秒时访问过，2在200秒时写入，此时只有2超过300秒未访问
+    assert cache.expire() == [(2, 'b')]
+    assert 1 in cache
+    clock.now += 50
+    assert cache.expire() == [(1, 'a')]
+    assert len(cache) == 0
+    assert cache.stats()['expired'] == 2
+
+
+def test_lookup_counts_hits_and_misses(clock):
+    cache = SessionCache(ttl=300, maxsize=10)
+    cache[1] = 'a'
+    assert cache.lookup(1) == 'a'
+    assert cache.lookup(2) is None
+    assert cache.pop(1) == 'a'
+    assert cache.lookup(1) is None
+    assert cache.stats() == {'size': 0, 'hits': 1, 'misses': 2, 'expired': 0, 'evicted': 0}
@@ -0,0 +1,44 @@
+import pytest
+
+from user_store import UserStore
+
+
+def binding(telegram_id: int, bound: bool = True) -> dict:
+    email = f"user{telegram_id}@example.com"
+    return {
+        'email': email,
+        'password': 'secret',
+        'auth_data': None,
+        'emby': {'user_id': f"emby-{telegram_id}", 'username': email, 'password': 'p'} if bound else {}
+    }
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = UserStore(tmp_path / 'users.db')
+    for telegram_id in (8, 1, 5, 3, 2):
+        store.save(telegram_id, binding(telegram_id))
+    store.save(4, binding(4, bound=False))
+    yield store
+    store.close()
+
+
+@pytest.mark.parametrize('start_id, expected', [
+    (0, [1, 2, 3, 5, 8]),
+    (5, [5, 8, 1, 2, 3]),
+    # 检查点对应的用户已解绑或删除时从下一个用户继续
+    (4, [5, 8, 1, 2, 3]),
+    (9, [1, 2, 3, 5, 8]),
+])
+def test_iter_emby_bindings_resumes_and_wraps_around(store, start_id, expected):
+    assert [telegram_id for telegram_id, _ in store.iter_emby_bindings(start_id)] == expected
+
+
+def test_iter_emby_bindings_skips_fresh_ok_checks(store):
+    store.record_check(1, 'ok', 1000.0)
+    store.record_check(2, 'failed', 1000.0)
+    store.record_check(3, 'ok', 100.0)
+    ids = [telegram_id for telegram_id, _ in store.iter_emby_bindings(2, fresh_after=500.0)]
+    # 1 在 fresh_after 之后检查且结果正常被跳过；2 检查失败、3 检查已过期，仍需检查
+    assert ids == [2, 3, 5, 8]
+    assert store.count_fresh_checks(500.0) == 1
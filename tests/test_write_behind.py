@@ -0,0 +1,168 @@
+import asyncio
+import threading
+
+import pytest
+
+from user_store import UserStore
+from write_behind import WriteBehindStore
+
+
+def user(email: str, emby_user_id: str | None = None) -> dict:
+    return {
+        'email': email,
+        'password': 'secret',
+        'auth_data': f"token:{email}",
+        'auth_validated_at': None,
+        'emby': {'user_id': emby_user_id, 'username': email, 'password': 'p', 'policy_hash': None}
+        if emby_user_id else {}
+    }
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = UserStore(tmp_path / 'users.db')
+    yield store
+    store.close()
+
+
+def test_saves_are_coalesced_and_readable_before_flush(store):
+    async def scenario():
+        write_behind = WriteBehindStore(store, interval=60)
+        write_behind.save(1, user('old@example.com'))
+        write_behind.save(1, user('new@example.com'))
+
+        # 未写入时读取到最后一次修改，数据库中还没有
+        assert write_behind.get(1) == user('new@example.com')
+        assert store.get(1) is None
+        assert write_behind.find_telegram_id_by_email('new@example.com') == 1
+        assert write_behind.find_telegram_id_by_email('old@example.com') is None
+        assert write_behind.coalesced == 1
+
+        assert await write_behind.flush() == 1
+        assert store.get(1) == user('new@example.com')
+        await write_behind.stop()
+
+    asyncio.run(scenario())
+
+
+def test_delete_hides_row_before_flush(store):
+    store.save(1, user('a@example.com'))
+
+    async def scenario():
+        write_behind = WriteBehindStore(store, interval=60)
+        write_behind.delete(1)
+        assert write_behind.get(1) is None
+        assert write_behind.find_telegram_id_by_email('a@example.com') is None
+        assert store.get(1) is not None
+        await write_behind.stop()
+
+    asyncio.run(scenario())
+    assert store.get(1) is None
+
+
+def test_returned_data_is_a_copy(store):
+    async def scenario():
+        write_behind = WriteBehindStore(store, interval=60)
+        data = user('a@example.com')
+        write_behind.save(1, data)
+        data['email'] = 'changed@example.com'
+        write_behind.get(1)['email'] = 'changed@example.com'
+        assert write_behind.get(1)['email'] == 'a@example.com'
+        await write_behind.stop()
+
+    asyncio.run(scenario())
+
+
+def test_failed_flush_requeues_batch_and_keeps_newer_writes(store, monkeypatch):
+    async def scenario():
+        write_behind = WriteBehindStore(store, interval=60)
+        flushed = []
+        write_behind.save(1, user('a@example.com'), on_flushed=lambda: flushed.append(1))
+        write_behind.save(2, user('b@example.com'))
+        write_behind.record_check(2, 'ok', 100.0)
+
+        release = threading.Event()
+
+        def failing_write(*args):
+            release.wait(5)
+            raise OSError("disk I/O error")
+
+        monkeypatch.setattr(write_behind, '_write_batch', failing_write)
+        flush = asyncio.create_task(write_behind.flush())
+        await asyncio.sleep(0.05)
+        # 写入进行中时仍能读到正在写入的修改，新的修改进入下一批
+        assert write_behind.get(2) == user('b@example.com')
+        write_behind.save(2, user('b2@example.com'))
+        release.set()
+        with pytest.raises(OSError):
+            await flush
+
+        assert flushed == []
+        assert store.get(1) is None
+        assert write_behind.get(1) == user('a@example.com')
+        assert write_behind.get(2) == user('b2@example.com')
+        assert write_behind.stats()['pending'] == 3
+
+        monkeypatch.undo()
+        assert await write_behind.flush() == 3
+        assert flushed == [1]
+        assert store.get(1) == user('a@example.com')
+        assert store.get(2) == user('b2@example.com')
+        assert store.get_check(2)['last_result'] == 'ok'
+        await write_behind.stop()
+
+    asyncio.run(scenario())
+
+
+def test_set_policy_hash_ignores_changed_binding(store):
+    async def scenario():
+        write_behind = WriteBehindStore(store, interval=60)
+        write_behind.save(1, user('a@example.com', 'emby-1'))
+        write_behind.set_policy_hash(1, 'emby-1', 'hash-1')
+        assert write_behind.get(1)['emby']['policy_hash'] == 'hash-1'
+
+        # 用户已更换Emby账号，旧账号的哈希不写入新账号
+        write_behind.save(1, user('a@example.com', 'emby-2'))
+        write_behind.set_policy_hash(1, 'emby-1', 'hash-old')
+        assert write_behind.get(1)['emby']['policy_hash'] is None
+        await write_behind.stop()
+
+    asyncio.run(scenario())
+    assert store.get(1)['emby']['user_id'] == 'emby-2'
+
+
+def test_writes_through_outside_event_loop(store):
+    write_behind = WriteBehindStore(store, interval=60)
+    flushed = []
+    write_behind.save(1, user('a@example.com'), on_flushed=lambda: flushed.append(1))
+    assert store.get(1) == user('a@example.com')
+    assert flushed == [1]
+
+
+def test_large_flush_is_split_into_transactions(store, monkeypatch):
+    batches = []
+    apply_batch = UserStore.apply_batch
+
+    def recording_apply_batch(self, saves, deletes, cleared_checks, checks):
+        batches.append((set(saves), set(deletes), set(cleared_checks), set(checks)))
+        apply_batch(self, saves, deletes, cleared_checks, checks)
+
+    monkeypatch.setattr(UserStore, 'apply_batch', recording_apply_batch)
+    store.save(3, user('c@example.com'))
+
+    async def scenario():
+        write_behind = WriteBehindStore(store, interval=60, batch_size=2)
+        for i in (1, 2):
+            write_behind.save(i, user(f"{i}@example.com"))
+        write_behind.delete(3)
+        write_behind.record_check(1, 'ok', 100.0)
+        write_behind.record_check(4, 'ok', 100.0)
+        assert await write_behind.flush() == 5
+        await write_behind.stop()
+
+    asyncio.run(scenario())
+    # 每个事务最多2个用户，同一用户的修改在同一个事务中
+    assert batches == [({1, 2}, set(), set(), {1}), (set(), {3}, {3}, {4})]
+    assert store.get(3) is None
+    assert store.get_check(1)['last_result'] == 'ok'
+    assert store.get_check(4)['last_result'] == 'ok'
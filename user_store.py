@@ -0,0 +1,421 @@
+import os
+import json
+import sqlite3
+import logging
+from pathlib import Path
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# 加载环境变量
+load_dotenv()
+
+# 用户绑定数据库路径
+USER_DB_PATH = Path(os.getenv('USER_DB_PATH', 'user_data/users.db'))
+# 写入时等待其他连接释放写锁的最长时间（秒）
+# 主连接在事件循环中写入发件箱、进度和账号池，等待期间会阻塞事件循环，因此默认较短；
+# 合并写入层每个事务最多写入 WRITE_BEHIND_BATCH_SIZE 个用户，正常情况下只需等待几毫秒
+USER_DB_BUSY_TIMEOUT = float(os.getenv('USER_DB_BUSY_TIMEOUT', '1'))
+# 不在事件循环中使用的连接（合并写入的工作线程、命令行工具）可以等待更久
+BACKGROUND_BUSY_TIMEOUT = 30.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    telegram_id   INTEGER PRIMARY KEY,
+    email         TEXT,
+    password      TEXT,
+    auth_data     TEXT,
+    auth_validated_at REAL,
+    emby_user_id  TEXT,
+    emby_username TEXT,
+    emby_password TEXT,
+    emby_policy_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_users_email_nocase ON users(email COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_users_emby_user_id ON users(emby_user_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id    INTEGER NOT NULL,
+    text       TEXT NOT NULL,
+    attempts   INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_not_before ON outbox(not_before);
+CREATE TABLE IF NOT EXISTS user_checks (
+    telegram_id  INTEGER PRIMARY KEY,
+    last_checked REAL NOT NULL,
+    last_result  TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS emby_pool (
+    emby_user_id TEXT PRIMARY KEY,
+    username     TEXT NOT NULL,
+    password     TEXT NOT NULL,
+    created_at   REAL NOT NULL,
+    claimed_by   INTEGER,
+    claimed_at   REAL
+);
+"""
+
+USER_COLUMNS = ('telegram_id', 'email', 'password', 'auth_data', 'auth_validated_at',
+                'emby_user_id', 'emby_username', 'emby_password', 'emby_policy_hash')
+
+# 旧版数据库缺少的列，打开数据库时自动补齐
+MIGRATION_COLUMNS = {
+    'auth_validated_at': 'REAL',
+    'emby_policy_hash': 'TEXT',
+}
+
+
+def row_to_data(row: sqlite3.Row) -> dict:
+    """将数据库行转换为与原json文件相同结构的字典"""
+    data = {
+        'email': row['email'],
+        'password': row['password'],
+        'auth_data': row['auth_data'],
+        'auth_validated_at': row['auth_validated_at'],
+        'emby': {}
+    }
+    if row['emby_user_id']:
+        data['emby'] = {
+            'username': row['emby_username'],
+            'password': row['emby_password'],
+            'user_id': row['emby_user_id'],
+            'policy_hash': row['emby_policy_hash']
+        }
+    return data
+
+
+def data_to_row(telegram_id: int, data: dict) -> tuple:
+    """将用户数据字典转换为数据库行"""
+    emby = data.get('emby') or {}
+    return (
+        int(telegram_id),
+        data.get('email'),
+        data.get('password'),
+        data.get('auth_data'),
+        data.get('auth_validated_at'),
+        emby.get('user_id'),
+        emby.get('username'),
+        emby.get('password'),
+        emby.get('policy_hash')
+    )
+
+
+class UserStore:
+    """基于SQLite(WAL)的用户绑定存储，按Telegram ID、邮箱、Emby用户ID建立索引"""
+
+    def __init__(self, path: Path = USER_DB_PATH, busy_timeout: float = USER_DB_BUSY_TIMEOUT):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path, timeout=busy_timeout, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.migrate()
+        self.conn.commit()
+
+    def migrate(self):
+        """为旧版数据库补齐新增的列，删除已被替换的索引"""
+        existing = {row['name'] for row in self.conn.execute("PRAGMA table_info(users)")}
+        for column, column_type in MIGRATION_COLUMNS.items():
+            if column not in existing:
+                self.conn.execute(f"ALTER TABLE users ADD COLUMN {column} {column_type}")
+        # 邮箱查找改为不区分大小写，使用 idx_users_email_nocase
+        self.conn.execute("DROP INDEX IF EXISTS idx_users_email")
+
+    def close(self):
+        """关闭数据库连接"""
+        self.conn.close()
+
+    def get(self, telegram_id: int) -> dict | None:
+        """获取用户数据，不存在时返回None"""
+        row = self.conn.execute(
+            "SELECT * FROM users WHERE telegram_id = ?", (int(telegram_id),)).fetchone()
+        return row_to_data(row) if row else None
+
+    def find_telegram_id_by_email(self, email: str) -> int | None:
+        """根据邮箱查找绑定的Telegram ID（不区分大小写，面板和用户登录时输入的大小写可能不同）"""
+        row = self.conn.execute(
+            "SELECT telegram_id FROM users WHERE email = ? COLLATE NOCASE LIMIT 1", (email,)).fetchone()
+        return row['telegram_id'] if row else None
+
+    def find_telegram_id_by_emby_user_id(self, emby_user_id: str) -> int | None:
+        """根据Emby用户ID查找绑定的Telegram ID"""
+        row = self.conn.execute(
+            "SELECT telegram_id FROM users WHERE emby_user_id = ? LIMIT 1", (emby_user_id,)).fetchone()
+        return row['telegram_id'] if row else None
+
+    def save(self, telegram_id: int, data: dict):
+        """保存（插入或覆盖）用户数据"""
+        with self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO users ({', '.join(USER_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(USER_COLUMNS))})",
+                data_to_row(telegram_id, data))
+
+    def delete(self, telegram_id: int):
+        """删除用户数据"""
+        with self.conn:
+            self.conn.execute("DELETE FROM users WHERE telegram_id = ?", (int(telegram_id),))
+            self.conn.execute("DELETE FROM user_checks WHERE telegram_id = ?", (int(telegram_id),))
+
+    def apply_batch(self, saves: dict, deletes, cleared_checks, checks: dict):
+        """在一个事务中写入一批合并后的修改
+
+        Args:
+            saves: telegram_id -> 用户数据
+            deletes: 要删除的telegram_id
+            cleared_checks: 要清除检查记录的telegram_id（用户被删除过）
+            checks: telegram_id -> (检查结果, 检查时间)
+        """
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM users WHERE telegram_id = ?", [(int(x),) for x in deletes])
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO users ({', '.join(USER_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(USER_COLUMNS))})",
+                [data_to_row(telegram_id, data) for telegram_id, data in saves.items()])
+            self.conn.executemany(
+                "DELETE FROM user_checks WHERE telegram_id = ?", [(int(x),) for x in cleared_checks])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO user_checks (telegram_id, last_checked, last_result) "
+                "VALUES (?, ?, ?)",
+                [(int(telegram_id), checked_at, result) for telegram_id, (result, checked_at) in checks.items()])
+
+    def _iter_bindings(self, condition: str, params: tuple, fresh_after: float | None):
+        """按条件遍历已绑定Emby账号的用户，fresh_after 之后检查结果为ok的用户被跳过"""
+        query = ("SELECT users.* FROM users "
+                 "LEFT JOIN user_checks ON user_checks.telegram_id = users.telegram_id "
+                 f"WHERE users.emby_user_id IS NOT NULL AND {condition}")
+        if fresh_after is not None:
+            query += (" AND (user_checks.last_checked IS NULL OR user_checks.last_result != 'ok' "
+                      "OR user_checks.last_checked < ?)")
+            params += (fresh_after,)
+        cursor = self.conn.execute(query + " ORDER BY users.telegram_id", params)
+        for row in cursor:
+            yield row['telegram_id'], row_to_data(row)
+
+    def iter_emby_bindings(self, start_id: int = 0, fresh_after: float | None = None):
+        """遍历所有已绑定Emby账号的用户，返回 (telegram_id, data)
+
+        按Telegram ID顺序从 start_id 开始，到末尾后再从头遍历到 start_id 之前。
+        """
+        yield from self._iter_bindings("users.telegram_id >= ?", (int(start_id),), fresh_after)
+        if start_id:
+            yield from self._iter_bindings("users.telegram_id < ?", (int(start_id),), fresh_after)
+
+    def iter_emby_bindings_slice(self, slices: int, slice_index: int, fresh_after: float | None = None):
+        """遍历按Telegram ID取模后属于指定分片的已绑定Emby账号的用户"""
+        yield from self._iter_bindings(
+            "users.telegram_id % ? = ?", (slices, slice_index), fresh_after)
+
+    def record_check(self, telegram_id: int, result: str, checked_at: float):
+        """记录订阅检查任务对用户的最近一次检查时间和结果"""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO user_checks (telegram_id, last_checked, last_result) "
+                "VALUES (?, ?, ?)", (int(telegram_id), checked_at, result))
+
+    def get_check(self, telegram_id: int) -> dict | None:
+        """获取用户最近一次检查的 {"last_checked", "last_result"}"""
+        row = self.conn.execute(
+            "SELECT last_checked, last_result FROM user_checks WHERE telegram_id = ?",
+            (int(telegram_id),)).fetchone()
+        return dict(row) if row else None
+
+    def count_fresh_checks(self, fresh_after: float) -> int:
+        """fresh_after 之后检查结果为ok、且仍绑定Emby账号的用户数"""
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM user_checks JOIN users ON users.telegram_id = user_checks.telegram_id "
+            "WHERE users.emby_user_id IS NOT NULL AND user_checks.last_result = 'ok' "
+            "AND user_checks.last_checked >= ?", (fresh_after,)).fetchone()[0]
+
+    def iter_policy_outdated(self, desired_hash: str, after_id: int = 0, limit: int = 100) -> list:
+        """按Telegram ID顺序取出一批记录的权限哈希与期望不一致的Emby绑定"""
+        rows = self.conn.execute(
+            "SELECT * FROM users WHERE emby_user_id IS NOT NULL AND telegram_id > ? "
+            "AND (emby_policy_hash IS NULL OR emby_policy_hash != ?) "
+            "ORDER BY telegram_id LIMIT ?", (int(after_id), desired_hash, limit)).fetchall()
+        return [(row['telegram_id'], row_to_data(row)) for row in rows]
+
+    def count_policy_outdated(self, desired_hash: str) -> int:
+        """记录的权限哈希与期望不一致的Emby绑定数量"""
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM users WHERE emby_user_id IS NOT NULL "
+            "AND (emby_policy_hash IS NULL OR emby_policy_hash != ?)", (desired_hash,)).fetchone()[0]
+
+    def set_policy_hash(self, telegram_id: int, policy_hash: str):
+        """记录用户Emby账号当前的权限哈希"""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE users SET emby_policy_hash = ? WHERE telegram_id = ?",
+                (policy_hash, int(telegram_id)))
+
+    def iter_user_rows(self):
+        """按Telegram ID顺序逐行遍历所有用户的原始列（游标流式读取，不一次性载入内存）"""
+        cursor = self.conn.execute(f"SELECT {', '.join(USER_COLUMNS)} FROM users ORDER BY telegram_id")
+        for row in cursor:
+            yield dict(row)
+
+    def save_user_rows(self, rows: list, meta: dict | None = None):
+        """在一个事务中批量写入（插入或覆盖）按 USER_COLUMNS 顺序排列的用户行，并同时写入meta"""
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO users ({', '.join(USER_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(USER_COLUMNS))})", rows)
+            for key, value in (meta or {}).items():
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def count(self) -> int:
+        """用户总数"""
+        return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def get_meta(self, key: str, default: str | None = None) -> str | None:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row else default
+
+    def set_meta(self, key: str, value: str):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def delete_meta(self, key: str):
+        with self.conn:
+            self.conn.execute("DELETE FROM meta WHERE key = ?", (key,))
+
+    def add_pooled_emby_user(self, emby_user_id: str, username: str, password: str, now: float):
+        """将预创建的（禁用状态）Emby账号加入账号池"""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO emby_pool (emby_user_id, username, password, created_at) "
+                "VALUES (?, ?, ?, ?)", (emby_user_id, username, password, now))
+
+    def claim_pooled_emby_user(self, telegram_id: int, now: float) -> dict | None:
+        """领取账号池中最早创建的一个账号，标记为被 telegram_id 领取，账号池为空时返回None
+
+        领取记录在账号启用并保存绑定后才删除，进程中途崩溃时由 iter_stale_pool_claims 找回。
+        """
+        while True:
+            row = self.conn.execute(
+                "SELECT * FROM emby_pool WHERE claimed_by IS NULL "
+                "ORDER BY created_at LIMIT 1").fetchone()
+            if row is None:
+                return None
+            with self.conn:
+                claimed = self.conn.execute(
+                    "UPDATE emby_pool SET claimed_by = ?, claimed_at = ? "
+                    "WHERE emby_user_id = ? AND claimed_by IS NULL",
+                    (int(telegram_id), now, row['emby_user_id'])).rowcount
+            if claimed:
+                return dict(row, claimed_by=int(telegram_id), claimed_at=now)
+
+    def remove_pooled_emby_user(self, emby_user_id: str):
+        """从账号池删除账号（已绑定给用户或已从Emby删除）"""
+        with self.conn:
+            self.conn.execute("DELETE FROM emby_pool WHERE emby_user_id = ?", (emby_user_id,))
+
+    def iter_stale_pool_claims(self, claimed_before: float) -> list:
+        """在 claimed_before 之前被领取、但仍未完成的账号池记录"""
+        return [dict(row) for row in self.conn.execute(
+            "SELECT * FROM emby_pool WHERE claimed_by IS NOT NULL AND claimed_at < ?",
+            (claimed_before,)).fetchall()]
+
+    def count_pooled_emby_users(self) -> dict:
+        """账号池中可领取和已领取未完成的账号数"""
+        row = self.conn.execute(
+            "SELECT COUNT(*) - COUNT(claimed_by) AS available, COUNT(claimed_by) AS claimed "
+            "FROM emby_pool").fetchone()
+        return dict(row)
+
+    def enqueue_notification(self, chat_id: int, text: str, now: float):
+        """将待发送的Telegram消息写入发件箱"""
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO outbox (chat_id, text, not_before, created_at) VALUES (?, ?, ?, ?)",
+                (int(chat_id), text, now, now))
+
+    def fetch_due_notifications(self, now: float, limit: int = 100) -> list:
+        """按入队顺序取出已到发送时间的消息"""
+        return self.conn.execute(
+            "SELECT * FROM outbox WHERE not_before <= ? ORDER BY id LIMIT ?",
+            (now, limit)).fetchall()
+
+    def next_notification_time(self) -> float | None:
+        """发件箱中最早可发送消息的时间"""
+        return self.conn.execute("SELECT MIN(not_before) FROM outbox").fetchone()[0]
+
+    def reschedule_notification(self, notification_id: int, not_before: float, attempts: int):
+        """推迟消息的发送时间"""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE outbox SET not_before = ?, attempts = ? WHERE id = ?",
+                (not_before, attempts, notification_id))
+
+    def delete_notification(self, notification_id: int):
+        """从发件箱删除消息（已发送或放弃发送）"""
+        with self.conn:
+            self.conn.execute("DELETE FROM outbox WHERE id = ?", (notification_id,))
+
+    def count_notifications(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def import_user_data_dir(self, user_data_dir: Path) -> int:
+        """从旧版 user_data/*.json 导入用户数据，返回导入数量"""
+        imported = 0
+        with self.conn:
+            for file_path in Path(user_data_dir).glob("*.json"):
+                try:
+                    telegram_id = int(file_path.stem)
+                    with open(file_path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                    self.conn.execute(
+                        f"INSERT OR REPLACE INTO users ({', '.join(USER_COLUMNS)}) "
+                        f"VALUES ({', '.join('?' * len(USER_COLUMNS))})",
+                        data_to_row(telegram_id, data))
+                    imported += 1
+                except Exception as e:
+                    logger.error(f"导入用户数据文件 {file_path} 时出错: {str(e)}")
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', '1')")
+        return imported
+
+    def import_user_data_dir_once(self, user_data_dir: Path) -> int:
+        """仅在首次启动时从旧版json文件导入用户数据"""
+        if self.get_meta('json_imported'):
+            return 0
+        imported = self.import_user_data_dir(user_data_dir)
+        if imported:
+            logger.info(f"已从 {user_data_dir} 导入 {imported} 个用户的绑定数据")
+        return imported
+
+
+# 进程内共享的存储实例
+_store: UserStore | None = None
+
+
+def get_user_store() -> UserStore:
+    """获取共享的用户存储实例"""
+    global _store
+    if _store is None:
+        _store = UserStore()
+    return _store
+
+
+def main():
+    # 手动导入旧版json数据：python user_store.py [user_data目录]
+    import sys
+    user_data_dir = Path(sys.argv[1]) if len(sys.argv) > 1 else Path("user_data")
+    store = get_user_store()
+    imported = store.import_user_data_dir(user_data_dir)
+    print(f"已导入 {imported} 个用户，数据库共 {store.count()} 个用户")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,114 @@
 import os
+import json
+import time
+import logging
+import httpx
 import requests
 from dotenv import load_dotenv
+from cache import AsyncTTLCache, LoadCancelled
+from metrics import observe_upstream
+from circuit_breaker import call_with_retry, CircuitOpenError
+from deadline import parse_endpoint_timeouts, request_timeout, DeadlineExceeded
+from settings import Settings, get_settings
+
+logger = logging.getLogger(__name__)
+
+# 共享的异步HTTP客户端（连接池），整个进程复用
+_async_client: httpx.AsyncClient | None = None
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """获取共享的异步HTTP客户端，首次调用时按 V2BOARD_POOL_SIZE 创建连接池"""
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=V2BOARD_POOL_SIZE,
+                max_keepalive_connections=V2BOARD_POOL_SIZE
+            ),
+            timeout=httpx.Timeout(V2BOARD_READ_TIMEOUT, connect=V2BOARD_CONNECT_TIMEOUT)
+        )
+    return _async_client
+
+
+async def close_async_client():
+    """关闭共享的异步HTTP客户端"""
+    global _async_client
+    if _async_client is not None and not _async_client.is_closed:
+        await _async_client.aclose()
+    _async_client = None
+
+
+# 用户信息和订阅信息的共享缓存，按auth_data区分用户，处理函数和定时任务共用
+load_dotenv()
+V2BOARD_CACHE_TTL = float(os.getenv('V2BOARD_CACHE_TTL', '30'))
+V2BOARD_CACHE_SIZE = int(os.getenv('V2BOARD_CACHE_SIZE', '10000'))
+user_info_cache = AsyncTTLCache(V2BOARD_CACHE_TTL, V2BOARD_CACHE_SIZE)
+subscribe_cache = AsyncTTLCache(V2BOARD_CACHE_TTL, V2BOARD_CACHE_SIZE)
+
+# 连接池大小（最大并发连接数）
+V2BOARD_POOL_SIZE = int(os.getenv('V2BOARD_POOL_SIZE', '100'))
+# 请求超时（秒）：连接超时、读取超时，以及按接口路径单独配置的读取超时
+V2BOARD_CONNECT_TIMEOUT = float(os.getenv('V2BOARD_CONNECT_TIMEOUT', '3'))
+V2BOARD_READ_TIMEOUT = float(os.getenv('V2BOARD_READ_TIMEOUT', '10'))
+V2BOARD_ENDPOINT_TIMEOUTS = parse_endpoint_timeouts(os.getenv('V2BOARD_ENDPOINT_TIMEOUTS', ''))
+# 面板拒绝登录时返回的500提示（逗号分隔，包含其一即视为密码错误或账号被封禁），
+# 默认为V2Board中英文语言包中的提示；其他500（数据库不可用、PHP错误等）视为面板故障
+V2BOARD_CREDENTIAL_ERRORS = [
+    message.strip() for message in os.getenv(
+        'V2BOARD_CREDENTIAL_ERRORS',
+        'Incorrect email or password,邮箱或密码错误,Your account has been suspended,该账户已被停止使用'
+    ).split(',') if message.strip()
+]
+
+# 面板不可用时请求可能抛出的异常：网络错误、响应不是JSON、熔断、处理超时、合并等待的加载被取消
+UPSTREAM_ERRORS = (httpx.HTTPError, json.JSONDecodeError, CircuitOpenError, DeadlineExceeded, LoadCancelled)
 
-class V2BoardAPI:
-    def __init__(self):
-        # 加载 .env 文件中的环境变量
-        load_dotenv()
 
+def panel_message(response: httpx.Response) -> str:
+    """面板错误响应中的 message 字段"""
+    try:
+        result = response.json()
+    except json.JSONDecodeError:
+        return ''
+    return str(result.get('message') or '') if isinstance(result, dict) else ''
+
+
+def is_rejection(response: httpx.Response) -> bool:
+    """面板是否明确拒绝了请求（凭据无效、账号被封禁、未登录等），而不是出现故障
+
+    V2Board对密码错误和账号被封禁返回500，只有 message 为 V2BOARD_CREDENTIAL_ERRORS 之一时视为拒绝；
+    4xx中除404、408、429之外视为拒绝。
+    """
+    if response.status_code >= 500:
+        message = panel_message(response)
+        return any(text in message for text in V2BOARD_CREDENTIAL_ERRORS)
+    return 400 <= response.status_code < 500 and response.status_code not in (404, 408, 429)
+
+
+def is_panel_failure(response: httpx.Response) -> bool:
+    """面板故障：5xx中除明确拒绝之外的所有错误，计入熔断器"""
+    return response.status_code >= 500 and not is_rejection(response)
+
+
+def is_subscription_expired(user_info: dict, now: float | None = None) -> bool:
+    """订阅是否已到期，expired_at 为空表示长期有效"""
+    expired_at = user_info.get('expired_at')
+    if not expired_at:
+        return False
+    return float(expired_at) <= (time.time() if now is None else now)
+
+
+class V2BoardAPI:
+    def __init__(self, settings: Settings | None = None):
         # 获取配置
-        self.base_url = os.getenv('V2BOARD_URL').rstrip('/')
+        settings = settings or get_settings()
+        self.base_url = settings.v2board_url
         self.email = None
         self.password = None
         self.auth_data = None
+        # 请求超时（连接超时, 读取超时）
+        self.timeout = (V2BOARD_CONNECT_TIMEOUT, V2BOARD_READ_TIMEOUT)
 
         # 设置请求头
         self.headers = {
@@ -30,7 +127,7 @@ class V2BoardAPI:
         data = { "email": self.email, "password": self.password }
 
         try:
-            response = requests.post(url, json=data, headers=self.headers)
+            response = requests.post(url, json=data, headers=self.headers, timeout=self.timeout)
             if response.status_code == 200:
                 result = response.json()
                 if 'data' in result and 'auth_data' in result['data']:
@@ -39,7 +136,7 @@ class V2BoardAPI:
                     return True
             return False
         except Exception as e:
-            print(f"Login error: {str(e)}")
+            logger.error(f"登录V2Board失败: {str(e)}")
             return False
 
     def check_auth(self):
@@ -48,7 +145,7 @@ class V2BoardAPI:
             return False
         try:
             response = requests.get(
-                f"{self.base_url}/user/info", headers=self.headers)
+                f"{self.base_url}/user/info", headers=self.headers, timeout=self.timeout)
             return response.status_code == 200 and 'data' in response.json()
         except:
             return False
@@ -59,12 +156,12 @@ class V2BoardAPI:
             return None
         try:
             response = requests.get(
-                f"{self.base_url}/user/info", headers=self.headers)
+                f"{self.base_url}/user/info", headers=self.headers, timeout=self.timeout)
             if response.status_code == 200:
                 return response.json()
             return None
         except Exception as e:
-            print(f"Get user info error: {str(e)}")
+            logger.error(f"获取V2Board用户信息失败: {str(e)}")
             return None
 
     def get_subscribe_info(self):
@@ -73,14 +170,240 @@ class V2BoardAPI:
             return None
         try:
             response = requests.get(
-                f"{self.base_url}/user/getSubscribe", headers=self.headers)
+                f"{self.base_url}/user/getSubscribe", headers=self.headers, timeout=self.timeout)
             if response.status_code == 200:
                 return response.json()
             return None
         except Exception as e:
-            print(f"Get subscribe info error: {str(e)}")
+            logger.error(f"获取V2Board订阅信息失败: {str(e)}")
             return None
 
+class AsyncV2BoardAPI:
+    """V2BoardAPI 的异步版本，所有实例共享同一个长连接池"""
+
+    def __init__(self, settings: Settings | None = None):
+        # 获取配置
+        self.settings = settings or get_settings()
+        self.base_url = self.settings.v2board_url
+        self.email = None
+        self.password = None
+        self.auth_data = None
+        # auth_data 最近一次被确认有效的时间戳，以及当时获取到的用户信息
+        self.auth_validated_at = None
+        self.user_info = None
+        # 最近一次请求的响应和异常，请求未得到响应（网络错误、熔断）时响应为None
+        self.last_response = None
+        self.last_error = None
+
+        # 设置请求头
+        self.headers = {
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+        }
+
+    async def _request(self, method: str, path: str, endpoint: str | None = None,
+                       **kwargs) -> httpx.Response:
+        """通过共享连接池请求V2Board接口，经过熔断器和重试，并记录每次尝试的耗时指标
+
+        Args:
+            endpoint: 指标和超时配置中使用的路径（不含管理后台路径等敏感信息），默认为 path
+        """
+        endpoint = endpoint or path
+
+        async def send():
+            start_time = time.perf_counter()
+            status = 'error'
+            try:
+                response = await get_async_client().request(
+                    method, f"{self.base_url}{path}", headers=self.headers,
+                    timeout=request_timeout(
+                        V2BOARD_CONNECT_TIMEOUT,
+                        V2BOARD_ENDPOINT_TIMEOUTS.get(endpoint, V2BOARD_READ_TIMEOUT)),
+                    **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                observe_upstream('v2board', endpoint, status, time.perf_counter() - start_time)
+
+        self.last_response = None
+        self.last_error = None
+        try:
+            response = await call_with_retry('v2board', send, is_failure=is_panel_failure)
+        except Exception as e:
+            self.last_error = e
+            raise
+        self.last_response = response
+        return response
+
+    def upstream_failed(self) -> bool:
+        """最近一次请求是否因为面板不可用而失败，而不是被面板拒绝
+
+        网络错误、熔断、处理超时、响应无法解析，以及除明确拒绝（见 is_rejection）之外的
+        错误响应都视为面板不可用，此时不能据此判断账号已失效。
+        """
+        if self.last_error is not None:
+            return True
+        response = self.last_response
+        if response is None:
+            return False
+        if response.is_success:
+            # 成功状态码但响应中没有预期的数据
+            return True
+        return not is_rejection(response)
+
+    async def login(self):
+        """登录并获取auth_data，失败原因见 upstream_failed"""
+        self.last_response = None
+        self.last_error = None
+        if not self.email or not self.password:
+            return False
+
+        data = { "email": self.email, "password": self.password }
+
+        try:
+            response = await self._request('POST', "/passport/auth/login", json=data)
+            if response.status_code == 200:
+                result = response.json()
+                if 'data' in result and 'auth_data' in result['data']:
+                    self.auth_data = result['data']['auth_data']
+                    self.headers['Authorization'] = self.auth_data
+                    self.auth_validated_at = time.time()
+                    self.user_info = None
+                    return True
+            return False
+        except UPSTREAM_ERRORS as e:
+            self.last_error = e
+            logger.warning(f"登录V2Board失败: {type(e).__name__}: {str(e)}")
+            return False
+
+    def is_auth_fresh(self, ttl: float) -> bool:
+        """auth_data 是否在 ttl 秒内被确认过有效"""
+        return (self.auth_validated_at is not None
+                and time.time() - self.auth_validated_at < ttl)
+
+    async def check_auth(self):
+        """检查认证是否有效"""
+        if not self.auth_data:
+            return False
+        try:
+            response = await self._request('GET', "/user/info")
+            return response.status_code == 200 and 'data' in response.json()
+        except UPSTREAM_ERRORS as e:
+            self.last_error = e
+            return False
+
+    async def _fetch(self, path: str):
+        """请求V2Board接口，仅返回包含data的成功响应"""
+        response = await self._request('GET', path)
+        if response.status_code == 200:
+            result = response.json()
+            if 'data' in result:
+                return result
+        return None
+
+    async def get_user_info(self):
+        """获取用户信息（经过共享缓存，同一用户的并发请求只访问一次面板）"""
+        if not self.auth_data:
+            return None
+        try:
+            result = await user_info_cache.get_or_load(
+                self.auth_data, lambda: self._fetch("/user/info"))
+            if result:
+                self.auth_validated_at = time.time()
+                self.user_info = result
+            return result
+        except UPSTREAM_ERRORS as e:
+            # 合并等待其他请求的加载时，异常不经过本实例的 _request，在这里记录
+            self.last_error = e
+            logger.warning(f"获取V2Board用户信息失败: {type(e).__name__}: {str(e)}")
+            return None
+
+    async def get_user_info_cached(self, ttl: float):
+        """获取用户信息，ttl 秒内复用最近一次成功获取（验证认证时）的结果"""
+        if self.user_info is not None and self.is_auth_fresh(ttl):
+            return self.user_info
+        return await self.get_user_info()
+
+    async def get_subscribe_info(self):
+        """获取订阅信息（经过共享缓存）"""
+        if not self.auth_data:
+            return None
+        try:
+            return await subscribe_cache.get_or_load(
+                self.auth_data, lambda: self._fetch("/user/getSubscribe"))
+        except UPSTREAM_ERRORS as e:
+            self.last_error = e
+            logger.warning(f"获取V2Board订阅信息失败: {type(e).__name__}: {str(e)}")
+            return None
+
+
+class AsyncV2BoardAdminAPI(AsyncV2BoardAPI):
+    """以管理员身份分页读取V2Board用户列表，一次获取所有用户的订阅等级，不需要逐个用户登录"""
+
+    def __init__(self, settings: Settings | None = None):
+        super().__init__(settings)
+        self.admin_path = self.settings.v2board_admin_path
+        self.page_size = self.settings.v2board_admin_page_size
+        self.email = self.settings.v2board_admin_email or None
+        self.password = self.settings.v2board_admin_password or None
+        if self.settings.v2board_admin_token:
+            self.auth_data = self.settings.v2board_admin_token
+            self.headers['Authorization'] = self.auth_data
+
+    async def fetch_users(self, current: int = 1, page_size: int | None = None) -> dict:
+        """获取管理后台用户列表的一页
+
+        Returns:
+            dict: V2Board返回的 {"data": [...], "total": N}
+        """
+        if not self.auth_data and not await self.login():
+            raise RuntimeError("V2Board管理员登录失败")
+        params = {'current': current, 'pageSize': page_size or self.page_size}
+        response = await self._request(
+            'GET', f"/{self.admin_path}/user/fetch", "/{admin}/user/fetch", params=params)
+        if response.status_code in (401, 403) and self.email and self.password:
+            # 管理员auth_data失效，重新登录后重试一次
+            if not await self.login():
+                raise RuntimeError("V2Board管理员登录失败")
+            response = await self._request(
+                'GET', f"/{self.admin_path}/user/fetch", "/{admin}/user/fetch", params=params)
+        response.raise_for_status()
+        return response.json()
+
+    async def iter_users(self, page_size: int | None = None):
+        """逐页遍历面板中的所有用户"""
+        current = 1
+        fetched = 0
+        while True:
+            page = await self.fetch_users(current, page_size)
+            items = page.get('data') or []
+            for user in items:
+                yield user
+            fetched += len(items)
+            current += 1
+            if not items or fetched >= page.get('total', 0):
+                return
+
+    async def fetch_plan_map(self, page_size: int | None = None) -> dict:
+        """获取所有用户的订阅信息
+
+        Returns:
+            dict: 小写邮箱 -> {"email", "plan_id", "expired_at", "banned"}
+        """
+        plan_map = {}
+        async for user in self.iter_users(page_size):
+            email = (user.get('email') or '').lower()
+            if email:
+                plan_map[email] = {
+                    'email': user.get('email'),
+                    'plan_id': user.get('plan_id'),
+                    'expired_at': user.get('expired_at'),
+                    'banned': user.get('banned')
+                }
+        return plan_map
+
+
 def main():
     # 使用示例
     api = V2BoardAPI()
@@ -0,0 +1,259 @@
+import os
+import copy
+import time
+import asyncio
+import logging
+import contextvars
+from dotenv import load_dotenv
+from user_store import UserStore, get_user_store, BACKGROUND_BUSY_TIMEOUT
+from metrics import WRITE_BEHIND_PENDING, WRITE_BEHIND_COALESCED, WRITE_BEHIND_FLUSH_DURATION
+
+logger = logging.getLogger(__name__)
+
+# 加载环境变量
+load_dotenv()
+
+# 合并写入的最长等待时间（秒），为0时每次修改都直接写入数据库
+WRITE_BEHIND_INTERVAL = float(os.getenv('WRITE_BEHIND_INTERVAL', '0.5'))
+# 等待写入的用户数达到此值时立即写入，不再等待
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', '500'))
+# 写入失败后重试前的等待时间（秒）
+WRITE_BEHIND_RETRY_DELAY = 5.0
+
+# 等待写入的删除操作
+DELETED = None
+
+
+class WriteBehindStore:
+    """用户数据的合并写入层
+
+    命令处理函数和定时任务的修改先记录在内存中，同一用户的多次修改只保留最后一次，
+    由后台任务每 WRITE_BEHIND_INTERVAL 秒在工作线程中用独立的数据库连接批量写入，
+    处理函数不再等待磁盘写入。读取时优先返回尚未写入的修改。
+    每个事务最多包含 batch_size 个用户，积压较多时分成多个事务，主连接在事件循环中的写入最多等待一个事务。
+
+    进程正常退出时调用 stop() 写入剩余的修改；进程被强制结束时最多丢失最近 WRITE_BEHIND_INTERVAL 秒的修改，
+    数据库本身由事务保证不会出现写了一半的数据。
+    """
+
+    def __init__(self, store: UserStore | None = None, interval: float = WRITE_BEHIND_INTERVAL,
+                 batch_size: int = WRITE_BEHIND_BATCH_SIZE):
+        self.store = store or get_user_store()
+        self.interval = interval
+        self.batch_size = batch_size
+        # telegram_id -> 用户数据，DELETED 表示删除
+        self._pending = {}
+        # 被删除过的用户，写入时清除其检查记录
+        self._cleared_checks = set()
+        # telegram_id -> (检查结果, 检查时间)
+        self._checks = {}
+        # telegram_id -> 写入成功后调用的函数列表
+        self._callbacks = {}
+        # 正在写入的一批修改，写入完成前读取时仍需返回
+        self._flushing = {}
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._stopping = False
+        # 后台写入使用的独立数据库连接，只在工作线程中使用
+        self._writer: UserStore | None = None
+        self.flushes = 0
+        self.coalesced = 0
+        WRITE_BEHIND_PENDING.set_function(lambda: len(self._pending) + len(self._checks))
+
+    def _write_through(self) -> bool:
+        """是否直接写入：未启用合并写入，或不在事件循环中"""
+        if self.interval <= 0:
+            return True
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return True
+        if self._task is None or self._task.done():
+            # 使用新的上下文，不继承当前命令的处理时限
+            self._task = asyncio.create_task(self._worker(), context=contextvars.Context())
+        return False
+
+    def _queued(self):
+        if len(self._pending) + len(self._checks) >= self.batch_size:
+            self._wakeup.set()
+
+    def save(self, telegram_id: int, data: dict, on_flushed=None):
+        """保存用户数据，on_flushed 在数据写入数据库后调用"""
+        telegram_id = int(telegram_id)
+        if self._write_through():
+            self.store.save(telegram_id, data)
+            if on_flushed:
+                on_flushed()
+            return
+        if telegram_id in self._pending:
+            self.coalesced += 1
+            WRITE_BEHIND_COALESCED.inc()
+        self._pending[telegram_id] = copy.deepcopy(data)
+        if on_flushed:
+            self._callbacks.setdefault(telegram_id, []).append(on_flushed)
+        self._queued()
+
+    def delete(self, telegram_id: int):
+        """删除用户数据和检查记录"""
+        telegram_id = int(telegram_id)
+        if self._write_through():
+            self.store.delete(telegram_id)
+            return
+        if telegram_id in self._pending:
+            self.coalesced += 1
+            WRITE_BEHIND_COALESCED.inc()
+        self._pending[telegram_id] = DELETED
+        self._cleared_checks.add(telegram_id)
+        self._checks.pop(telegram_id, None)
+        self._queued()
+
+    def record_check(self, telegram_id: int, result: str, checked_at: float):
+        """记录订阅检查结果"""
+        telegram_id = int(telegram_id)
+        if self._write_through():
+            self.store.record_check(telegram_id, result, checked_at)
+            return
+        if telegram_id in self._checks:
+            self.coalesced += 1
+            WRITE_BEHIND_COALESCED.inc()
+        self._checks[telegram_id] = (result, checked_at)
+        self._queued()
+
+    def set_policy_hash(self, telegram_id: int, emby_user_id: str, policy_hash: str):
+        """更新Emby账号记录的权限哈希，用户已解绑或更换Emby账号时忽略"""
+        data = self.get(telegram_id)
+        if data is None or (data.get('emby') or {}).get('user_id') != emby_user_id:
+            return
+        data['emby']['policy_hash'] = policy_hash
+        self.save(telegram_id, data)
+
+    def _lookup(self, telegram_id: int):
+        """未写入的修改：返回 (是否存在未写入的修改, 用户数据或DELETED)"""
+        for pending in (self._pending, self._flushing):
+            if telegram_id in pending:
+                return True, pending[telegram_id]
+        return False, None
+
+    def get(self, telegram_id: int) -> dict | None:
+        """获取用户数据，优先返回尚未写入的修改"""
+        found, data = self._lookup(int(telegram_id))
+        if found:
+            return copy.deepcopy(data) if data is not DELETED else None
+        return self.store.get(telegram_id)
+
+    def find_telegram_id_by_email(self, email: str) -> int | None:
+        """根据邮箱查找绑定的Telegram ID（不区分大小写），包括尚未写入的修改"""
+        email = email.lower()
+        for pending in (self._pending, self._flushing):
+            for telegram_id, data in pending.items():
+                if data is not DELETED and (data.get('email') or '').lower() == email:
+                    return telegram_id
+        telegram_id = self.store.find_telegram_id_by_email(email)
+        if telegram_id is not None:
+            found, data = self._lookup(telegram_id)
+            if found and (data is DELETED or (data.get('email') or '').lower() != email):
+                # 数据库中的绑定已被删除或改绑其他邮箱，尚未写入
+                return None
+        return telegram_id
+
+    async def _worker(self):
+        delay = self.interval
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                delay = self.interval
+            except Exception as e:
+                logger.error(f"写入用户数据失败，{WRITE_BEHIND_RETRY_DELAY:.0f} 秒后重试: {str(e)}")
+                delay = WRITE_BEHIND_RETRY_DELAY
+
+    def _write_batch(self, saves: dict, deletes: list, cleared_checks: set, checks: dict):
+        """在工作线程中写入一批修改，同一用户的修改在同一个事务中"""
+        if self._writer is None:
+            self._writer = UserStore(self.store.path, busy_timeout=BACKGROUND_BUSY_TIMEOUT)
+        deletes = set(deletes)
+        telegram_ids = list(dict.fromkeys([*saves, *deletes, *cleared_checks, *checks]))
+        for start in range(0, len(telegram_ids), max(1, self.batch_size)):
+            chunk = telegram_ids[start:start + max(1, self.batch_size)]
+            self._writer.apply_batch(
+                {x: saves[x] for x in chunk if x in saves},
+                [x for x in chunk if x in deletes],
+                {x for x in chunk if x in cleared_checks},
+                {x: checks[x] for x in chunk if x in checks})
+
+    async def flush(self) -> int:
+        """立即写入所有未写入的修改，返回写入的条数；失败时修改放回队列并抛出异常"""
+        async with self._flush_lock:
+            if not self._pending and not self._checks:
+                return 0
+            batch, self._pending = self._pending, {}
+            cleared_checks, self._cleared_checks = self._cleared_checks, set()
+            checks, self._checks = self._checks, {}
+            callbacks, self._callbacks = self._callbacks, {}
+            self._flushing = batch
+            saves = {telegram_id: data for telegram_id, data in batch.items() if data is not DELETED}
+            deletes = [telegram_id for telegram_id, data in batch.items() if data is DELETED]
+            start_time = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._write_batch, saves, deletes, cleared_checks, checks)
+            except BaseException:
+                # 放回队列，期间已有的新修改优先
+                self._pending = {**batch, **self._pending}
+                self._cleared_checks |= cleared_checks
+                self._checks = {**checks, **self._checks}
+                for telegram_id, functions in callbacks.items():
+                    self._callbacks.setdefault(telegram_id, [])[:0] = functions
+                raise
+            finally:
+                self._flushing = {}
+                WRITE_BEHIND_FLUSH_DURATION.observe(time.perf_counter() - start_time)
+            self.flushes += 1
+
+        for functions in callbacks.values():
+            for function in functions:
+                try:
+                    function()
+                except Exception as e:
+                    logger.error(f"用户数据写入后的回调出错: {str(e)}")
+        return len(batch) + len(checks)
+
+    async def stop(self):
+        """停止后台任务并写入剩余的修改
+
+        不取消正在进行的写入（工作线程无法中断），等待后台任务完成当前一批后退出。
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            self._stopping = False
+        await self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        logger.info("用户数据已全部写入")
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._pending) + len(self._checks),
+            'flushes': self.flushes,
+            'coalesced': self.coalesced
+        }
+
+
+# 进程内共享的合并写入层
+_write_behind: WriteBehindStore | None = None
+
+
+def get_write_behind() -> WriteBehindStore:
+    """获取共享的合并写入层"""
+    global _write_behind
+    if _write_behind is None:
+        _write_behind = WriteBehindStore()
+    return _write_behind